@@ -136,12 +136,24 @@ class Network(Thread):
 
         while not self.exiting_:
             try:
-                data = self.rep_socket.recv_json()
-                log.info("Processing message: {}".format(data))
+                frame = self.rep_socket.recv()
             except Exception:
                 log.exception("failed to receive sensor message")
                 continue
 
+            # We only speak JSON, and only ever reply in JSON, so the server should never
+            # send us one of its binary codecs (frames that start with a NUL). If it does,
+            # we must still reply, or the REP socket will never receive again.
+            try:
+                if frame.startswith(b'\0'):
+                    raise ValueError("unsupported codec")
+                data = json.loads(frame.decode('UTF-8'))
+                log.info("Processing message: {}".format(data))
+            except Exception:
+                log.exception("failed to decode sensor message")
+                self.rep_socket.send_json({'result': 'error: undecodable message'})
+                continue
+
             with self.lock_:
                 if self.exiting_:
                     return
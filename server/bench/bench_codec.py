@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+"""
+Compare the Bus wire codecs on typical nerve traffic.
+
+Run from the server directory: python3 bench/bench_codec.py [--journal FILE]
+
+By default this uses a handful of representative nerve payloads. Pass a journal
+written by eyrie_main.py --record to benchmark on real sensor traffic instead.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mcp import codec, journal
+
+# Hand-written payloads in the shape that nerves send.
+SampleNervePayloads = [
+    {'type': 'TEMP_HUMIDITY', 'temp': 21.3, 'humidity': 38.6},
+    {'type': 'TEMP_HUMIDITY', 'temp': 21.4, 'humidity': 38.5},
+    {'type': 'MOVEMENT', 'state': 1},
+    {'type': 'MOVEMENT', 'state': 0},
+    {'type': 'TEMP_HUMIDITY', 'temp': 19.8, 'humidity': 44.1},
+    {'type': 'MOVEMENT', 'state': 1},
+    {'type': 'MOVEMENT', 'state': 0},
+    {'type': 'TEMP_HUMIDITY', 'temp': 19.9, 'humidity': 44.0},
+]
+
+
+def load_journal_payloads(filename: str) -> [object]:
+    """
+    Decode every sensor message in a journal.
+    """
+    return [codec.decode(record.payload) for record in journal.JournalReader(filename)
+            if record.kind == journal.SensorMessage]
+
+
+def bench_codec(encoder, payloads: [object], repeat: int, number: int):
+    frames = [encoder.encode(payload) for payload in payloads]
+    size = sum(len(frame) for frame in frames) / len(frames)
+
+    def encode_all():
+        for payload in payloads:
+            encoder.encode(payload)
+
+    def decode_all():
+        for frame in frames:
+            codec.decode(frame)
+
+    per_message = number * len(payloads)
+    encode = min(timeit.repeat(encode_all, repeat=repeat, number=number)) / per_message
+    decode = min(timeit.repeat(decode_all, repeat=repeat, number=number)) / per_message
+    return size, encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Bus wire codecs on nerve payloads.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing runs per codec; the best is reported.')
+    parser.add_argument('--number', type=int, default=10000, help='Passes over the payloads per timing run.')
+    parser.add_argument('--journal', metavar='FILE', type=str, default=None,
+                        help='Use the sensor messages recorded in this journal as the payloads.')
+    args = parser.parse_args()
+
+    payloads = SampleNervePayloads
+    if args.journal:
+        payloads = load_journal_payloads(args.journal)
+        if not payloads:
+            print("no sensor messages in {}".format(args.journal))
+            return 1
+    print("{} payloads".format(len(payloads)))
+
+    print("{:<10} {:>12} {:>14} {:>14}".format('codec', 'bytes/msg', 'encode us/msg', 'decode us/msg'))
+    for name, encoder in sorted(codec.Codecs.items()):
+        if not codec.is_available(name):
+            print("{:<10} (not installed)".format(name))
+            continue
+        size, encode, decode = bench_codec(encoder, payloads, args.repeat, args.number)
+        print("{:<10} {:>12.1f} {:>14.3f} {:>14.3f}".format(name, size, encode * 1e6, decode * 1e6))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
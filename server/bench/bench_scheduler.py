@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+"""
+Compare the Scheduler's heap and timing wheel backends on large timer populations.
+
+Run from the server directory: python3 bench/bench_scheduler.py [--timers N ...]
+
+Each run arms N timers spread over an hour, cancels half of them, reschedules a
+quarter, then drains the rest in deadline order the way the scheduler thread
+would. Time is simulated, so this measures only the bookkeeping. With --slack,
+timers may fire that long after their deadline, and the drain wakes only as
+often as their windows require.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mcp.clock import NanosPerSecond
+from mcp.scheduler import _Event, _HeapQueue, _TimingWheel
+
+
+class BenchTimer:
+    event_ = None
+
+    def __init__(self, slack: int):
+        self.slack_ = slack
+
+
+def bench_backend(make_queue: callable, count: int, seed: int, slack: int) -> {str: float}:
+    rng = random.Random(seed)
+    queue = make_queue()
+    timers = [BenchTimer(slack) for _ in range(count)]
+    sequence = 0
+    results = {}
+
+    def arm(timer: BenchTimer, when: int):
+        nonlocal sequence
+        if timer.event_ is not None:
+            event, timer.event_ = timer.event_, None
+            queue.discard(event)
+        timer.event_ = _Event(when, sequence, timer)
+        sequence += 1
+        queue.push(timer.event_)
+
+    start = time.perf_counter()
+    for timer in timers:
+        arm(timer, rng.randrange(3600 * NanosPerSecond))
+    results['insert'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for timer in timers[:count // 2]:
+        event, timer.event_ = timer.event_, None
+        queue.discard(event)
+    results['cancel'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for timer in timers[count // 2:count // 2 + count // 4]:
+        arm(timer, rng.randrange(3600 * NanosPerSecond))
+    results['reschedule'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fired = 0
+    wakeups = 0
+    next_time = queue.next_wakeup()
+    while next_time is not None:
+        wakeups += 1
+        event = queue.pop_due(next_time)
+        while event is not None:
+            event.timer.event_ = None
+            fired += 1
+            event = queue.pop_due(next_time)
+        next_time = queue.next_wakeup()
+    results['drain'] = time.perf_counter() - start
+    assert fired == count - count // 2, fired
+    results['wakeups'] = wakeups
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Scheduler backends.')
+    parser.add_argument('--timers', type=int, nargs='+', default=[10000, 100000], help='Timer populations to try.')
+    parser.add_argument('--tick', type=float, default=1, help='Timing wheel tick, in seconds.')
+    parser.add_argument('--slots', type=int, default=4096, help='Timing wheel slots.')
+    parser.add_argument('--slack', type=float, default=0, help='Timer slack, in seconds.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the deadlines.')
+    args = parser.parse_args()
+
+    backends = [
+        ('heap', _HeapQueue),
+        ('wheel', lambda: _TimingWheel(int(args.tick * NanosPerSecond), args.slots, 0)),
+    ]
+    print("{:<8} {:<7} {:>10} {:>10} {:>12} {:>10} {:>9}".format(
+        'timers', 'backend', 'insert us', 'cancel us', 'resched us', 'drain us', 'wakeups'))
+    for count in args.timers:
+        for name, make_queue in backends:
+            results = bench_backend(make_queue, count, args.seed, int(args.slack * NanosPerSecond))
+            print("{:<8} {:<7} {:>10.2f} {:>10.2f} {:>12.2f} {:>10.2f} {:>9}".format(
+                count, name,
+                results['insert'] / count * 1e6,
+                results['cancel'] / (count // 2) * 1e6,
+                results['reschedule'] / (count // 4) * 1e6,
+                results['drain'] / (count - count // 2) * 1e6,
+                results['wakeups']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,26 @@
 # This Source Code Form is subject to the terms of the GNU General Public
 # License, version 3. If a copy of the GPL was not distributed with this file,
 # You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+from datetime import timedelta
+
 from eyrie.abode import build_abode, bind_abode_to_filesystem, bind_abode_to_state
 from eyrie.actuators import build_actuators, bind_actuators_to_filesystem
 from eyrie.alarms import bind_alarms_to_state, bind_alarms_to_filesystem
 from eyrie.automatic import bind_abode_to_real_world_obeying_state
 from eyrie.database import bind_abode_to_database
+from eyrie.network import bind_network_to_filesystem
 from eyrie.presence import bind_abode_to_presence
 from eyrie.presets import bind_preset_states_to_real_world
+from eyrie.scheduler import bind_cronish_to_filesystem, bind_scheduler_to_filesystem
 from eyrie.sensors import build_sensors
 from eyrie.state import EyrieStateMachine, bind_state_to_filesystem
 
 from mcp.animation import AnimationController
+from mcp.clock import Clock, VirtualClock
 from mcp.cronish import Cronish
 from mcp.environment import Environment
 from mcp.filesystem import FileSystem
+from mcp.journal import JournalWriter
 from mcp.network import Bus as NetworkBus
 from mcp.scheduler import Scheduler
 
@@ -22,19 +28,23 @@ import llfuse
 
 
 class Eyrie:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, journal_path: str=None, shard_nerves: bool=False, clock: Clock=None):
         # Platform services.
-        self.animator = AnimationController(2, llfuse.lock)
-        self.cronish = Cronish(db_path, llfuse.lock)
+        self.clock = clock
+        self.simulating_ = False
+        self.animator = AnimationController(2, llfuse.lock, clock=clock)
+        self.cronish = Cronish(db_path, llfuse.lock, clock=clock)
         self.environment = Environment()
         self.filesystem = FileSystem('/things')
-        self.network = NetworkBus(llfuse.lock)
-        self.scheduler = Scheduler(llfuse.lock)
+        self.network = NetworkBus(llfuse.lock, JournalWriter(journal_path) if journal_path else None)
+        # A simulation runs every callback on the calling thread, in order.
+        workers = 0 if isinstance(clock, VirtualClock) else Scheduler.Workers
+        self.scheduler = Scheduler(llfuse.lock, clock=clock, workers=workers)
 
         # The model.
         self.abode = build_abode()
         self.sensors, sensor_threads = build_sensors(self.abode, self.environment, self.network, self.cronish,
-                                                     self.scheduler)
+                                                     self.scheduler, shard_nerves)
         self.state = EyrieStateMachine('manual:unset')
 
         # The view.
@@ -42,10 +52,13 @@ class Eyrie:
 
         # Data-binding for monitoring and direct control.
         bind_abode_to_database(self.abode, db_path)
-        bind_abode_to_presence(self.abode, self.cronish)
+        bind_abode_to_presence(self.abode, self.cronish, clock)
         bind_abode_to_filesystem(self.abode, self.filesystem)
         bind_actuators_to_filesystem(self.actuators, self.filesystem)
         bind_alarms_to_filesystem(self.cronish, self.filesystem)
+        bind_network_to_filesystem(self.network, self.filesystem)
+        bind_scheduler_to_filesystem(self.scheduler, self.filesystem)
+        bind_cronish_to_filesystem(self.cronish, self.filesystem)
         bind_state_to_filesystem(self.state, self.filesystem)
         # Data-binding for direct control.
         bind_abode_to_state(self.abode, self.state)
@@ -61,6 +74,18 @@ class Eyrie:
             self.scheduler
         ] + sensor_threads
 
+    def simulate(self, duration: timedelta):
+        """
+        Fast-forward the virtual clock this Eyrie was built with by |duration|,
+        running the scheduler, cron tasks and animations in this thread.
+        """
+        assert isinstance(self.clock, VirtualClock)
+        if not self.simulating_:
+            for service in (self.scheduler, self.cronish, self.animator):
+                self.clock.attach(service)
+            self.simulating_ = True
+        self.clock.advance(duration)
+
     def run(self):
         for thread in self.threads:
             thread.start()
@@ -3,6 +3,8 @@
 # You can obtain one at https://www.gnu.org/licenses/gpl.txt.
 import logging
 
+from datetime import timedelta
+
 from eyrie.state import EyrieStateMachine
 
 from mcp.abode import Abode, Area, AbodeEvent
@@ -10,6 +12,10 @@ from mcp.filesystem import FileSystem, File, Directory
 from mcp.dimension import Coord, Size
 
 log = logging.getLogger('eyrie-abode')
+
+# The windows summarized in each history file.
+HistoryWindows = (('1m', timedelta(minutes=1)), ('15m', timedelta(minutes=15)), ('1h', timedelta(hours=1)),
+                  ('24h', timedelta(hours=24)))
 house = \
     """
     Horizontal: 4/ft
@@ -112,7 +118,8 @@ def build_abode() -> Abode:
 
 def bind_abode_to_filesystem(abode: Abode, filesystem: FileSystem):
     """
-    Create a directory hierarchy that mirrors the abode layout.
+    Create a directory hierarchy that mirrors the abode layout. Properties whose history
+    is kept are summarized over recent windows in a history directory in their area.
 
     Note: it is generally most useful to do this after sensors and other inputs have
           bound themselves to the abode with properties.
@@ -140,6 +147,22 @@ def bind_abode_to_filesystem(abode: Abode, filesystem: FileSystem):
                 node = File(read_attr, None)
             area_dir.add_file(property_name, node)
 
+        if area.history_names():
+            history_dir = area_dir.add_subdir('history', Directory())
+            for property_name in area.history_names():
+                def read_history(bound_prop=property_name) -> str:
+                    history = area.history(bound_prop)
+                    lines = ['{:>6} {:>8} {:>10} {:>10} {:>10}\n'.format('window', 'samples', 'min', 'mean', 'max')]
+                    for label, window in HistoryWindows:
+                        stats = history.stats(window)
+                        if not stats.count:
+                            lines.append('{:>6} {:>8} {:>10} {:>10} {:>10}\n'.format(label, 0, '-', '-', '-'))
+                            continue
+                        lines.append('{:>6} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}\n'.format(
+                            label, stats.count, stats.min, stats.mean, stats.max))
+                    return ''.join(lines)
+                history_dir.add_file(property_name, File(read_history, None))
+
     abode_dir = filesystem.root().add_subdir(abode.name, Directory())
     add_subareas(abode, abode_dir)
 
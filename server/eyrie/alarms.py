@@ -40,9 +40,10 @@ def bind_alarms_to_state(cronish: Cronish, state: EyrieStateMachine):
     def sleep():
         state.change_state('auto:bedtime')
 
+    # An alarm that was missed because we were down must not go off hours late, when we come back up.
     for day in ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']:
-        cronish.register_task('alarm_wakeup_{}'.format(day), wakeup)
-        cronish.register_task('alarm_sleep_{}'.format(day), sleep)
+        cronish.register_task('alarm_wakeup_{}'.format(day), wakeup, catch_up='skip')
+        cronish.register_task('alarm_sleep_{}'.format(day), sleep, catch_up='skip')
 
 
 def bind_alarms_to_filesystem(cronish: Cronish, filesystem: FileSystem):
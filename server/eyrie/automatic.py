@@ -71,7 +71,11 @@ def _handle_daytime(abode: Abode, actuators: DeviceSet, state: EyrieStateMachine
     # TODO: Allow us to set an ambient color for the house.
     # TODO: Animate fade out on presence = False.
     # TODO: Tie in the kinect when we have people present.
+    rooms = {'bedroom', 'livingroom', 'office', 'kitchen', 'utility', 'hall'}
+
     def on_presence(event: AbodeEvent):
+        if event.target.name not in rooms:
+            return
         if state.current != 'auto:daytime':
             log.debug("skipping motion update -- state is {}, not auto:daytime".format(state.current))
             return
@@ -79,9 +83,7 @@ def _handle_daytime(abode: Abode, actuators: DeviceSet, state: EyrieStateMachine
         log.debug("motion updating lighting state in {} to {}".format(event.target.name, new_lighting))
         actuators.select('$hue').select('@' + event.target.name).set(on=True, color=new_lighting)
 
-    rooms = ['bedroom', 'livingroom', 'office', 'kitchen', 'utility', 'hall']
-    for room_name in rooms:
-        abode.lookup('/eyrie/{}'.format(room_name)).listen("humans_present", "propertyChanged", on_presence)
+    abode.listen_subtree("humans_present", "propertyChanged", on_presence)
 
 
 def _handle_sleep(abode: Abode, actuators: DeviceSet, state: EyrieStateMachine):
@@ -96,16 +98,18 @@ def _handle_sleep(abode: Abode, actuators: DeviceSet, state: EyrieStateMachine):
     state.listen_enter_state('auto:sleep', on_enter_sleep)
 
     # TODO: Give us a night light in rooms other than the bedroom.
+    rooms = {'livingroom', 'office', 'kitchen', 'utility', 'hall'}
+
     def on_presence(event: AbodeEvent):
+        if event.target.name not in rooms:
+            return
         if state.current != 'auto:sleep':
             return
         assert event.target.name != 'bedroom'
         new_lighting = moonlight(int(event.property_value))
         actuators.select('$hue').select('@' + event.target.name).set(on=True, color=new_lighting)
 
-    rooms = ['livingroom', 'office', 'kitchen', 'utility', 'hall']
-    for room_name in rooms:
-        abode.lookup('/eyrie/{}'.format(room_name)).listen("humans_present", "propertyChanged", on_presence)
+    abode.listen_subtree("humans_present", "propertyChanged", on_presence)
 
 
 def bind_abode_to_real_world_obeying_state(abode: Abode, actuators: DeviceSet, animation: AnimationController,
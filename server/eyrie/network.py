@@ -0,0 +1,29 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+from mcp.filesystem import FileSystem, File, Directory
+from mcp.network import Bus
+
+
+def _format_stats(stats: {str: object}) -> str:
+    def format_value(value):
+        if value is None:
+            return 'never'
+        if isinstance(value, float):
+            return '{:.3f}'.format(value)
+        return str(value)
+    return ''.join('{}: {}\n'.format(key, format_value(stats[key])) for key in sorted(stats))
+
+
+def bind_network_to_filesystem(bus: Bus, filesystem: FileSystem):
+    """
+    Expose the health of each device on the bus as /things/network/<device>.
+
+    Note: this must be done after all devices have been added to the bus.
+    """
+    network_dir = filesystem.root().add_subdir('network', Directory())
+
+    for name in bus.device_stats():
+        def read_stats(bound_name=name) -> str:
+            return _format_stats(bus.device_stats()[bound_name])
+        network_dir.add_file(name, File(read_stats, None))
@@ -4,9 +4,10 @@
 import logging
 
 from collections import namedtuple
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-from mcp.abode import Abode, AbodeEvent, Area
+from mcp.abode import Abode, AbodeBatchEvent, Area
+from mcp.clock import Clock, system_clock
 from mcp.cronish import Cronish
 
 log = logging.getLogger('presence')
@@ -15,7 +16,10 @@ log = logging.getLogger('presence')
 WatchedProperty = namedtuple('WatchedProperty', ('area', 'sensor', 'lifetime'))
 
 
-def _bind_area_to_presence(cronish: Cronish, area: Area, properties: [WatchedProperty]):
+def _bind_area_to_presence(cronish: Cronish, area: Area, properties: [WatchedProperty], clock: Clock) -> callable:
+    """
+    Return the function that re-evaluates presence in |area| when any of |properties| is touched.
+    """
     cron_task_name = "{}_presence_update_timeout".format(area.name)
 
     def _timeout_presence():
@@ -29,28 +33,30 @@ def _bind_area_to_presence(cronish: Cronish, area: Area, properties: [WatchedPro
         area.set('humans_present', False)
         cronish.unschedule_task(cron_task_name)
 
-    def _check_presence_conditions(_: AbodeEvent):
+    def _check_presence_conditions():
         timeouts = [watched_.lifetime for watched_ in properties if watched_.area.get(watched_.sensor)]
         if timeouts:
-            area.set('last_detected_humans', datetime.now())
+            area.set('last_detected_humans', clock.now())
             area.set('humans_present', True)
             # Note: this will /shrink/ the interval to lights-off if we trigger one of the short interval detectors
             #       after the long-interval detector has subsided. I think this is the correct behavior: for example,
             #       when leaving a room the lights will shut off sooner.
             cronish.schedule_at_offset(cron_task_name, timedelta(seconds=max(timeouts) * 60))
 
-    cronish.register_task(cron_task_name, _timeout_presence)
+    # Nobody will notice the lights going off a couple of seconds late, so let the timeout share a wakeup.
+    # A missed timeout must still happen, however late, or the room would stay occupied.
+    cronish.register_task(cron_task_name, _timeout_presence, catch_up='once', slack=timedelta(seconds=2))
     cronish.unschedule_task(cron_task_name)  # Remove any previous saved value.
-    for watched in properties:
-        watched.area.listen(watched.sensor, 'propertyTouched', _check_presence_conditions)
 
     # Set initial state.
     area.set('last_detected_humans', 'never')
     area.set('humans_present', False)
-    _check_presence_conditions(None)
+    _check_presence_conditions()
+    return _check_presence_conditions
 
 
-def bind_abode_to_presence(abode: Abode, cronish: Cronish):
+def bind_abode_to_presence(abode: Abode, cronish: Cronish, clock: Clock=None):
+    clock = clock or system_clock
     office = abode.lookup('/eyrie/office')
     bedroom = abode.lookup('/eyrie/bedroom')
     kitchen = abode.lookup('/eyrie/kitchen')
@@ -87,6 +93,20 @@ def bind_abode_to_presence(abode: Abode, cronish: Cronish):
             WatchedProperty(livingroom, 'wemomotion_north', 1),
         ]
     }
+    checks = {}  #: {(Area, str): [callable]} The checks to run when a sensor is touched.
     for area, properties in presence_sensors.items():
-        _bind_area_to_presence(cronish, area, properties)
+        check = _bind_area_to_presence(cronish, area, properties, clock)
+        for watched in properties:
+            checks.setdefault((watched.area, watched.sensor), []).append(check)
+
+    # A single listener for every motion sensor in the house, which runs each affected
+    # room's check once however many of its sensors were touched together.
+    def on_motion(batch: AbodeBatchEvent):
+        due = {}
+        for event in batch.events:
+            for check in checks.get((event.target, event.property_name), ()):
+                due[check] = None
+        for check in due:
+            check()
+    abode.listen_subtree('wemomotion_*', 'propertyTouched', on_motion, batched=True)
 
@@ -0,0 +1,54 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+from mcp.cronish import Cronish
+from mcp.filesystem import FileSystem, File, Directory
+from mcp.scheduler import Scheduler
+
+
+def bind_scheduler_to_filesystem(scheduler: Scheduler, filesystem: FileSystem):
+    """
+    Expose the scheduler's counters as /things/scheduler/stats and the time taken
+    by each kind of callback, slowest first, as /things/scheduler/callbacks.
+    """
+    scheduler_dir = filesystem.root().add_subdir('scheduler', Directory())
+
+    def read_stats() -> str:
+        stats = {
+            'pending': scheduler.pending_count,
+            'fired': scheduler.fired_count,
+            'cancelled': scheduler.cancelled_count,
+            'late': scheduler.late_count,
+            'wakeups_saved': scheduler.wakeups_saved,
+        }
+        return ''.join('{}: {}\n'.format(key, stats[key]) for key in sorted(stats))
+    scheduler_dir.add_file('stats', File(read_stats, None))
+
+    def read_callbacks() -> str:
+        stats = scheduler.callback_stats()
+        lines = ['{:>8} {:>10} {:>10} {:>10}  {}\n'.format('calls', 'mean ms', 'max ms', 'total s', 'callback')]
+        for name in sorted(stats, key=lambda name: stats[name].max_time, reverse=True):
+            entry = stats[name]
+            lines.append('{:>8} {:>10.1f} {:>10.1f} {:>10.3f}  {}\n'.format(
+                entry.calls, entry.mean_time * 1000, entry.max_time * 1000, entry.total_time, name))
+        return ''.join(lines)
+    scheduler_dir.add_file('callbacks', File(read_callbacks, None))
+
+
+def bind_cronish_to_filesystem(cronish: Cronish, filesystem: FileSystem):
+    """
+    Expose how late each cron task has been running, latest first, as /things/cronish/lateness,
+    and how many wakeups slack has saved as /things/cronish/wakeups_saved.
+    """
+    cronish_dir = filesystem.root().add_subdir('cronish', Directory())
+    cronish_dir.add_file('wakeups_saved', File(lambda: '{}\n'.format(cronish.wakeups_saved), None))
+
+    def read_lateness() -> str:
+        stats = cronish.task_stats()
+        lines = ['{:>8} {:>8} {:>10} {:>10} {:>10}  {}\n'.format('runs', 'skipped', 'last s', 'mean s', 'max s', 'task')]
+        for name in sorted(stats, key=lambda name: stats[name].max_lateness, reverse=True):
+            entry = stats[name]
+            lines.append('{:>8} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}  {}\n'.format(
+                entry.runs, entry.skipped, entry.last_lateness, entry.mean_lateness, entry.max_lateness, name))
+        return ''.join(lines)
+    cronish_dir.add_file('lateness', File(read_lateness, None))
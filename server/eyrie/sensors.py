@@ -15,9 +15,13 @@ from mcp.sensors.listener import Listener, ListenerEvent
 from mcp.sensors.nerve import Nerve
 from mcp.sensors.wemo import  WeMoManager, WeMoSensor
 from mcp.scheduler import Scheduler
+from mcp.shard import SensorShard
 
 log = logging.getLogger("sensors")
 
+# Samples of history to keep for each nerve reading: a day's worth, at one every five seconds.
+NerveHistory = 24 * 60 * 60 // 5
+
 
 def _make_property_forwarder(room: Area, property_name: str):
     def handler(event: SensorEvent):
@@ -26,10 +30,15 @@ def _make_property_forwarder(room: Area, property_name: str):
     return handler
 
 
-def build_sensors(abode: Abode, environment: Environment, network: NetworkBus, cronish: Cronish, scheduler: Scheduler) -> DeviceSet:
+def build_sensors(abode: Abode, environment: Environment, network: NetworkBus, cronish: Cronish, scheduler: Scheduler,
+                  shard_nerves: bool=False) -> DeviceSet:
+    """
+    If |shard_nerves| is set, each room's nerves are listened to from a worker process.
+    """
     sensors = DeviceSet()
 
     # Nerves.
+    nerve_shards = {}  # {str: SensorShard}
     for unique in ('bedroom-north', 'office-north', 'livingroom-south'):
         name = 'nerve-{}'.format(unique)
         log.info("Building nerve: {}".format(name))
@@ -41,14 +50,24 @@ def build_sensors(abode: Abode, environment: Environment, network: NetworkBus, c
         room.set('temperature', 'unset')
         room.set('humidity', 'unset')
         room.set('nerve_motion', 'unset')
+        for property_name in ('temperature', 'humidity'):
+            room.track_history(property_name, NerveHistory)
 
         # Forward updates to the sensor to the abode properties we just attached.
         nerve.listen_temperature(_make_property_forwarder(room, 'temperature'))
         nerve.listen_humidity(_make_property_forwarder(room, 'humidity'))
         nerve.listen_motion(_make_property_forwarder(room, 'nerve_motion'))
+        nerve.listen_batch(abode.transaction)
 
         # Put on the network.
-        network.add_sensor(nerve.remote)
+        if shard_nerves:
+            nerve_shards.setdefault(nerve.room_name, SensorShard(nerve.room_name)).add_sensor(nerve.remote)
+        else:
+            network.add_sensor(nerve.remote)
+
+    # Fork the shards before anything else starts threads.
+    for shard in nerve_shards.values():
+        network.add_shard(shard)
 
     # WeMo motion.
     wemo_manager = WeMoManager(network.internal_address, scheduler, network, llfuse.lock)
@@ -67,6 +86,7 @@ def build_sensors(abode: Abode, environment: Environment, network: NetworkBus, c
 
             motion_property_name = 'wemomotion_{}'.format(sensor_name)
             room.set(motion_property_name, False)  # FIXME: see if we can make this reflect the initial state somehow.
+            room.track_history(motion_property_name)
             wemo_motion.listen_motion(_make_property_forwarder(room, motion_property_name))
 
             defunct_property_name = 'wemomotion_{}_defunct'.format(sensor_name)
@@ -123,7 +143,7 @@ def build_sensors(abode: Abode, environment: Environment, network: NetworkBus, c
         abode.set('sunrise', environment.sunrise)
         abode.set('sunset', environment.sunset)
         abode.set('sunset_twilight', environment.sunset_twilight)
-    cronish.register_task('update_environment_on_abode', update_environment_on_abode)
+    cronish.register_task('update_environment_on_abode', update_environment_on_abode, catch_up='once')
     cronish.update_task_time('update_environment_on_abode',
                              days_of_week={0, 1, 2, 3, 4, 5, 6}, hours={0}, minutes=set())
 
@@ -15,12 +15,18 @@ parser.add_argument('--db-path', default=os.path.expanduser("~/.local/var/db/mcp
                     help='Where to store our data.')
 parser.add_argument('--log-level', '-l', default='INFO',
                     help="Set the log level (default: INFO).")
+parser.add_argument('--record', metavar='JOURNAL', default=None,
+                    help="Record all bus traffic to the given journal file, for use with replay_main.py.")
+parser.add_argument('--shard-nerves', action='store_true', default=False,
+                    help="Listen to each room's nerves from a separate worker process.")
 args = parser.parse_args()
+if args.record and os.path.exists(args.record):
+    parser.error("journal already exists, refusing to overwrite it: {}".format(args.record))
 
 mcp.enable_logging(level=args.log_level)
 log = logging.getLogger('eyrie')
 
-eyrie = Eyrie(args.db_path)
+eyrie = Eyrie(args.db_path, args.record, args.shard_nerves)
 eyrie.run()
 eyrie.cleanup()
 
@@ -3,7 +3,13 @@
 # You can obtain one at https://www.gnu.org/licenses/gpl.txt.
 import logging
 
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+
+from mcp.clock import Clock
 from mcp.dimension import Coord, Size
+from mcp.history import History
+from mcp.spatial import SpatialIndex
 
 log = logging.getLogger('abode')
 
@@ -38,6 +44,10 @@ class Area:
         # Sub-divisions of this space.
         self.subareas_ = {}  #: {Area.name: Area}
 
+        # Areas never move in the tree, so these can be worked out once.
+        self.root_ = parent.root_ if parent is not None else self
+        self.path_ = (parent.path_ if parent is not None else '') + '/' + name
+
         # The set of properties attached to this region and the set of callbacks
         # directed at events on those properties.
         self.properties_ = {
@@ -49,6 +59,10 @@ class Area:
             'position-z': _Property(self.position.z, False),
         }  #: {str: _Property}
         self.listeners_ = {}  #: {str: {str: [callable]}} property -> event -> calls
+        self.batch_listeners_ = {}  #: {str: {str: [callable]}} property -> event -> calls
+
+        # The recent values of properties whose history we keep.
+        self.histories_ = {}  #: {str: History}
 
     def subarea_names(self) -> [str]:
         """
@@ -64,56 +78,123 @@ class Area:
 
     def path(self):
         """
-        Construct and return the path that when passed to Abode.lookup will return
-        this Area.
+        Return the path that when passed to Abode.lookup will return this Area.
+        """
+        return self.path_
+
+    def root(self):
+        """
+        Return the Abode that contains this area.
         """
-        components = [self.name]
-        parent = self.parent
-        while parent is not None:
-            components.append(parent.name)
-            parent = parent.parent
-        components = reversed(components)
-        return '/' + '/'.join(components)
+        return self.root_
 
     def create_subarea(self, name: str, position: Coord, size: Size):
         """
         Instantiate and return a new Area that is a sub-area of the current area.
+        An existing sub-area with the same name is replaced, along with everything in it.
         """
         area = Area(self, name, position, size)
+        replaced = self.subareas_.get(area.name)
         self.subareas_[area.name] = area
+        self.root_.index_area_(area, replaced)
         return area
 
+    def track_history(self, prop_name: str, capacity: int=History.DefaultCapacity, clock: Clock=None) -> History:
+        """
+        Start keeping the last |capacity| numeric values set on the given property.
+        Tracking a property again replaces its history.
+        """
+        self.histories_[prop_name] = History(capacity, clock)
+        return self.histories_[prop_name]
+
+    def history_names(self) -> [str]:
+        """
+        Return the names of all properties on this area whose history is kept.
+        """
+        return list(self.histories_.keys())
+
+    def history(self, prop_name: str) -> History:
+        """
+        Return the history of a property, as set up by track_history.
+        """
+        return self.histories_[prop_name]
+
     def subarea(self, name: str):
         """
         Return the named subarea.
         """
         return self.subareas_[name]
 
-    def listen(self, prop_name: str, event_name: str, callback: callable):
+    def listen(self, prop_name: str, event_name: str, callback: callable, batched: bool=False):
         """
         Attach an event listener to call the given callback when the given
         event name occurs on the given property name.
+
+        If |batched| is set, the callback is passed an AbodeBatchEvent instead. All
+        the events for a batched callback in an Abode.transaction arrive together,
+        in one call, once the transaction commits.
+        """
+        listeners = self.batch_listeners_ if batched else self.listeners_
+        if prop_name not in listeners:
+            listeners[prop_name] = {}
+        if event_name not in listeners[prop_name]:
+            listeners[prop_name][event_name] = []
+        listeners[prop_name][event_name].append(callback)
+
+    def listen_subtree(self, prop_pattern: str, event_name: str, callback: callable, batched: bool=False):
+        """
+        Like listen, but for events on this area and on every area below it, now or
+        later, and for every property whose name matches the glob |prop_pattern|,
+        e.g. 'wemomotion_*'. Events reach these listeners after the target's own,
+        bubbling up from the target towards the root.
+
+        The dispatch table lives in the Abode, so the area must be in one: this
+        raises TypeError for a tree of plain Areas.
         """
-        if prop_name not in self.listeners_:
-            self.listeners_[prop_name] = {}
-        if event_name not in self.listeners_[prop_name]:
-            self.listeners_[prop_name][event_name] = []
-        self.listeners_[prop_name][event_name].append(callback)
+        self.root_.add_subtree_listener_(self, prop_pattern, event_name, callback, batched)
 
     def set(self, prop_name: str, prop_value: object):
         """
-        Update the value of a property on this area.
+        Update the value of a property on this area. In a transaction, this is put
+        off until the transaction commits.
         """
+        if self.root_.buffer_set_(self, prop_name, prop_value):
+            return
+        changed = False
         if prop_name not in self.properties_:
             log.info("ADD {}[{}]".format(self.name, prop_name))
             self.properties_[prop_name] = _Property(None)
             self.send_event(prop_name, 'propertyAdded', prop_value)
+            changed = True
         if prop_value != self.properties_[prop_name].value:
             log.info("CHANGE {}[{}] = {} -> {}".format(self.name, prop_name, self.properties_[prop_name].value, prop_value))
             self.send_event(prop_name, 'propertyChanged', prop_value)
+            changed = True
         log.debug("TOUCH {}[{}] = {}".format(self.name, prop_name, prop_value))
         self.properties_[prop_name].value = prop_value
+        if prop_name in self.histories_:
+            self.histories_[prop_name].append(prop_value)
         self.send_event(prop_name, 'propertyTouched', prop_value)
+        if changed and self.properties_[prop_name].is_configurable():
+            self.root().notify_observers_(self, prop_name, prop_value)
+
+    def notify_observers_(self, area, prop_name: str, prop_value: object):
+        pass
+
+    def index_area_(self, area, replaced):
+        pass
+
+    def buffer_set_(self, area, prop_name: str, prop_value: object) -> bool:
+        return False
+
+    def add_subtree_listener_(self, area, prop_pattern: str, event_name: str, callback: callable, batched: bool):
+        raise TypeError("listen_subtree needs an Abode at the root of the tree, not {}".format(self.path()))
+
+    def subtree_listeners_for_(self, area, prop_name: str, event_name: str) -> [(callable, bool)]:
+        return ()
+
+    def send_batched_(self, callback: callable, event):
+        callback(AbodeBatchEvent([event]))
 
     def get(self, prop_name: str, default: object=None):
         """
@@ -130,13 +211,21 @@ class Area:
         Send an arbitrary event. An event must be fore a property name, but the property
         does not have to actually exist in the tree.
         """
-        if prop_name not in self.listeners_:
-            return
-        if event_name not in self.listeners_[prop_name]:
+        callbacks = self.listeners_.get(prop_name, {}).get(event_name, ())
+        batch_callbacks = self.batch_listeners_.get(prop_name, {}).get(event_name, ())
+        subtree_callbacks = self.root_.subtree_listeners_for_(self, prop_name, event_name)
+        if not callbacks and not batch_callbacks and not subtree_callbacks:
             return
         event = AbodeEvent(event_name, self, prop_name, prop_value)
-        for callback in self.listeners_[prop_name][event_name]:
+        for callback in callbacks:
             callback(event)
+        for callback in batch_callbacks:
+            self.root_.send_batched_(callback, event)
+        for callback, batched in subtree_callbacks:
+            if batched:
+                self.root_.send_batched_(callback, event)
+            else:
+                callback(event)
 
 
 class AbodeEvent:
@@ -147,6 +236,14 @@ class AbodeEvent:
         self.property_value = prop_value
 
 
+class AbodeBatchEvent:
+    """
+    The events for a batched listener, in the order they happened.
+    """
+    def __init__(self, events: [AbodeEvent]):
+        self.events = events
+
+
 class Abode(Area):
     """
     A scene-graph specialize for houses. This is a graph of nested, inter-connected areas. The mapped
@@ -162,11 +259,13 @@ class Abode(Area):
 
     Queries:
         Every Area has a name, position, and size. Areas can be found via a path using |lookup|,
-        or found by name using |find|.
+        or found by name using |find|. The areas at a point or in a region can be found with the
+        SpatialIndex returned by |spatial_index|.
 
     Properties and Listeners:
         Arbitrary properties can be set on an area and queried later. Users of the Abode can
-        register to receive notifications of property changes via |listen|. Current, changing
+        register to receive notifications of property changes via |listen|, or for a whole part
+        of the tree and a pattern of property names via |listen_subtree|. Current, changing
         a property triggers the following events:
 
         propertyAdded - The property was set for the first time. Not generally terribly useful
@@ -174,11 +273,140 @@ class Abode(Area):
         propertyChanged - Triggered when the value of a property changes.
         propertyTouched - Triggered when the value of a property is set, but its value is the
                           same as the value that was there previously.
+
+    History:
+        The recent values of chosen properties can be kept with |track_history|, and summarized
+        over a window of time with the History that |history| returns.
+
+    Transactions:
+        Inside |transaction|, sets are buffered rather than applied, and only the last value set
+        for each property is kept. When the transaction commits, each buffered set is applied in
+        the order its property was first set, and fires the usual events. Listeners registered
+        with batched=True are then called once each, with every event they were sent.
     """
 
     def __init__(self, name: str):
         super().__init__(None, name, Coord(0, 0), Size(0, 0, 0))
 
+        # Callbacks for property changes anywhere in the tree.
+        self.observers_ = []  #: [callable]
+
+        # Every area in the tree, by path and by name.
+        self.paths_ = {self.path_: self}  #: {str: Area}
+        self.names_ = {self.name: [self]}  #: {str: [Area]}
+        self.spatial_ = SpatialIndex()  # The Abode itself has no extent, so is not in here.
+
+        # The open transaction's buffered sets, and the events for batched listeners while committing.
+        self.transaction_depth_ = 0
+        self.pending_sets_ = {}  #: {(Area, str): object}
+        self.pending_batches_ = None  #: {callable: [AbodeEvent]} or None
+
+        # Listeners on whole subtrees, and the ones that apply to each property and event
+        # by the area they are attached to, worked out as each property and event is first sent.
+        self.subtree_listeners_ = []  #: [(Area, str, str, callable, bool)]
+        self.dispatch_ = {}  #: {(str, str): {Area: [(callable, bool)]}}
+
+    def observe(self, callback: callable):
+        """
+        Call |callback|(area, property_name, property_value) whenever any property
+        anywhere in the abode is added or changes value.
+        """
+        self.observers_.append(callback)
+
+    def notify_observers_(self, area: Area, prop_name: str, prop_value: object):
+        for callback in self.observers_:
+            callback(area, prop_name, prop_value)
+
+    def index_area_(self, area: Area, replaced: Area):
+        if replaced is not None:
+            self.unindex_area_(replaced)
+        self.paths_[area.path_] = area
+        self.names_.setdefault(area.name, []).append(area)
+        self.spatial_.insert(area)
+
+    def unindex_area_(self, area: Area):
+        for subarea in area.subareas_.values():
+            self.unindex_area_(subarea)
+        del self.paths_[area.path_]
+        self.spatial_.remove(area)
+        self.names_[area.name].remove(area)
+        if not self.names_[area.name]:
+            del self.names_[area.name]
+
+    @contextmanager
+    def transaction(self):
+        """
+        Buffer every set made in the with block, and apply them when it exits. The
+        values are not visible to get until then. Transactions nest: only the
+        outermost commits. If a block raises, the sets made inside it are dropped,
+        and those made before it, in the enclosing transactions, are kept.
+        """
+        before = dict(self.pending_sets_)
+        self.transaction_depth_ += 1
+        try:
+            yield self
+        except BaseException:
+            self.pending_sets_ = before
+            raise
+        finally:
+            self.transaction_depth_ -= 1
+        if self.transaction_depth_ == 0:
+            self.commit_()
+
+    def commit_(self):
+        pending, self.pending_sets_ = self.pending_sets_, {}
+        outermost = self.pending_batches_ is None
+        if outermost:
+            self.pending_batches_ = {}
+        try:
+            for (area, prop_name), prop_value in pending.items():
+                area.set(prop_name, prop_value)
+        finally:
+            if outermost:
+                batches, self.pending_batches_ = self.pending_batches_, None
+        if outermost:
+            for callback, events in batches.items():
+                callback(AbodeBatchEvent(events))
+
+    def buffer_set_(self, area: Area, prop_name: str, prop_value: object) -> bool:
+        if not self.transaction_depth_:
+            return False
+        self.pending_sets_[(area, prop_name)] = prop_value
+        return True
+
+    def add_subtree_listener_(self, area: Area, prop_pattern: str, event_name: str, callback: callable,
+                              batched: bool):
+        self.subtree_listeners_.append((area, prop_pattern, event_name, callback, batched))
+        self.dispatch_ = {}
+
+    def subtree_listeners_for_(self, area: Area, prop_name: str, event_name: str) -> [(callable, bool)]:
+        by_area = self.dispatch_.get((prop_name, event_name))
+        if by_area is None:
+            by_area = {}
+            for listening_area, prop_pattern, listening_event, callback, batched in self.subtree_listeners_:
+                if listening_event == event_name and fnmatchcase(prop_name, prop_pattern):
+                    by_area.setdefault(listening_area, []).append((callback, batched))
+            self.dispatch_[(prop_name, event_name)] = by_area
+        if not by_area:
+            return ()
+        found = []
+        while area is not None:
+            found.extend(by_area.get(area, ()))
+            area = area.parent
+        return found
+
+    def send_batched_(self, callback: callable, event: AbodeEvent):
+        if self.pending_batches_ is None:
+            callback(AbodeBatchEvent([event]))
+        else:
+            self.pending_batches_.setdefault(callback, []).append(event)
+
+    def spatial_index(self) -> SpatialIndex:
+        """
+        Return the index of every area's box, in the Abode's coordinates.
+        """
+        return self.spatial_
+
     room = Area.subarea
     create_room = Area.create_subarea
 
@@ -190,14 +418,18 @@ class Abode(Area):
         """
         assert path.startswith('/')
         assert len(path) > 1
-        parts = path[1:].split('/')
-        assert len(parts) > 0
-        if parts[0] != self.name:
-            raise KeyError("No Abode: " + parts[0])
-        area = self
-        parts = parts[1:]
-        while parts:
-            area = area.subarea(parts[0])
-            parts = parts[1:]
+        area = self.paths_.get(path)
+        if area is None:
+            raise KeyError("No area at: " + path)
         return area
 
+    def find(self, name: str):
+        """
+        Find the area called |name|, wherever it is in the tree. Raises KeyError if
+        there is no such area, or if there is more than one.
+        """
+        areas = self.names_.get(name, [])
+        if len(areas) != 1:
+            raise KeyError("{} areas named {}".format('No' if not areas else 'Several', name))
+        return areas[0]
+
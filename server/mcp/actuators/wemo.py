@@ -41,11 +41,14 @@ class WeMoActuatorBridge:
 
 
 class WeMoSwitch(Actuator):
+    # The bridge answers in well under a second; if it takes this long, it has restarted.
+    ReplyTimeout = 10
+
     def __init__(self, name: str, bridge: WeMoActuatorBridge):
         super().__init__(name)
         self.bridge = bridge
         self.address = self.bridge.address
-        self.remote = network.Actuator(self)
+        self.remote = network.Actuator(self, coalesce=True, reply_timeout=self.ReplyTimeout)
 
     def set(self, **args):
         for arg, value in args.items():
@@ -1,13 +1,14 @@
 # This Source Code Form is subject to the terms of the GNU General Public
 # License, version 3. If a copy of the GPL was not distributed with this file,
 # You can obtain one at https://www.gnu.org/licenses/gpl.txt.
-from datetime import datetime, timedelta
 from threading import Thread
 
 import logging
 import os
 import select
 
+from mcp.clock import Clock, NanosPerSecond, system_clock
+
 log = logging.getLogger('animation')
 
 
@@ -16,6 +17,9 @@ class Animation:
         super().__init__()
         self.is_over = False
 
+        # The AnimationController replaces this with its own clock.
+        self.clock_ = system_clock
+
     def animate(self):
         raise NotImplementedError("Animations must override animate.")
 
@@ -46,21 +50,22 @@ class LinearAnimation(Animation):
         self.tick_callback_ = tick_callback
         self.finish_callback_ = finish_callback
 
-        self.duration_ = timedelta(seconds=duration)
-        self.start_time_ = datetime.now()
-        self.end_time_ = self.start_time_ + self.duration_
+        # Monotonic nanoseconds, set when the animation is first run.
+        self.duration_ = int(duration * NanosPerSecond)
+        self.start_time_ = None
 
     def animate(self):
-        now = datetime.now()
+        now = self.clock_.monotonic_ns()
+        if self.start_time_ is None:
+            self.start_time_ = now
 
-        if now >= self.end_time_:
+        if now >= self.start_time_ + self.duration_:
             self.tick_callback_(self.end_)
             self.is_over = True
             self.finish_callback_()
             return
 
-        elapsed = now - self.start_time_
-        fraction = elapsed.total_seconds() / self.duration_.total_seconds()
+        fraction = (now - self.start_time_) / self.duration_
         value = self.start_ + (self.extent_ * fraction)
         self.tick_callback_(value)
 
@@ -69,16 +74,20 @@ class AnimationController(Thread):
     """
     A simple interval scheduler.
     """
-    def __init__(self, interval, lock):
+    def __init__(self, interval, lock, clock: Clock=None):
         super().__init__()
         self.daemon = True
 
         self.read_fd_, self.write_fd_ = os.pipe()
         self.interval_ = interval
         self.lock_ = lock
+        self.clock_ = clock or system_clock
         self.want_exit_ = False
         self.state_ = NullAnimation()
 
+        # When a VirtualClock should next apply the animation, or None while idle.
+        self.next_tick_ = None
+
     def exit(self):
         with self.lock_:
             self.want_exit_ = True
@@ -96,6 +105,19 @@ class AnimationController(Thread):
 
                 self._apply_animation()
 
+    def next_wakeup_ns(self) -> int:
+        return self.next_tick_
+
+    def run_due(self):
+        """
+        Apply the current animation. Called by a VirtualClock in place of run.
+        """
+        with self.lock_:
+            self.next_tick_ = self.clock_.monotonic_ns() + int(self.interval_ * NanosPerSecond)
+            self._apply_animation()
+            if isinstance(self.state_, NullAnimation):
+                self.next_tick_ = None
+
     def _apply_animation(self):
         self.state_.animate()
 
@@ -106,7 +128,9 @@ class AnimationController(Thread):
         """
         Must be called with lock held.
         """
+        animation.clock_ = self.clock_
         self.state_ = animation
+        self.next_tick_ = self.clock_.monotonic_ns()
         os.write(self.write_fd_, b"\0")
 
     def cancel_ongoing_animation(self):
@@ -114,5 +138,6 @@ class AnimationController(Thread):
         Must be called with lock held.
         """
         self.state_ = NullAnimation()
+        self.next_tick_ = None
         os.write(self.write_fd_, b"\0")
 
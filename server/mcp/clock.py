@@ -0,0 +1,118 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+"""
+The time source shared by the Scheduler, Cronish and the AnimationController.
+
+Deadlines are integer nanoseconds on a monotonic clock: they are cheap to build
+and compare, and they do not move when NTP steps the wall clock or when DST
+starts or ends. Only code with calendar semantics -- "at 7:30 on weekdays" --
+should look at the wall clock, through Clock.now, and convert with to_wall.
+
+Every user takes a Clock so tests can substitute their own; the default is
+|system_clock|.
+
+A VirtualClock stands still until it is advanced. Rather than starting the
+Scheduler, Cronish and AnimationController threads, attach them to the clock:
+advancing it then runs each one's due work in the caller's thread, in deadline
+order, so a simulated day takes as long as the callbacks do and always plays
+out the same way. Anything attached must provide:
+
+    next_wakeup_ns() -> int or None: the monotonic time it next has work due.
+    run_due(): do whatever work is due now.
+"""
+import time
+
+from datetime import datetime, timedelta
+
+
+NanosPerSecond = 1000000000
+
+
+def to_ns(delta: timedelta) -> int:
+    """
+    Convert a timedelta to integer nanoseconds, without going through a float.
+    """
+    return (delta // timedelta(microseconds=1)) * 1000
+
+
+class Clock:
+    def monotonic_ns(self) -> int:
+        raise NotImplementedError("Clocks must override monotonic_ns.")
+
+    def time_ns(self) -> int:
+        """
+        Nanoseconds since the epoch, by the wall clock.
+        """
+        raise NotImplementedError("Clocks must override time_ns.")
+
+    def monotonic(self) -> float:
+        return self.monotonic_ns() / NanosPerSecond
+
+    def now(self) -> datetime:
+        """
+        The local wall-clock time.
+        """
+        return datetime.fromtimestamp(self.time_ns() / NanosPerSecond)
+
+    def to_wall(self, monotonic_ns: int) -> datetime:
+        """
+        The local wall-clock time at which the monotonic clock will read (or read)
+        |monotonic_ns|, assuming the wall clock does not jump in the meantime.
+        """
+        return datetime.fromtimestamp((self.time_ns() + monotonic_ns - self.monotonic_ns()) / NanosPerSecond)
+
+
+class SystemClock(Clock):
+    def monotonic_ns(self) -> int:
+        return time.monotonic_ns()
+
+    def time_ns(self) -> int:
+        return time.time_ns()
+
+
+system_clock = SystemClock()
+
+
+class VirtualClock(Clock):
+    def __init__(self, start: datetime):
+        """
+        Create a clock that reads |start| on the wall until it is advanced.
+        """
+        self.monotonic_ns_ = 0
+        self.epoch_ns_ = int(start.timestamp()) * NanosPerSecond + start.microsecond * 1000
+        self.participants_ = []
+
+    def monotonic_ns(self) -> int:
+        return self.monotonic_ns_
+
+    def time_ns(self) -> int:
+        return self.epoch_ns_ + self.monotonic_ns_
+
+    def attach(self, participant):
+        """
+        Run |participant|'s due work as the clock advances. Participants due at
+        the same time run in the order they were attached.
+        """
+        self.participants_.append(participant)
+        return participant
+
+    def advance(self, delta: timedelta):
+        self.advance_to(self.monotonic_ns_ + to_ns(delta))
+
+    def advance_to(self, target_ns: int):
+        """
+        Step the clock forward to |target_ns|, stopping at every wakeup on the way.
+        """
+        assert target_ns >= self.monotonic_ns_, "virtual time cannot go backwards"
+        while True:
+            due = None
+            due_ns = target_ns
+            for participant in self.participants_:
+                wakeup_ns = participant.next_wakeup_ns()
+                if wakeup_ns is not None and wakeup_ns <= due_ns and (due is None or wakeup_ns < due_ns):
+                    due, due_ns = participant, wakeup_ns
+            self.monotonic_ns_ = max(self.monotonic_ns_, due_ns)
+            if due is None:
+                return
+            due.run_due()
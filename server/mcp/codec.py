@@ -0,0 +1,166 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+"""
+Wire codecs for traffic on the network Bus.
+
+Every frame on the wire is self-describing, so a receiver can decode whatever a
+sender chose to use without any prior agreement:
+
+    * Untagged frames are plain UTF-8 JSON text, exactly as written by
+      zmq's send_json. JSON text can never begin with a NUL byte.
+    * Tagged frames start with a NUL byte followed by a one byte codec id.
+
+Sensors only ever send, so a sensor may use any codec it likes: the Bus decodes
+anything. Actuators are different, because the Bus has to send them requests
+that they can read. The Bus therefore talks JSON to an actuator until the
+actuator shows that it knows better by replying in a binary codec, and from then
+on it answers in kind; see network.Actuator. Devices that have not been taught
+about codecs keep sending and receiving plain JSON.
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import zmq
+
+TagMarker = 0
+
+
+class CodecError(Exception):
+    pass
+
+
+class JsonCodec:
+    """
+    Plain JSON text: the compatible default.
+    """
+    name = 'json'
+    tag = None
+
+    @staticmethod
+    def encode(message: object) -> bytes:
+        return json.dumps(message).encode('UTF-8')
+
+    @staticmethod
+    def decode(buf: memoryview) -> object:
+        # The json module cannot parse from a buffer, so this one copy is unavoidable.
+        return json.loads(bytes(buf))
+
+
+class MsgpackCodec:
+    """
+    A compact binary encoding of arbitrary JSON-like messages.
+    """
+    name = 'msgpack'
+    tag = 1
+
+    @classmethod
+    def encode(cls, message: object) -> bytes:
+        return bytes((TagMarker, cls.tag)) + msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def decode(buf: memoryview) -> object:
+        return msgpack.unpackb(buf[2:], raw=False)
+
+
+class NerveCodec:
+    """
+    Fixed struct layouts for the two messages a nerve sends all day long. Any
+    other message is carried as JSON behind the same tag so that a device can
+    use this codec for everything it sends.
+    """
+    name = 'nerve'
+    tag = 2
+
+    Other = 0
+    TempHumidity = 1
+    Movement = 2
+
+    TempHumidityLayout = struct.Struct('<dd')
+    MovementLayout = struct.Struct('<?')
+    HeaderSize = 3
+
+    @classmethod
+    def encode(cls, message: object) -> bytes:
+        msg_type = message.get('type') if isinstance(message, dict) else None
+        if msg_type == 'TEMP_HUMIDITY' and set(message) == {'type', 'temp', 'humidity'}:
+            return (bytes((TagMarker, cls.tag, cls.TempHumidity)) +
+                    cls.TempHumidityLayout.pack(float(message['temp']), float(message['humidity'])))
+        if msg_type == 'MOVEMENT' and set(message) == {'type', 'state'}:
+            return bytes((TagMarker, cls.tag, cls.Movement)) + cls.MovementLayout.pack(bool(message['state']))
+        return bytes((TagMarker, cls.tag, cls.Other)) + JsonCodec.encode(message)
+
+    @classmethod
+    def decode(cls, buf: memoryview) -> object:
+        kind = buf[2]
+        if kind == cls.TempHumidity:
+            temp, humidity = cls.TempHumidityLayout.unpack_from(buf, cls.HeaderSize)
+            return {'type': 'TEMP_HUMIDITY', 'temp': temp, 'humidity': humidity}
+        if kind == cls.Movement:
+            state, = cls.MovementLayout.unpack_from(buf, cls.HeaderSize)
+            return {'type': 'MOVEMENT', 'state': state}
+        if kind == cls.Other:
+            return JsonCodec.decode(buf[cls.HeaderSize:])
+        raise CodecError("unknown nerve message kind: {}".format(kind))
+
+
+Codecs = {codec.name: codec for codec in (JsonCodec, MsgpackCodec, NerveCodec)}
+CodecsByTag = {codec.tag: codec for codec in Codecs.values() if codec.tag is not None}
+
+
+def is_available(name: str) -> bool:
+    if name == MsgpackCodec.name:
+        return msgpack is not None
+    return name in Codecs
+
+
+def negotiate(preferences: [str] or str) -> "codec":
+    """
+    Return the first codec in |preferences| that we can use here. JSON is always
+    acceptable as a last resort.
+    """
+    if isinstance(preferences, str):
+        preferences = [preferences]
+    for name in preferences:
+        if name not in Codecs:
+            raise CodecError("unknown codec: {}".format(name))
+        if is_available(name):
+            return Codecs[name]
+    return JsonCodec
+
+
+def codec_of(buf: memoryview or bytes) -> "codec":
+    """
+    Return the codec that wrote a frame.
+    """
+    buf = memoryview(buf)
+    if len(buf) >= 2 and buf[0] == TagMarker:
+        try:
+            return CodecsByTag[buf[1]]
+        except KeyError:
+            raise CodecError("unknown codec tag: {}".format(buf[1]))
+    return JsonCodec
+
+
+def decode(buf: memoryview or bytes) -> object:
+    """
+    Decode a frame written by any codec.
+    """
+    buf = memoryview(buf)
+    codec = codec_of(buf)
+    if not is_available(codec.name):
+        raise CodecError("received a {} frame, but {} is not installed".format(codec.name, codec.name))
+    return codec.decode(buf)
+
+
+def recv(socket: zmq.Socket, flags: int=0) -> object:
+    """
+    Receive and decode one message, decoding in place from the zmq.Frame's buffer.
+    """
+    frame = socket.recv(flags, copy=False)
+    return decode(frame.buffer)
@@ -1,19 +1,58 @@
 # This Source Code Form is subject to the terms of the GNU General Public
 # License, version 3. If a copy of the GPL was not distributed with this file,
 # You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+import heapq
+import itertools
 import json
 import logging
 import os
 import os.path
 import select
 
+from collections import namedtuple
 from datetime import datetime, time, timedelta
-from threading import Thread
+from threading import Thread, Lock
+
+from mcp.clock import Clock, NanosPerSecond, system_clock, to_ns
+from mcp.scheduler import coalesced_wakeup
 
 
 log = logging.getLogger('cronish')
 
 
+# Entries in the next-fire heap order by wall-clock time, then by insertion.
+_Entry = namedtuple('_Entry', ('time', 'sequence', 'task'))
+
+
+class TaskStats:
+    """
+    How late a task's runs have started, in seconds after they were due.
+    """
+    def __init__(self):
+        self.runs = 0
+        self.skipped = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    @property
+    def mean_lateness(self) -> float:
+        return self.total_lateness / self.runs if self.runs else 0.0
+
+    def copy(self):
+        stats = TaskStats()
+        stats.runs, stats.skipped = self.runs, self.skipped
+        stats.last_lateness, stats.max_lateness, stats.total_lateness = (
+            self.last_lateness, self.max_lateness, self.total_lateness)
+        return stats
+
+    def record(self, lateness: float):
+        self.runs += 1
+        self.last_lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.total_lateness += lateness
+
+
 class _Task:
     def _empty_runnable(self):
         pass
@@ -25,27 +64,86 @@ class _Task:
         self.days_of_week = set()
         self.hours = set()
         self.minutes = set()
+        self.seconds = {0}
 
-    def set_callback(self, callback: callable):
+        # A single run at this wall-clock time, if set. Cleared when it runs.
+        self.once = None
+
+        # What to do about runs that were missed, and when the last one was due.
+        self.catch_up = 'skip'
+        self.last_run = None
+        self.stats = TaskStats()
+
+        # How long after it is due the task may run, so that it can share a wakeup with others.
+        self.slack = timedelta(0)
+
+        # This task's entry in the Cronish's next-fire heap, if it is scheduled.
+        self.entry_ = None
+
+    def set_callback(self, callback: callable, catch_up: str='skip', slack: timedelta=timedelta(0)):
         self.callback_ = callback
+        self.catch_up = catch_up
+        self.slack = slack
 
-    def set_time(self, days_of_week: {int}, hours: {int}, minutes: {int}):
+    def set_time(self, days_of_week: {int}, hours: {int}, minutes: {int}, seconds: {int}=frozenset({0})):
         self.days_of_week = days_of_week
         self.hours = hours
         self.minutes = minutes
+        self.seconds = set(seconds)
+        self.once = None
+
+    def set_once(self, when: datetime):
+        """
+        Run once at |when|, to the second, instead of on a recurring schedule.
+        """
+        self.set_time(set(), set(), set())
+        self.once = when.replace(microsecond=0)
 
     def should_run_at(self, t: datetime) -> bool:
         return (t.weekday() in self.days_of_week and
                 t.hour in self.hours and
                 t.minute in self.minutes)
 
+    def next_run_after(self, t: datetime) -> datetime:
+        """
+        The first time after |t| at which this task should run, or None if it is
+        unscheduled. A pending one-shot run is returned even if it is overdue.
+        """
+        if self.once is not None:
+            return self.once
+
+        hours = sorted(hour for hour in self.hours if 0 <= hour < 24)
+        minutes = sorted(minute for minute in self.minutes if 0 <= minute < 60)
+        seconds = sorted(second for second in self.seconds if 0 <= second < 60)
+        if not (self.days_of_week and hours and minutes and seconds):
+            return None
+        start = t.replace(microsecond=0) + timedelta(seconds=1)
+        for day in range(8):
+            date = start.date() + timedelta(days=day)
+            if date.weekday() not in self.days_of_week:
+                continue
+            for hour in hours:
+                if day == 0 and hour < start.hour:
+                    continue
+                for minute in minutes:
+                    if day == 0 and (hour, minute) < (start.hour, start.minute):
+                        continue
+                    for second in seconds:
+                        candidate = datetime.combine(date, time(hour, minute, second))
+                        if candidate >= start:
+                            return candidate
+        return None
+
     def run(self):
         log.info("running task '{}'".format(self.name))
         return self.callback_()
 
     def __str__(self):
-        return "Task(name={0.name},dow={0.days_of_week},hours={0.hours},minutes={0.minutes},set={1})".format(self,
-               self.callback_ != self._empty_runnable)
+        if self.once is not None:
+            return "Task(name={0.name},once={0.once},set={1})".format(self, self.callback_ != self._empty_runnable)
+        seconds = '' if self.seconds == {0} else ',seconds={}'.format(self.seconds)
+        return "Task(name={0.name},dow={0.days_of_week},hours={0.hours},minutes={0.minutes}{1},set={2})".format(
+            self, seconds, self.callback_ != self._empty_runnable)
 
 
 class Cronish(Thread):
@@ -54,13 +152,33 @@ class Cronish(Thread):
     a simpler interface and more features.
 
     - Each task has a name and can only exist once in the system.
-    - Each task will run 0 or 1 times in the 24 hour period between 0000 and 2359 local.
+    - Each task will run 0 or 1 times in the 24 hour period between 0000 and 2359 local, or once only at a given time.
+    - Tasks are scheduled to the second; by default, at the top of the minute.
+    - A task that could not run on time -- because we were stalled or not running -- is caught up according to
+      its policy: 'skip', the default, drops runs that are more than MissedTolerance late, 'once' runs a single
+      time for all of them, and 'all' runs once for each in turn. Only choose 'once' or 'all' for tasks that are
+      still right to run however late they are. When each task last ran is persisted, so this works across
+      restarts. How late each run started is kept in the task's TaskStats.
+    - A task may be given some slack, in which case it runs up to that long after it is due if that lets it share
+      a wakeup, and an acquisition of the lock, with other tasks.
     - A task may be unscheduled, in which case it exists but is not run.
     - A task may be unmapped (to a suitable run function), in which case it will not be run at the set time.
     - There is a task database and scheduled times (but not run functions) are serialzed.
 
     This seems like an absurd list, but makes a certain use case much easier.
 
+    Each scheduled task's next run time is kept in a heap, so the thread sleeps
+    until the earliest one rather than waking every minute to check them all.
+
+    Schedules are persisted as a snapshot, crontab.json, plus a journal of the
+    changes since, crontab.journal, with one JSON [name, schedule] per line.
+    Changes are coalesced per task and appended by the cronish thread once per
+    FlushWindow, so rescheduling a task on every motion event costs the caller
+    nothing but a dict update. Once the journal is long enough, it is folded
+    into a fresh snapshot. Both steps are crash-safe: the snapshot is replaced
+    atomically, replaying a change twice is harmless, and a torn last line is
+    ignored. At startup the snapshot is loaded and the journal replayed over it.
+
     Typical usage looks like:
     1) Create a Cronish instance. This will load any previously created tasks from disk with their scheduled time.
     2) As part of init, register all of your program's tasks. They may already exist, but will not yet have a runnable.
@@ -69,12 +187,29 @@ class Cronish(Thread):
        has removed some tasks in a more recent version. Holding old tasks is only potentially dangerous with name
        re-use, but it is also overhead for serialization, etc.
     4) At runtime or during startup, create, remove, query, or change the schedule of tasks.
-    5) During shutdown, call Cronish.save to serialize the task list.
+    5) During shutdown, call Cronish.exit; the thread writes out any pending changes before it stops.
+
+    Tasks are scheduled by the calendar, so Cronish reads the wall clock from |clock|.
     """
 
-    def __init__(self, database_path: str, lock):
+    # The longest we sleep without looking at the wall clock again.
+    MaxSleep = timedelta(minutes=15)
+
+    # How long schedule changes may wait before they are written to the journal.
+    FlushWindow = timedelta(seconds=1)
+
+    # Fold the journal into the snapshot once it has this many changes.
+    CompactionThreshold = 1000
+
+    CatchUpPolicies = ('skip', 'once', 'all')
+
+    # Runs that start later than this count as missed.
+    MissedTolerance = timedelta(minutes=1)
+
+    def __init__(self, database_path: str, lock, clock: Clock=None):
         super().__init__()
         self.daemon = True
+        self.clock_ = clock or system_clock
 
         # Lock to take when running tasks.
         self.lock_ = lock
@@ -84,13 +219,63 @@ class Cronish(Thread):
 
         # For unblocking us in the middle of a sleep.
         self.read_fd_, self.write_fd_ = os.pipe()
+        self.poked_ = False
 
         # Load any existing tasks for disk.
         self.database_filename = os.path.join(database_path, 'crontab.json')
-        self.tasks_ = self._load_tasks(self.database_filename)
+        self.journal_filename = os.path.join(database_path, 'crontab.journal')
+        self.persisted_ = self._load_schedules(self.database_filename)  # {str: {str: [int]}}
+        self.journal_count_ = self._replay_journal(self.journal_filename, self.persisted_)
+        self.tasks_ = {}
+        for name, schedule in self.persisted_.items():
+            self.tasks_[name] = self._task_from_schedule(name, schedule)
+
+        # Only one thread writes to the database at a time.
+        self.io_lock_ = Lock()
+        if self.journal_count_:
+            self._compact()
+
+        # The next run of every scheduled task, guarded by mutex_. Entries that are
+        # not their task's current entry_ are stale and skipped.
+        self.mutex_ = Lock()
+        self.heap_ = []
+        self.sequence_ = itertools.count()
+        self.wakeups_saved = 0  # Runs that happened early in their slack, alongside others, not on their own.
+
+        # Schedule changes waiting to be journaled, and when they must be, also guarded by mutex_.
+        self.pending_ = {}  #: {str: {str: [int]}}
+        self.flush_due_ns_ = None
+
+        # Pick up from each task's last run, so that runs missed while we were down are caught up.
+        now = self.clock_.now()
+        for task in self.tasks_.values():
+            self._index_task(task, min(task.last_run or now, now))
 
     @staticmethod
-    def _load_tasks(filename: str) -> {str: _Task}:
+    def _schedule_of(task: _Task) -> {str: object}:
+        return {
+            'days_of_week': sorted(task.days_of_week),
+            'hours': sorted(task.hours),
+            'minutes': sorted(task.minutes),
+            'seconds': sorted(task.seconds),
+            'once': task.once.timestamp() if task.once is not None else None,
+            'last_run': task.last_run.timestamp() if task.last_run is not None else None
+        }
+
+    @staticmethod
+    def _task_from_schedule(name: str, schedule: {str: object}) -> _Task:
+        # Schedules written before seconds and one-shot runs existed lack those keys.
+        task = _Task(name)
+        task.set_time(days_of_week=set(schedule['days_of_week']), hours=set(schedule['hours']),
+                      minutes=set(schedule['minutes']), seconds=set(schedule.get('seconds', [0])))
+        if schedule.get('once') is not None:
+            task.set_once(datetime.fromtimestamp(schedule['once']))
+        if schedule.get('last_run') is not None:
+            task.last_run = datetime.fromtimestamp(schedule['last_run'])
+        return task
+
+    @staticmethod
+    def _load_schedules(filename: str) -> {str: {str: [int]}}:
         try:
             with open(filename, 'r') as fp:
                 data = json.load(fp)
@@ -98,44 +283,78 @@ class Cronish(Thread):
             return {}
         except ValueError:
             return {}
+        return data
 
-        tasks = {}
-        for key, value in data.items():
-            tasks[key] = _Task(key)
-            dow = set(value['days_of_week'])
-            hours = set(value['hours'])
-            minutes = set(value['minutes'])
-            tasks[key].set_time(days_of_week=dow, hours=hours, minutes=minutes)
-        return tasks
+    @staticmethod
+    def _replay_journal(filename: str, schedules: {str: {str: [int]}}) -> int:
+        """
+        Apply the changes in the journal at |filename| to |schedules|. Returns how
+        many there were.
+        """
+        count = 0
+        try:
+            with open(filename, 'r') as fp:
+                for line in fp:
+                    try:
+                        name, schedule = json.loads(line)
+                    except ValueError:
+                        # Only the last line can be torn, by a crash mid-append.
+                        log.warning("ignoring damaged line in {}".format(filename))
+                        continue
+                    schedules[name] = schedule
+                    count += 1
+        except FileNotFoundError:
+            pass
+        return count
 
     @staticmethod
-    def _save_tasks(filename: str, tasks: {str: _Task}):
-        obj = {}
-        for name, task in tasks.items():
-            obj[name] = {
-                'days_of_week': list(task.days_of_week),
-                'hours': list(task.hours),
-                'minutes': list(task.minutes)
-            }
-        with open(filename, 'w') as fp:
-            json.dump(obj, fp)
-
-    def register_task(self, name: str, callback: callable):
+    def _save_schedules(filename: str, schedules: {str: {str: [int]}}):
+        # Write a new file and move it into place, so a crash leaves either the old snapshot or the new one.
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as fp:
+            json.dump(schedules, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_filename, filename)
+
+    def register_task(self, name: str, callback: callable, catch_up: str='skip', slack: timedelta=timedelta(0)):
         """
         Map a task name to a callback, creating the task if it doesn't exist.
+        |catch_up| is one of CatchUpPolicies, and says what to do about missed runs.
+        The task may run up to |slack| late if that saves a wakeup.
         """
+        assert catch_up in self.CatchUpPolicies
         if name not in self.tasks_:
             self.tasks_[name] = _Task(name)
-        self.tasks_[name].set_callback(callback)
+        self.tasks_[name].set_callback(callback, catch_up, slack)
         log.info("registered task '{}'".format(name))
 
-    def update_task_time(self, name: str, days_of_week: {int}, hours: {int}, minutes: {int}):
+    def update_task_time(self, name: str, days_of_week: {int}, hours: {int}, minutes: {int},
+                         seconds: {int}=frozenset({0})):
         """
         Set the time(s) a given task should run.
         """
-        self.tasks_[name].set_time(days_of_week, hours, minutes)
+        self.tasks_[name].set_time(days_of_week, hours, minutes, seconds)
+        self._task_changed(name)
+
+    def schedule_once(self, name: str, when: datetime):
+        """
+        Set the given task to run once, at |when| (to the second), and then not again.
+        """
+        self.tasks_[name].set_once(when)
+        self._task_changed(name)
+
+    def _task_changed(self, name: str):
         log.debug("Updated task '{}' to {}".format(name, str(self.tasks_[name])))
-        self._save_tasks(self.database_filename, self.tasks_)
+        self._index_task(self.tasks_[name], self.clock_.now())
+        self._persist_task(name)
+
+    def _persist_task(self, name: str):
+        with self.mutex_:
+            self.pending_[name] = self._schedule_of(self.tasks_[name])
+            if self.flush_due_ns_ is None:
+                self.flush_due_ns_ = self.clock_.monotonic_ns() + to_ns(self.FlushWindow)
+        self._poke()
 
     def unschedule_task(self, name: str):
         """
@@ -145,37 +364,170 @@ class Cronish(Thread):
 
     def schedule_at_offset(self, name: str, offset: timedelta):
         """
-        Set the given task to run at times that match now + timedelta.
+        Set the given task to run once, |offset| from now.
         """
-        when = datetime.now() + offset
-        self.update_task_time(name, {when.weekday()}, {when.hour}, {when.minute})
+        self.schedule_once(name, self.clock_.now() + offset)
 
     def get_task(self, name: str) -> _Task:
         return self.tasks_.get(name, None)
 
+    def task_stats(self) -> {str: TaskStats}:
+        """
+        A snapshot of how late each task has run. Must be called with lock held.
+        """
+        return {name: task.stats.copy() for name, task in self.tasks_.items()}
+
     def exit(self):
         with self.lock_:
             self.want_exit_ = True
             os.write(self.write_fd_, b"\0")
 
+    def flush(self):
+        """
+        Write any pending schedule changes to the journal now.
+        """
+        with self.io_lock_:
+            with self.mutex_:
+                pending, self.pending_ = self.pending_, {}
+                self.flush_due_ns_ = None
+            if not pending:
+                return
+            with open(self.journal_filename, 'a') as fp:
+                for name, schedule in pending.items():
+                    fp.write(json.dumps([name, schedule], separators=(',', ':')) + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.persisted_.update(pending)
+            self.journal_count_ += len(pending)
+            if self.journal_count_ >= self.CompactionThreshold:
+                self._compact()
+
+    def _compact(self):
+        # Replaying the journal over the new snapshot would change nothing, so it
+        # is safe to crash between these two steps.
+        self._save_schedules(self.database_filename, self.persisted_)
+        with open(self.journal_filename, 'w'):
+            pass
+        self.journal_count_ = 0
+
+    def _flush_due(self) -> bool:
+        with self.mutex_:
+            return self.flush_due_ns_ is not None and self.flush_due_ns_ <= self.clock_.monotonic_ns()
+
+    def _poke(self):
+        # Wake the thread to recompute its sleep. One pending byte is enough.
+        with self.mutex_:
+            if self.poked_:
+                return
+            self.poked_ = True
+        os.write(self.write_fd_, b"\0")
+
+    def _index_task(self, task: _Task, after: datetime):
+        with self.mutex_:
+            when = task.next_run_after(after)
+            if when is None:
+                task.entry_ = None
+                return
+            task.entry_ = _Entry(when, next(self.sequence_), task)
+            heapq.heappush(self.heap_, task.entry_)
+
+            # Rescheduling leaves stale entries behind; don't let them pile up.
+            if len(self.heap_) > 2 * len(self.tasks_) + 64:
+                self.heap_ = [entry for entry in self.heap_ if entry.task.entry_ is entry]
+                heapq.heapify(self.heap_)
+
+    def _next_run(self) -> datetime:
+        """
+        When to next run tasks: as late as the slack of every task due by then allows.
+        """
+        with self.mutex_:
+            while self.heap_ and self.heap_[0].task.entry_ is not self.heap_[0]:
+                heapq.heappop(self.heap_)
+            return coalesced_wakeup(self.heap_, lambda entry: entry.task.entry_ is entry,
+                                    lambda entry: entry.time + entry.task.slack)
+
+    def _next_interval(self) -> float:
+        """
+        Seconds until the next task is due. The wall clock may jump in the meantime,
+        so we never sleep longer than MaxSleep.
+        """
+        wakeup_ns = self.next_wakeup_ns()
+        if wakeup_ns is None:
+            return self.MaxSleep.total_seconds()
+        return max(0.0, min((wakeup_ns - self.clock_.monotonic_ns()) / NanosPerSecond, self.MaxSleep.total_seconds()))
+
+    def next_wakeup_ns(self) -> int:
+        when = self._next_run()
+        wakeup_ns = None
+        if when is not None:
+            wakeup_ns = self.clock_.monotonic_ns() + max(0, to_ns(when - self.clock_.now()))
+        with self.mutex_:
+            if self.flush_due_ns_ is not None and (wakeup_ns is None or self.flush_due_ns_ < wakeup_ns):
+                wakeup_ns = self.flush_due_ns_
+        return wakeup_ns
+
+    def _pop_due(self, now: datetime) -> _Entry:
+        with self.mutex_:
+            while self.heap_ and self.heap_[0].time <= now:
+                entry = heapq.heappop(self.heap_)
+                if entry.task.entry_ is entry:
+                    entry.task.entry_ = None
+                    if now < entry.time + entry.task.slack:
+                        self.wakeups_saved += 1
+                    return entry
+            return None
+
+    def _run_entry(self, entry: _Entry):
+        task = entry.task
+        now = self.clock_.now()
+        lateness = now - entry.time
+        missed = lateness - task.slack > self.MissedTolerance
+
+        # Queue the next run before this one, so the task can reschedule itself. Unless we
+        # are to catch up on every missed run, skip any others that have already gone by.
+        task.once = None
+        task.last_run = entry.time if task.catch_up == 'all' or not missed else now
+        self._index_task(task, task.last_run)
+        self._persist_task(task.name)
+
+        if missed:
+            log.warning("task '{}' is {} late".format(task.name, lateness))
+            if task.catch_up == 'skip':
+                task.stats.skipped += 1
+                return
+        task.stats.record(lateness.total_seconds())
+        task.run()
+
+    def run_due(self):
+        """
+        Run every task that is due, then journal any schedule changes that are due.
+        Called from run, or by a VirtualClock.
+        """
+        now = self.clock_.now()
+        entry = self._pop_due(now)
+        if entry is not None:
+            with self.lock_:
+                while entry is not None:
+                    self._run_entry(entry)
+                    entry = self._pop_due(now)
+
+        if self._flush_due():
+            self.flush()
+
     def run(self):
         while True:
-            # Sleep until the top of the next minute (+1 sec so jitter doesn't make us run the same minute twice)
-            t = datetime.now()
-            interval = 60 - t.second - t.microsecond / 1000000.0 + 1
-            readable, _, _ = select.select([self.read_fd_], [], [], interval)
+            readable, _, _ = select.select([self.read_fd_], [], [], self._next_interval())
             if readable:
+                with self.mutex_:
+                    self.poked_ = False
                 os.read(self.read_fd_, 4096)
 
             # Check if we set the exit flag.
             with self.lock_:
                 if self.want_exit_:
-                    return
+                    break
 
             # Get the new time and run any events that belong to this time.
-            t = datetime.now()
-            for task in self.tasks_.values():
-                if task.should_run_at(t):
-                    with self.lock_:
-                        task.run()
+            self.run_due()
 
+        self.flush()
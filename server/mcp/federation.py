@@ -0,0 +1,263 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+"""
+Replicate an Abode between several MCP nodes.
+
+Every node builds the same Abode, but each owns some subtrees of it -- say, one
+node per floor. A node publishes changes to the properties in the areas it owns
+and applies what its peers publish to its own copy of the tree, where they fire
+the usual propertyChanged listeners. Since every area has exactly one owner,
+there are never conflicting writes to resolve.
+
+Changes are sent in batches over zmq PUB/SUB. Within a batching window only the
+latest value of each property is sent, which bounds bandwidth however often a
+property flaps; the window bounds the added latency. Each batch is stamped with
+its origin and a per-origin sequence number, and each node keeps a version
+vector of the last sequence number it has applied from every peer. PUB/SUB may
+drop messages, for instance before a peer has finished connecting, so owners
+also publish a snapshot of everything they own now and again. A node that sees
+a gap in a peer's sequence catches up from that peer's next snapshot. Sequence
+numbers restart when a node does, so messages also carry the epoch at which
+their origin started.
+
+Property values go out as whatever the codec can carry. Datetimes, like the
+last time presence saw someone, are sent tagged as ISO 8601 text and turned
+back into datetimes on arrival. Any other value the codec cannot encode is left
+out, with a warning the first time for each property, so that one odd value
+cannot hold up the rest.
+"""
+import logging
+import time
+
+from datetime import datetime
+
+from threading import Thread, Lock
+
+import zmq
+
+from mcp import codec
+from mcp.abode import Abode, Area
+
+log = logging.getLogger('federation')
+
+DatetimeTag = '$datetime'
+
+
+def _to_wire(value: object) -> object:
+    if isinstance(value, datetime):
+        return {DatetimeTag: value.isoformat()}
+    return value
+
+
+def _from_wire(value: object) -> object:
+    if isinstance(value, dict) and len(value) == 1 and DatetimeTag in value:
+        return datetime.fromisoformat(value[DatetimeTag])
+    return value
+
+
+class FederationNode(Thread):
+    Topic = b'mcp-federation'
+
+    # Seconds to collect changes before publishing them.
+    BatchInterval = 0.05
+
+    # Seconds between snapshots of everything we own.
+    SnapshotInterval = 10
+
+    def __init__(self, abode: Abode, node_id: str, owned_paths: [str], endpoint: str, peer_endpoints: [str],
+                 lock, ctx: zmq.Context=None, codecs: [str]=('msgpack', 'json')):
+        """
+        Replicate the areas at and under |owned_paths| in |abode| to every node that
+        connects to |endpoint|, and apply changes from the nodes at |peer_endpoints|.
+        Remote changes are applied while holding |lock|.
+        """
+        super().__init__()
+        self.ready_to_exit = False
+
+        self.abode = abode
+        self.node_id = node_id
+        self.owned_paths_ = [path.rstrip('/') for path in owned_paths]
+        self.lock_ = lock
+        self.codec = codec.negotiate(codecs)
+
+        self.ctx = ctx or zmq.Context()
+        self.pub_socket = self.ctx.socket(zmq.PUB)
+        self.pub_socket.bind(endpoint)
+        self.sub_socket = self.ctx.socket(zmq.SUB)
+        self.sub_socket.setsockopt(zmq.SUBSCRIBE, self.Topic)
+        for peer in peer_endpoints:
+            self.sub_socket.connect(peer)
+
+        # Local changes waiting to be published, latest wins.
+        self.pending_lock_ = Lock()
+        self.pending_ = {}  #: {(str, str): object} (path, property) -> value
+        self.sequence_ = 0
+
+        # The last sequence number applied from each node, including ourself.
+        self.version_vector_ = {node_id: 0}  #: {str: int}
+        self.epoch_ = time.time_ns()
+        self.peer_epochs_ = {}  #: {str: int}
+        self.stale_peers_ = set()  #: {str} Peers we have missed updates from.
+        self.unencodable_ = set()  #: {(str, str)} Properties we have warned we cannot send.
+        self.applying_remote_ = False
+
+        self.batches_sent = 0
+        self.changes_sent = 0
+        self.changes_applied = 0
+
+        abode.observe(self.on_local_change_)
+
+    def owns(self, area: Area) -> bool:
+        path = area.path()
+        return any(path == owned or path.startswith(owned + '/') for owned in self.owned_paths_)
+
+    def version_vector(self) -> {str: int}:
+        with self.pending_lock_:
+            return dict(self.version_vector_)
+
+    def on_local_change_(self, area: Area, prop_name: str, prop_value: object):
+        if self.applying_remote_ or not self.owns(area):
+            return
+        value = _to_wire(prop_value)
+        if not self.encodable_(area.path(), prop_name, value):
+            return
+        with self.pending_lock_:
+            self.pending_[(area.path(), prop_name)] = value
+
+    def encodable_(self, path: str, prop_name: str, value: object) -> bool:
+        try:
+            self.codec.encode(value)
+        except (TypeError, ValueError, OverflowError):
+            if (path, prop_name) not in self.unencodable_:
+                self.unencodable_.add((path, prop_name))
+                log.warning("cannot send {}[{}] = {!r}; leaving it out".format(path, prop_name, value))
+            return False
+        return True
+
+    def exit(self):
+        self.ready_to_exit = True
+
+    def cleanup(self):
+        self.pub_socket.close()
+        self.sub_socket.close()
+
+    def run(self):
+        last_batch = time.monotonic()
+        last_snapshot = 0
+        while not self.ready_to_exit:
+            if self.sub_socket.poll(int(self.BatchInterval * 1000)):
+                self.receive_()
+
+            now = time.monotonic()
+            if now - last_snapshot >= self.SnapshotInterval:
+                self.publish_snapshot_()
+                last_snapshot = last_batch = now
+            elif now - last_batch >= self.BatchInterval:
+                self.publish_batch_()
+                last_batch = now
+
+        self.cleanup()
+
+    def publish_(self, kind: str, changes: [(str, str, object)]):
+        message = {'kind': kind, 'origin': self.node_id, 'epoch': self.epoch_, 'sequence': self.sequence_,
+                   'changes': changes}
+        try:
+            data = self.codec.encode(message)
+        except TypeError:
+            log.exception("cannot encode federated changes; dropping them")
+            return
+        self.pub_socket.send_multipart([self.Topic, data])
+
+    def publish_batch_(self):
+        with self.pending_lock_:
+            if not self.pending_:
+                return
+            changes = [(path, prop_name, value) for (path, prop_name), value in self.pending_.items()]
+            self.pending_ = {}
+            self.sequence_ += 1
+            self.version_vector_[self.node_id] = self.sequence_
+        self.publish_('batch', changes)
+        self.batches_sent += 1
+        self.changes_sent += len(changes)
+
+    def publish_snapshot_(self):
+        """
+        Publish the current value of every property we own. Anything still pending
+        is included, so it goes out as part of the snapshot.
+        """
+        changes = []
+        with self.lock_:
+            for path in self.owned_paths_:
+                self.collect_(self.abode.lookup(path), changes)
+            with self.pending_lock_:
+                self.pending_ = {}
+                self.sequence_ += 1
+                self.version_vector_[self.node_id] = self.sequence_
+        self.publish_('snapshot', changes)
+
+    def collect_(self, area: Area, changes: [(str, str, object)]):
+        path = area.path()
+        for prop_name in area.property_names():
+            if area.properties_[prop_name].is_configurable():
+                value = _to_wire(area.get(prop_name))
+                if self.encodable_(path, prop_name, value):
+                    changes.append((path, prop_name, value))
+        for name in area.subarea_names():
+            self.collect_(area.subarea(name), changes)
+
+    def receive_(self):
+        while True:
+            try:
+                _, data = self.sub_socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            try:
+                message = codec.decode(data.buffer)
+            except Exception:
+                log.exception("failed to decode federated changes")
+                continue
+            self.apply_(message)
+
+    def apply_(self, message: {str: object}):
+        origin, sequence = message['origin'], message['sequence']
+        if origin == self.node_id:
+            return
+
+        with self.pending_lock_:
+            if self.peer_epochs_.get(origin) != message['epoch']:
+                if origin in self.peer_epochs_:
+                    log.info("node {} restarted".format(origin))
+                self.peer_epochs_[origin] = message['epoch']
+                self.version_vector_[origin] = 0
+            seen = self.version_vector_[origin]
+            if sequence <= seen:
+                return
+            if message['kind'] == 'batch' and sequence != seen + 1:
+                if origin not in self.stale_peers_:
+                    log.warning("missed updates from node {}; waiting for its next snapshot".format(origin))
+                self.stale_peers_.add(origin)
+            if message['kind'] == 'snapshot':
+                self.stale_peers_.discard(origin)
+            self.version_vector_[origin] = sequence
+
+        with self.lock_:
+            self.applying_remote_ = True
+            try:
+                for path, prop_name, wire_value in message['changes']:
+                    value = _from_wire(wire_value)
+                    try:
+                        area = self.abode.lookup(path)
+                    except KeyError:
+                        log.warning("node {} sent a change for unknown area: {}".format(origin, path))
+                        continue
+                    if self.owns(area):
+                        log.warning("node {} sent a change for {}, which we own".format(origin, path))
+                        continue
+                    # Snapshots repeat values we already have; those must not look like touches.
+                    if prop_name in area.property_names() and area.get(prop_name) == value:
+                        continue
+                    area.set(prop_name, value)
+                    self.changes_applied += 1
+            finally:
+                self.applying_remote_ = False
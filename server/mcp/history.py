@@ -0,0 +1,102 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+"""
+Recent values of an Abode property, for trends like "has it been getting warmer
+in the last hour" without going out to a database.
+
+A History is a ring buffer of a fixed number of samples, kept in a pair of
+arrays of doubles: one of wall-clock timestamps and one of values. Memory is
+16 bytes per sample of capacity, allocated up front, and recording a sample
+never allocates. Once full, each new sample overwrites the oldest.
+
+Only numbers are recorded; booleans count as 0 and 1, so the mean of a motion
+sensor is the fraction of its samples that saw motion. Anything else, like the
+'unset' placeholder the sensors start with, is skipped.
+"""
+import logging
+
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from mcp.clock import Clock, NanosPerSecond, system_clock
+
+log = logging.getLogger('history')
+
+
+WindowStats = namedtuple('WindowStats', ('count', 'min', 'max', 'mean'))
+
+
+class History:
+    # Samples kept by default: about five hours of a reading every four seconds.
+    DefaultCapacity = 4096
+
+    def __init__(self, capacity: int=DefaultCapacity, clock: Clock=None):
+        assert capacity > 0
+        self.clock_ = clock or system_clock
+        self.times_ = array('d', bytes(8 * capacity))  # Seconds since the epoch.
+        self.values_ = array('d', bytes(8 * capacity))
+        self.start_ = 0  # The physical index of the oldest sample.
+        self.count_ = 0
+
+    def __len__(self) -> int:
+        return self.count_
+
+    @property
+    def capacity(self) -> int:
+        return len(self.times_)
+
+    def append(self, value: object) -> bool:
+        """
+        Record |value| as of now. Returns False if it is not a number, and so was not recorded.
+        """
+        if not isinstance(value, (int, float)):
+            return False
+        index = (self.start_ + self.count_) % self.capacity
+        self.times_[index] = self.clock_.time_ns() / NanosPerSecond
+        self.values_[index] = value
+        if self.count_ < self.capacity:
+            self.count_ += 1
+        else:
+            self.start_ = (self.start_ + 1) % self.capacity
+        return True
+
+    def first_since_(self, since: float) -> int:
+        # Binary search for the oldest sample at or after |since|, by its age order. This
+        # assumes the wall clock has not been stepped back while the samples were recorded.
+        low, high = 0, self.count_
+        while low < high:
+            middle = (low + high) // 2
+            if self.times_[(self.start_ + middle) % self.capacity] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def indices_(self, window: timedelta) -> range:
+        first = 0
+        if window is not None:
+            first = self.first_since_(self.clock_.time_ns() / NanosPerSecond - window.total_seconds())
+        return range(first, self.count_)
+
+    def samples(self, window: timedelta=None) -> [(datetime, float)]:
+        """
+        Return the samples from the last |window|, or all of them, oldest first.
+        """
+        samples = []
+        for age in self.indices_(window):
+            index = (self.start_ + age) % self.capacity
+            samples.append((datetime.fromtimestamp(self.times_[index]), self.values_[index]))
+        return samples
+
+    def stats(self, window: timedelta=None) -> WindowStats:
+        """
+        Return the count, min, max and mean of the samples from the last |window|,
+        or of all of them. The min, max and mean are None if there are no samples.
+        """
+        indices = self.indices_(window)
+        if not indices:
+            return WindowStats(0, None, None, None)
+        values = [self.values_[(self.start_ + age) % self.capacity] for age in indices]
+        return WindowStats(len(values), min(values), max(values), sum(values) / len(values))
@@ -0,0 +1,216 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+"""
+A compact traffic journal for the network Bus, and a tool to replay one.
+
+The journal is a flat file of length-prefixed records behind an 8 byte magic:
+
+    payload length: u32 | timestamp: i64 (monotonic ns) | kind: u8 | name length: u16 | name | payload
+
+Payloads are stored exactly as they crossed the wire, so any codec's frames can
+be recorded without re-encoding them; see mcp.codec. The writer appends through
+a memory map that grows in chunks. It writes each record's body before its
+header, so a crash mid-append leaves a zeroed header that readers treat as the
+end of the journal.
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+
+from collections import namedtuple
+
+from mcp import codec
+
+log = logging.getLogger('journal')
+
+
+Magic = b'MCPJRNL1'
+RecordHeader = struct.Struct('<IqBH')
+
+SensorMessage = 1
+ActuatorMessage = 2
+
+JournalRecord = namedtuple('JournalRecord', ('timestamp', 'kind', 'name', 'payload'))
+
+
+class JournalWriter:
+    DefaultChunkSize = 1 << 20
+
+    def __init__(self, filename: str, chunk_size: int=DefaultChunkSize):
+        """
+        Start a new journal at |filename|. Raises FileExistsError rather than
+        overwriting an existing file: it may be the only copy of a recording.
+        """
+        self.filename = filename
+        self.chunk_size_ = chunk_size
+
+        self.fd_ = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        self.map_ = None
+        self.size_ = 0
+        self.offset_ = 0
+
+        self.reserve_(len(Magic))
+        self.map_[0:len(Magic)] = Magic
+        self.offset_ = len(Magic)
+
+    def reserve_(self, length: int):
+        if self.offset_ + length <= self.size_:
+            return
+        chunks = (self.offset_ + length + self.chunk_size_ - 1) // self.chunk_size_
+        if self.map_ is not None:
+            self.map_.close()
+        self.size_ = chunks * self.chunk_size_
+        os.ftruncate(self.fd_, self.size_)
+        self.map_ = mmap.mmap(self.fd_, self.size_)
+
+    def append(self, kind: int, name: str, payload: bytes or memoryview, timestamp: int=None):
+        """
+        Append one record. |timestamp| defaults to now on the monotonic clock.
+        """
+        assert len(payload) > 0
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        name_bytes = name.encode('UTF-8')
+        body_offset = self.offset_ + RecordHeader.size
+        end = body_offset + len(name_bytes) + len(payload)
+        self.reserve_(end - self.offset_)
+
+        self.map_[body_offset:body_offset + len(name_bytes)] = name_bytes
+        self.map_[body_offset + len(name_bytes):end] = payload
+        RecordHeader.pack_into(self.map_, self.offset_, len(payload), timestamp, kind, len(name_bytes))
+        self.offset_ = end
+
+    def flush(self):
+        self.map_.flush()
+
+    def close(self):
+        if self.map_ is None:
+            return
+        self.map_.flush()
+        self.map_.close()
+        self.map_ = None
+        os.ftruncate(self.fd_, self.offset_)
+        os.close(self.fd_)
+
+
+class JournalReader:
+    def __init__(self, filename: str):
+        self.filename = filename
+
+    def __iter__(self) -> JournalRecord:
+        with open(self.filename, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < len(Magic):
+                raise ValueError("not a journal: {}".format(self.filename))
+            with mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ) as buf:
+                if buf[0:len(Magic)] != Magic:
+                    raise ValueError("not a journal: {}".format(self.filename))
+                offset = len(Magic)
+                while offset + RecordHeader.size <= size:
+                    length, timestamp, kind, name_length = RecordHeader.unpack_from(buf, offset)
+                    if length == 0:
+                        return
+                    offset += RecordHeader.size
+                    end = offset + name_length + length
+                    if end > size:
+                        log.warning("truncated record at the end of {}".format(self.filename))
+                        return
+                    name = buf[offset:offset + name_length].decode('UTF-8')
+                    payload = buf[offset + name_length:end]
+                    yield JournalRecord(timestamp, kind, name, payload)
+                    offset = end
+
+
+class ReplayStats:
+    def __init__(self):
+        self.messages = 0
+        self.unknown = 0
+        self.heartbeats = 0
+        self.shed = 0
+        self.elapsed = 0.0  # seconds
+        self.max_lag = 0.0  # seconds behind the recorded schedule
+
+    def __str__(self):
+        return "ReplayStats(messages={0.messages},unknown={0.unknown},heartbeats={0.heartbeats}," \
+               "shed={0.shed},elapsed={0.elapsed:.3f}s,max_lag={0.max_lag:.3f}s)".format(self)
+
+
+def deliver_(bus, sensor, messages: [object], stats: ReplayStats):
+    if not messages:
+        return
+    with bus.lock_:
+        try:
+            sensor.on_messages(messages)
+        except Exception:
+            log.exception("failed to handle replayed sensor message")
+    stats.messages += len(messages)
+
+
+def replay(reader: JournalReader, bus, speed: float=1.0) -> ReplayStats:
+    """
+    Feed the sensor messages in a journal to the matching sensors on |bus|, under
+    the bus's lock, as if they had just arrived from the network. The bus does not
+    need to be running.
+
+    |speed| scales the recorded gaps between messages: 1 replays in real time,
+    N replays N times faster, and 0 replays as fast as the model can take it.
+    Recorded actuator messages are skipped: the model under test will make its
+    own, which can be journaled and compared.
+
+    Messages are filtered as the live Bus would: heartbeats are counted and
+    dropped, and each sensor's rate limit is applied on the recorded timeline, so
+    the model sees the same traffic whatever the replay speed. Messages that
+    were deferred by a limit are delivered once the journal runs out.
+    """
+    sensors = {sensor.name: sensor for sensor in bus.all_sensors()}
+    stats = ReplayStats()
+    start = time.monotonic()
+    first_timestamp = None
+    last_time = 0.0
+    for record in reader:
+        if record.kind != SensorMessage:
+            continue
+
+        sensor = sensors.get(record.name)
+        if sensor is None:
+            stats.unknown += 1
+            continue
+
+        if first_timestamp is None:
+            first_timestamp = record.timestamp
+        if speed > 0:
+            due = (record.timestamp - first_timestamp) / 1e9 / speed
+            delay = due - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                stats.max_lag = max(stats.max_lag, -delay)
+
+        try:
+            message = codec.decode(record.payload)
+        except Exception:
+            log.exception("failed to decode journaled message for {}".format(record.name))
+            continue
+
+        if sensor.is_heartbeat(message):
+            stats.heartbeats += 1
+            continue
+
+        recorded_time = record.timestamp / 1e9
+        shed_before = sensor.shed_count
+        messages = sensor.admit_([message], recorded_time)
+        stats.shed += sensor.shed_count - shed_before
+        deliver_(bus, sensor, messages, stats)
+        last_time = recorded_time
+
+    # Flush anything still held back by a rate limit, as the Bus would have done shortly after.
+    for sensor in sensors.values():
+        while sensor.has_deferred:
+            last_time += sensor.deferred_wait_time_(last_time) + 1e-6
+            deliver_(bus, sensor, sensor.admit_([], last_time), stats)
+
+    stats.elapsed = time.monotonic() - start
+    return stats
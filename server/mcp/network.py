@@ -10,14 +10,19 @@ except ImportError:
 import logging
 import os
 import socket
+import struct
+import time
 
+from collections import deque, namedtuple
 from select import POLLIN
-from threading import Thread
+from threading import Thread, Lock
 from queue import Queue, Empty
 
 import zmq
 from zmq.sugar import socket as zmq_socket
 
+from mcp import codec, journal
+
 log = logging.getLogger('network')
 
 
@@ -44,18 +49,73 @@ class DeviceType(Enum):
     actuator = 2
 
 
+class _TokenBucket:
+    """
+    Allows |rate| events per second on average, and bursts of up to |burst| events.
+    """
+    def __init__(self, rate: float, burst: float):
+        assert rate > 0
+        assert burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self.tokens_ = float(burst)
+        self.stamp_ = time.monotonic()
+
+    def refill_(self, now: float):
+        # Replays drive the bucket from recorded timestamps, which may predate our creation.
+        self.tokens_ = min(self.burst, self.tokens_ + max(0.0, now - self.stamp_) * self.rate)
+        self.stamp_ = now
+
+    def take(self, now: float) -> bool:
+        self.refill_(now)
+        if self.tokens_ < 1:
+            return False
+        self.tokens_ -= 1
+        return True
+
+    def wait_time(self, now: float) -> float:
+        """
+        Seconds until the next token is available.
+        """
+        self.refill_(now)
+        return max(0.0, (1 - self.tokens_) / self.rate)
+
+
 class Sensor:
-    def __init__(self, sensor: object):
+    ShedModes = ('drop', 'merge')
+
+    def __init__(self, sensor: object, rate: float=None, burst: float=None, shed: str='drop'):
         """
         Construct a network sensor given some object with a name and address.
         Forwards messages on the network at |address| to the given |sensor|
         instance.
+
+        If |rate| is given, the sensor is limited to that many messages per second,
+        with bursts of up to |burst| messages (by default, one second's worth).
+        Messages over the limit are shed before they reach the model: with |shed|
+        'drop' they are discarded; with 'merge' only the latest message of each
+        type is kept, and these are delivered in arrival order once the sensor is
+        back under its limit.
         """
         assert hasattr(sensor, 'name')
         assert hasattr(sensor, 'address')
         assert hasattr(sensor, 'on_message')
+        assert shed in self.ShedModes
         self.instance = sensor
         self.socket = None  # ZMQ socket, assigned by Bus.
+        self.local_queue_ = None  # Set by Bus if the sensor is a LocalPublisher in this process.
+
+        # Ingress limiting.
+        self.bucket_ = _TokenBucket(rate, burst or max(1, rate)) if rate is not None else None
+        self.shed = shed
+        self.deferred_ = {}  #: {str: object} The latest over-limit message of each type, in merge mode.
+        self.shed_count = 0  # Messages that never reached the model.
+
+        # Liveness tracking, on the monotonic clock. Devices may publish messages of
+        # type 'heartbeat' when they have nothing else to say; the Bus counts these
+        # as proof of life and does not forward them.
+        self.last_seen = None
+        self.heartbeat_count = 0
 
     @staticmethod
     def device_type():
@@ -72,17 +132,185 @@ class Sensor:
     def on_message(self, message: object):
         self.instance.on_message(message)
 
+    def stats(self, now: float) -> {str: object}:
+        return {
+            'last_seen_ago': None if self.last_seen is None else now - self.last_seen,
+            'heartbeats': self.heartbeat_count,
+            'shed': self.shed_count,
+            'deferred': len(self.deferred_),
+        }
+
+    @staticmethod
+    def is_heartbeat(message: object) -> bool:
+        return isinstance(message, dict) and message.get('type') == 'heartbeat'
+
+    @property
+    def has_deferred(self) -> bool:
+        return bool(self.deferred_)
+
+    def deferred_wait_time_(self, now: float) -> float:
+        return self.bucket_.wait_time(now)
+
+    def admit_(self, messages: [object], now: float) -> [object]:
+        """
+        Apply the sensor's rate limit to newly received |messages|, returning those
+        that may be dispatched now, preceded by any deferred messages that are
+        now within the limit. Must be called from the Bus thread.
+        """
+        if self.bucket_ is None:
+            return messages
+
+        admitted = []
+        while self.deferred_ and self.bucket_.take(now):
+            msg_type = next(iter(self.deferred_))
+            admitted.append(self.deferred_.pop(msg_type))
+
+        for message in messages:
+            if not self.deferred_ and self.bucket_.take(now):
+                admitted.append(message)
+                continue
+
+            msg_type = message.get('type') if isinstance(message, dict) else None
+            if self.shed == 'drop' or msg_type is None:
+                self.shed_count += 1
+                continue
+            if self.deferred_.pop(msg_type, None) is not None:
+                self.shed_count += 1
+            # Re-insert, so that deferred messages are delivered in the order their latest versions arrived.
+            self.deferred_[msg_type] = message
+        return admitted
+
+    def on_messages(self, messages: [object]):
+        """
+        Forward a batch of messages that arrived in one poll cycle. If the instance
+        implements on_messages it gets the whole batch; otherwise each message is
+        passed to on_message in order.
+        """
+        if hasattr(self.instance, 'on_messages'):
+            self.instance.on_messages(messages)
+            return
+
+        for message in messages:
+            try:
+                self.instance.on_message(message)
+            except Exception:
+                log.exception("failed to handle sensor message")
+
+
+def default_coalescing_key(message: object) -> object:
+    """
+    Messages to the same property of the same target supersede each other. Returns
+    None for messages that do not name both, which are never coalesced.
+    """
+    if not isinstance(message, dict):
+        return None
+    target, prop = message.get('target'), message.get('type')
+    if target is None or prop is None:
+        return None
+    return target, prop
+
+
+class _CoalescingQueue:
+    """
+    A latest-wins message queue with the subset of the queue.Queue interface that
+    the Bus uses. Putting a message whose coalescing key matches a message that is
+    still pending replaces that message in place, keeping its position in the queue.
+    """
+    def __init__(self, key: callable):
+        self.key_ = key
+        self.lock_ = Lock()
+        self.slots_ = deque()  #: deque([key, message])
+        self.pending_ = {}  #: {key: [key, message]}
+        self.coalesced_count = 0
+
+    def put(self, message: object):
+        key = self.key_(message)
+        with self.lock_:
+            slot = self.pending_.get(key) if key is not None else None
+            if slot is not None:
+                slot[1] = message
+                self.coalesced_count += 1
+                return
+            slot = [key, message]
+            self.slots_.append(slot)
+            if key is not None:
+                self.pending_[key] = slot
+
+    def get_nowait(self) -> object:
+        with self.lock_:
+            if not self.slots_:
+                raise Empty
+            key, message = self.slots_.popleft()
+            if key is not None:
+                del self.pending_[key]
+            return message
+
+    def empty(self) -> bool:
+        return not self.slots_
+
+    def qsize(self) -> int:
+        return len(self.slots_)
+
+
+_InFlight = namedtuple('_InFlight', ('correlation_id', 'sent_at', 'is_heartbeat'))
+
 
 class Actuator:
-    def __init__(self, actuator: object):
+    HeartbeatMessage = {'target': '', 'type': 'heartbeat'}
+
+    def __init__(self, actuator: object, window: int=1, coalesce: bool=False,
+                 coalescing_key: callable=default_coalescing_key, codecs: [str]=('json',),
+                 reply_timeout: float=None, heartbeat_interval: float=None):
         """
         Construct a network actuator given some object with name and address.
+
+        By default, messages are sent in strict lockstep over a REQ socket: we
+        send one request and wait for its reply before sending the next. If
+        |window| is greater than 1, the actuator is pipelined instead: we talk
+        to the remote over a DEALER socket and allow up to |window| requests to
+        be in flight at once. Each request carries a correlation id in its
+        envelope, which REP and ROUTER peers echo back to us, so that replies
+        are still delivered to on_reply in the order the requests were sent.
+
+        If |coalesce| is set, queued messages are latest-wins: a new message
+        with the same |coalescing_key| as one that has not been sent yet
+        replaces it, rather than being replayed after it. The default key is
+        the message's (target, type) pair.
+
+        Replies are decoded with whatever codec the remote used. Requests are sent
+        as JSON until the remote replies in one of the binary |codecs| that is
+        available here; after that, requests are sent in that codec. See mcp.codec.
+
+        If |reply_timeout| seconds pass without a reply to the oldest request in
+        flight, the Bus gives up on everything in flight and re-creates the
+        socket, so that a rebooted device does not wedge its queue forever. If
+        |heartbeat_interval| is set, the Bus sends a HeartbeatMessage whenever
+        the actuator has been idle that long; any reply counts as proof of life
+        and is not passed on to on_reply.
         """
+        assert window >= 1
         self.bus = None
         self.socket = None
         self.instance = actuator
-        self.queue_ = Queue()
-        self.ready_to_send = True
+        self.queue_ = _CoalescingQueue(coalescing_key) if coalesce else Queue()
+        self.window = window
+        self.codec = codec.JsonCodec
+        self.accepted_codecs_ = {name for name in codecs if codec.negotiate(name).name == name}
+        self.reply_timeout = reply_timeout
+        self.heartbeat_interval = heartbeat_interval
+
+        # The requests awaiting a reply, in send order.
+        self.in_flight_ = deque()  #: deque(_InFlight)
+
+        # Replies that arrived before the reply to some earlier request.
+        self.early_replies_ = {}  #: {bytes: object}
+        self.next_correlation_id_ = 0
+
+        # Liveness tracking, on the monotonic clock.
+        self.last_seen = None  # When we last got a reply.
+        self.last_active_ = time.monotonic()  # When we last sent or received anything.
+        self.reconnect_count = 0
+        self.lost_count = 0  # Requests abandoned in flight by a reconnect.
 
     @staticmethod
     def device_type():
@@ -96,6 +324,22 @@ class Actuator:
     def address(self):
         return self.instance.address
 
+    @property
+    def is_pipelined(self) -> bool:
+        return self.window > 1
+
+    @property
+    def ready_to_send(self) -> bool:
+        return len(self.in_flight_) < self.window
+
+    @property
+    def coalesced_count(self) -> int:
+        """The number of queued messages that were replaced before they were sent."""
+        return getattr(self.queue_, 'coalesced_count', 0)
+
+    def socket_type(self) -> "zmq socket type":
+        return zmq.DEALER if self.is_pipelined else zmq.REQ
+
     def send_message(self, message: object):
         assert self.socket is not None
         self.queue_.put(message)
@@ -104,28 +348,206 @@ class Actuator:
     def on_reply(self, message: object):
         self.instance.on_reply(message)
 
+    def stalled_for(self, now: float) -> float:
+        """
+        How long the oldest request in flight has been waiting for its reply, in seconds.
+        """
+        if not self.in_flight_:
+            return 0.0
+        return now - self.in_flight_[0].sent_at
+
+    def stats(self, now: float) -> {str: object}:
+        return {
+            'queue_depth': self.queue_.qsize(),
+            'in_flight': len(self.in_flight_),
+            'stalled_for': self.stalled_for(now),
+            'last_seen_ago': None if self.last_seen is None else now - self.last_seen,
+            'reconnects': self.reconnect_count,
+            'lost': self.lost_count,
+            'coalesced': self.coalesced_count,
+        }
+
+    def send_(self, message: object, is_heartbeat: bool=False):
+        data = self.codec.encode(message)
+        if not is_heartbeat:
+            self.bus.record_(journal.ActuatorMessage, self.name, data)
+
+        correlation_id = None
+        if not self.is_pipelined:
+            self.socket.send(data)
+        else:
+            correlation_id = struct.pack('!Q', self.next_correlation_id_)
+            self.next_correlation_id_ += 1
+            self.socket.send_multipart([correlation_id, b'', data])
+
+        self.last_active_ = time.monotonic()
+        self.in_flight_.append(_InFlight(correlation_id, self.last_active_, is_heartbeat))
+
+    def flush_(self):
+        """
+        Send queued messages until the queue is empty or the in-flight window is full.
+        Must be called from the Bus thread.
+        """
+        while self.ready_to_send:
+            try:
+                message = self.queue_.get_nowait()
+            except Empty:
+                return
+
+            log.info("Sending message to actuator: {}".format(self.name))
+            self.send_(message)
+
+    def check_liveness_(self, now: float) -> bool:
+        """
+        Send a heartbeat if one is due. Returns False if the actuator has timed out
+        and needs a new socket. Must be called from the Bus thread.
+        """
+        if self.reply_timeout is not None and self.stalled_for(now) > self.reply_timeout:
+            return False
+
+        if (self.heartbeat_interval is not None and not self.in_flight_ and self.queue_.empty() and
+                now - self.last_active_ > self.heartbeat_interval):
+            log.debug("Sending heartbeat to actuator: {}".format(self.name))
+            self.send_(self.HeartbeatMessage, is_heartbeat=True)
+        return True
+
+    def reset_(self, socket: zmq_socket):
+        """
+        Abandon everything in flight and continue on a new socket.
+        """
+        self.lost_count += sum(1 for request in self.in_flight_ if not request.is_heartbeat)
+        self.in_flight_.clear()
+        self.early_replies_.clear()
+        self.reconnect_count += 1
+        self.last_active_ = time.monotonic()
+        self.socket = socket
+
+    def receive_replies_(self) -> [object]:
+        """
+        Read one reply from the socket and return the list of replies that can now
+        be delivered in order. Must be called from the Bus thread.
+        """
+        if not self.is_pipelined:
+            frame = self.socket.recv(copy=False)
+            data = codec.decode(frame.buffer)
+            self.answer_in_kind_(frame.buffer)
+            self.mark_seen_()
+            request = self.in_flight_.popleft()
+            return [] if request.is_heartbeat else [data]
+
+        frames = self.socket.recv_multipart(copy=False)
+        correlation_id, payload = frames[0].bytes, frames[-1]
+        if not any(request.correlation_id == correlation_id for request in self.in_flight_):
+            log.warning("dropping reply with unknown correlation id from actuator: {}".format(self.name))
+            return []
+        self.early_replies_[correlation_id] = codec.decode(payload.buffer)
+        self.answer_in_kind_(payload.buffer)
+        self.mark_seen_()
+
+        replies = []
+        while self.in_flight_ and self.in_flight_[0].correlation_id in self.early_replies_:
+            request = self.in_flight_.popleft()
+            reply = self.early_replies_.pop(request.correlation_id)
+            if not request.is_heartbeat:
+                replies.append(reply)
+        return replies
+
+    def answer_in_kind_(self, buf: memoryview):
+        """
+        A remote that replies in a binary codec can evidently read it too.
+        """
+        peer_codec = codec.codec_of(buf)
+        if peer_codec is not self.codec and peer_codec.name in self.accepted_codecs_:
+            log.info("Actuator {} speaks {}; switching to it".format(self.name, peer_codec.name))
+            self.codec = peer_codec
+
+    def mark_seen_(self):
+        self.last_seen = self.last_active_ = time.monotonic()
+
+
+class LocalPublisher:
+    """
+    The device half of a sensor that lives in the same process as the Bus. Use
+    Bus.bind_local to create one, then add a network.Sensor whose address is the
+    same inproc:// endpoint.
+
+    Messages are handed to the Bus by reference: the inproc socket only carries
+    an empty doorbell frame per message, so nothing is serialized or copied. As
+    with any zmq socket, a LocalPublisher must only be used from one thread, and
+    that thread is responsible for closing it.
+
+    Sending never blocks: if no sensor is connected, or the Bus has stopped
+    reading, the message is dropped and counted in |dropped_count|.
+    """
+    def __init__(self, ctx: zmq.Context, endpoint: str):
+        assert endpoint.startswith('inproc://')
+        self.endpoint = endpoint
+        self.queue_ = deque()
+        self.socket_ = ctx.socket(zmq.PUSH)
+        self.socket_.setsockopt(zmq.LINGER, 0)
+        self.socket_.bind(endpoint)
+        self.dropped_count = 0
+
+    def send(self, message: object) -> bool:
+        """
+        Returns False if the message was dropped.
+        """
+        self.queue_.append(message)
+        try:
+            self.socket_.send(b'', zmq.NOBLOCK)
+        except zmq.Again:
+            # No doorbell was rung for this message, so the Bus will never take it.
+            self.queue_.pop()
+            self.dropped_count += 1
+            return False
+        return True
+
+    def close(self):
+        self.socket_.close()
+
 
 class Bus(Thread):
     """
     The global message bus for an MCP instance. Receives sensor traffic from
     the network and forwards it to the connected model for further processing.
+
+    Device addresses are either a (host, port) pair, which is reached over TCP,
+    or a zmq endpoint string. Devices on the same machine can use ipc:// to skip
+    the loopback TCP stack. Devices in the same process can use inproc://, but
+    must create their sockets from Bus.ctx; see also LocalPublisher.
     """
 
+    Transports = ('tcp', 'ipc', 'inproc')
     DefaultSensorPort = 31975
     DefaultActuatorPort = 31978
     Interval = 500
 
-    def __init__(self, lock):
+    # The most messages to drain from one sensor socket per poll cycle.
+    SensorBatchBudget = 64
+
+    def __init__(self, lock, journal_writer: journal.JournalWriter=None):
+        """
+        If |journal_writer| is given, every inbound sensor message and outbound
+        actuator message is appended to it. The Bus closes it on exit.
+        """
         super().__init__()
         self.ready_to_exit = False
 
         # A lock to hold while executing response code.
         self.lock_ = lock
 
+        # Where to record traffic, if anywhere.
+        self.journal_ = journal_writer
+
         self.ctx = zmq.Context()
         self.poller = zmq.Poller()
         self.sensors = {}  # {zmq.socket: Sensor}
         self.actuators = {}  # {zmq.socket: Actuator}
+        self.local_publishers_ = {}  # {str: LocalPublisher}
+        self.shards = {}  # {zmq.socket: mcp.shard.SensorShard}
+
+        # When we last looked for stalled actuators, on the monotonic clock.
+        self.last_liveness_check_ = time.monotonic()
 
         # The poke socket.
         self.read_fd_, self.write_fd_ = os.pipe()
@@ -139,13 +561,27 @@ class Bus(Thread):
             socket.close()
         for socket in self.sensors:
             socket.close()
+        for socket, shard in self.shards.items():
+            shard.stop_()
+            socket.close()
+        if self.journal_ is not None:
+            self.journal_.close()
         os.close(self.read_fd_)
         os.close(self.write_fd_)
 
-    def connect_(self, address: (str, int), socket_type: "zmq socket type"):
+    @classmethod
+    def endpoint_(cls, address: (str, int) or str) -> str:
+        if isinstance(address, str):
+            transport, _, _ = address.partition('://')
+            if transport not in cls.Transports:
+                raise ValueError("unsupported device address: {}".format(address))
+            return address
+        return "tcp://" + str(address[0]) + ":" + str(address[1])
+
+    def connect_(self, address: (str, int) or str, socket_type: "zmq socket type"):
         socket = self.ctx.socket(socket_type)
-        address = "tcp://" + str(address[0]) + ":" + str(address[1])
-        log.info("Connecting to sensor at: {}".format(address))
+        address = self.endpoint_(address)
+        log.info("Connecting to device at: {}".format(address))
         socket.connect(address)
         self.poller.register(socket, POLLIN)
         return socket
@@ -153,16 +589,129 @@ class Bus(Thread):
     def add_actuator(self, actuator: Actuator):
         assert not hasattr(actuator, 'remote')
         actuator.bus = self
-        actuator.socket = self.connect_(actuator.address, zmq.REQ)
+        actuator.socket = self.connect_(actuator.address, actuator.socket_type())
         self.actuators[actuator.socket] = actuator
 
     def add_sensor(self, sensor: Sensor):
         assert not hasattr(sensor, 'remote')
         sensor.bus = self
-        sensor.socket = self.connect_(sensor.address, zmq.SUB)
-        sensor.socket.setsockopt(zmq.SUBSCRIBE, b'')
+        publisher = self.local_publishers_.get(sensor.address) if isinstance(sensor.address, str) else None
+        if publisher is not None:
+            sensor.local_queue_ = publisher.queue_
+            sensor.socket = self.connect_(sensor.address, zmq.PULL)
+        else:
+            sensor.socket = self.connect_(sensor.address, zmq.SUB)
+            sensor.socket.setsockopt(zmq.SUBSCRIBE, b'')
         self.sensors[sensor.socket] = sensor
 
+    def add_shard(self, shard: "mcp.shard.SensorShard"):
+        """
+        Listen to the shard's sensors from a worker process, and dispatch what it
+        forwards here. Forks, so must be called before any threads are started.
+        """
+        shard.socket = self.ctx.socket(zmq.PULL)
+        shard.socket.bind(shard.endpoint)
+        self.poller.register(shard.socket, POLLIN)
+        self.shards[shard.socket] = shard
+        for sensor in shard.sensors.values():
+            sensor.bus = self
+        shard.start_(self)
+
+    def all_sensors(self) -> [Sensor]:
+        """
+        Every sensor on the bus, whether it is listened to here or from a shard.
+        """
+        sensors = list(self.sensors.values())
+        for shard in list(self.shards.values()):
+            sensors += shard.sensors.values()
+        return sensors
+
+    def mute_sensors(self):
+        """
+        Stop listening to sensors on the network. Used when sensor traffic is being
+        replayed from a journal instead; see mcp.journal.replay.
+        """
+        for socket in list(self.sensors) + list(self.shards):
+            self.poller.unregister(socket)
+
+    def record_(self, kind: int, name: str, payload: bytes or memoryview):
+        if self.journal_ is None:
+            return
+        try:
+            self.journal_.append(kind, name, payload)
+        except Exception:
+            log.exception("failed to journal message for {}".format(name))
+
+    def record_local_(self, name: str, message: object):
+        # Messages from a LocalPublisher never touched the wire, so give them one.
+        try:
+            payload = codec.JsonCodec.encode(message)
+        except TypeError:
+            log.warning("cannot journal non-JSON message from {}".format(name))
+            return
+        self.record_(journal.SensorMessage, name, payload)
+
+    def bind_local(self, endpoint: str) -> LocalPublisher:
+        """
+        Create the sending half of an in-process sensor at the given inproc:// endpoint.
+        The caller owns the publisher and must close it from the thread that uses it.
+        """
+        publisher = LocalPublisher(self.ctx, endpoint)
+        self.local_publishers_[endpoint] = publisher
+        return publisher
+
+    def reconnect_actuator_(self, actuator: Actuator):
+        """
+        Throw away the socket of an actuator that stopped answering and connect a new one.
+        A REQ socket that has lost its reply can never send again, and a DEALER's peer may
+        have forgotten everything we sent it, so there is nothing worth salvaging.
+        """
+        log.warning("Actuator {} has not replied in {:.1f}s; reconnecting".format(
+            actuator.name, actuator.stalled_for(time.monotonic())))
+        old_socket = actuator.socket
+        self.poller.unregister(old_socket)
+        del self.actuators[old_socket]
+        old_socket.close(linger=0)
+
+        actuator.reset_(self.connect_(actuator.address, actuator.socket_type()))
+        self.actuators[actuator.socket] = actuator
+        actuator.flush_()
+
+    def check_liveness_(self):
+        now = time.monotonic()
+        if now - self.last_liveness_check_ < self.Interval / 1000:
+            return
+        self.last_liveness_check_ = now
+
+        for actuator in list(self.actuators.values()):
+            if not actuator.check_liveness_(now):
+                self.reconnect_actuator_(actuator)
+
+    @property
+    def coalesced_count(self) -> int:
+        """
+        The number of actuator messages dropped by coalescing, across all actuators.
+        """
+        return sum(actuator.coalesced_count for actuator in self.actuators.values())
+
+    @property
+    def shed_count(self) -> int:
+        """
+        The number of sensor messages shed by rate limiting, across all sensors.
+        """
+        return sum(sensor.shed_count for sensor in self.all_sensors())
+
+    def device_stats(self) -> {str: {str: object}}:
+        """
+        Return a snapshot of the health of every device on the bus, by name. Times
+        are in seconds; 'last_seen_ago' is None for devices we have never heard from.
+        """
+        now = time.monotonic()
+        stats = {}
+        for device in self.all_sensors() + list(self.actuators.values()):
+            stats[device.name] = device.stats(now)
+        return stats
+
     def add_device(self, device: Sensor or Actuator):
         if device.device_type() == DeviceType.sensor:
             return self.add_sensor(device)
@@ -171,17 +720,43 @@ class Bus(Thread):
 
     def run(self):
         while not self.ready_to_exit:
-            ready = self.poller.poll(Bus.Interval)
-            if not ready:
-                continue
+            ready = self.poller.poll(self.poll_timeout_())
+            self.check_liveness_()
 
+            batches = []  # [(Sensor, [object])]
             for (socket, event) in ready:
                 self.check_outgoing_messages_(socket, event)
-                self.check_sensors_(socket, event)
+                batch = self.check_sensors_(socket, event)
+                if batch is not None:
+                    batches.append(batch)
+                batches += self.check_shards_(socket, event)
                 self.check_actuators_(socket, event)
+            batches += self.check_deferred_sensors_({sensor for sensor, _ in batches})
+            self.dispatch_sensor_messages_(batches)
 
         self.cleanup()
 
+    def poll_timeout_(self) -> int:
+        """
+        Wake up in time to deliver the next deferred sensor message, if any.
+        """
+        timeout = self.Interval
+        now = time.monotonic()
+        for sensor in self.sensors.values():
+            if sensor.has_deferred:
+                timeout = min(timeout, int(sensor.deferred_wait_time_(now) * 1000) + 1)
+        return timeout
+
+    def check_deferred_sensors_(self, skip: {Sensor}) -> [(Sensor, [object])]:
+        batches = []
+        now = time.monotonic()
+        for sensor in self.sensors.values():
+            if sensor.has_deferred and sensor not in skip:
+                messages = sensor.admit_([], now)
+                if messages:
+                    batches.append((sensor, messages))
+        return batches
+
     def poke(self):
         os.write(self.write_fd_, b'1')
 
@@ -198,44 +773,89 @@ class Bus(Thread):
             log.warning("unknown error on poke fd")
             return
 
-        # Clear the buffered poke byte.
+        # Clear the buffered poke bytes: several pokes may have piled up since we last woke.
         buf = os.read(self.read_fd_, 4096)
-        assert buf == b'1'
+        assert buf and buf == b'1' * len(buf)
 
         for actuator in self.actuators.values():
-            if not actuator.queue_.empty() and actuator.ready_to_send:
-                log.info("Sending message to actuator: {}".format(actuator.name))
-                actuator.socket.send_json(actuator.queue_.get_nowait())
-                actuator.ready_to_send = False
+            actuator.flush_()
 
-    def check_sensors_(self, socket: zmq_socket, event: int):
+    def check_sensors_(self, socket: zmq_socket, event: int) -> (Sensor, [object]):
+        """
+        Drain up to SensorBatchBudget messages from a ready sensor socket without
+        blocking. Returns the sensor and its batch, or None if there is nothing
+        to dispatch.
+        """
         if event != POLLIN:
             log.warning("unknown error on sensor socket")
-            return
+            return None
 
         if socket not in self.sensors:
-            return
+            return None
 
         try:
             sensor = self.sensors[socket]
         except KeyError:
             log.exception("received message from unknown sensor")
-            return
-
-        log.debug("Received message from sensor: {}".format(sensor.name))
+            return None
+
+        messages = []
+        for _ in range(self.SensorBatchBudget):
+            try:
+                if sensor.local_queue_ is not None:
+                    socket.recv(zmq.NOBLOCK)
+                    message = sensor.local_queue_.popleft()
+                    if self.journal_ is not None:
+                        self.record_local_(sensor.name, message)
+                    messages.append(message)
+                    continue
+                frame = socket.recv(zmq.NOBLOCK, copy=False)
+                self.record_(journal.SensorMessage, sensor.name, frame.buffer)
+                messages.append(codec.decode(frame.buffer))
+            except zmq.Again:
+                break
+            except Exception:
+                log.exception("failed to receive sensor message")
+
+        if not messages:
+            return None
+
+        now = time.monotonic()
+        sensor.last_seen = now
+        heartbeats = sum(1 for message in messages if sensor.is_heartbeat(message))
+        if heartbeats:
+            sensor.heartbeat_count += heartbeats
+            messages = [message for message in messages if not sensor.is_heartbeat(message)]
+
+        messages = sensor.admit_(messages, now)
+        if not messages:
+            return None
+
+        log.debug("Received {} message(s) from sensor: {}".format(len(messages), sensor.name))
+        return sensor, messages
+
+    def check_shards_(self, socket: zmq_socket, event: int) -> [(Sensor, [object])]:
+        if socket not in self.shards:
+            return []
+        if event != POLLIN:
+            log.warning("unknown error on shard socket")
+            return []
+        return self.shards[socket].receive_(self.SensorBatchBudget)
 
-        try:
-            data = socket.recv_json()
-        except Exception:
-            log.exception("failed to receive sensor message")
+    def dispatch_sensor_messages_(self, batches: [(Sensor, [object])]):
+        """
+        Hand every batch drained this poll cycle to its sensor under a single
+        acquisition of the model lock.
+        """
+        if not batches:
             return
 
-        try:
-            with self.lock_:
-                sensor.on_message(data)
-        except Exception:
-            log.exception("failed to handle sensor message")
-            return
+        with self.lock_:
+            for sensor, messages in batches:
+                try:
+                    sensor.on_messages(messages)
+                except Exception:
+                    log.exception("failed to handle sensor messages")
 
     def check_actuators_(self, socket: zmq_socket, event: int):
         if event != POLLIN:
@@ -254,25 +874,17 @@ class Bus(Thread):
         log.info("Received message from actuator: {}".format(actuator.name))
 
         try:
-            data = socket.recv_json()
+            replies = actuator.receive_replies_()
         except Exception:
-            log.exception("failed to receive sensor message")
+            log.exception("failed to receive actuator reply")
             return
-        actuator.ready_to_send = True
 
         try:
             with self.lock_:
-                actuator.on_reply(data)
+                for data in replies:
+                    actuator.on_reply(data)
         except Exception:
             log.exception("failed to handle actuator reply")
-            return
 
         # Check for any messages waiting to send.
-        try:
-            to_send = actuator.queue_.get_nowait()
-            actuator.socket.send_json(to_send)
-            actuator.ready_to_send = False
-        except Empty:
-            return
-
-
+        actuator.flush_()
@@ -2,60 +2,527 @@
 # License, version 3. If a copy of the GPL was not distributed with this file,
 # You can obtain one at https://www.gnu.org/licenses/gpl.txt.
 import heapq
+import itertools
+import logging
+import time
 
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from queue import Queue, Empty
 from threading import Thread, Lock
 
+from mcp.clock import Clock, NanosPerSecond, system_clock, to_ns
 
-class _Event(namedtuple('_Event', ('time', 'action'))):
-    def __eq__(s, o): return s.time == o.time
-    #def __ne__(s, o): return s.time != o.time
-    def __lt__(s, o): return s.time <  o.time
-    #def __le__(s, o): return s.time <= o.time
-    #def __gt__(s, o): return s.time >  o.time
-    #def __ge__(s, o): return s.time >= o.time
+log = logging.getLogger('scheduler')
+
+
+# Entries order by time, then by insertion, so that the timer itself is never compared.
+# Times are integer nanoseconds on the scheduler's monotonic clock.
+_Event = namedtuple('_Event', ('time', 'sequence', 'timer'))
+
+
+def _is_live(event: _Event) -> bool:
+    # Any event that is not its timer's current event has been cancelled or superseded.
+    return event.timer.event_ is event
+
+
+def coalesced_wakeup(heap: list, is_live: callable, latest: callable):
+    """
+    The time to wake for the entries at the front of |heap|, a heapq of entries
+    with a |time|: the latest time that is not past |latest|(entry) for any live
+    entry due by then. Everything due at that time can then run in one wakeup.
+    Only visits entries due before the first one's latest time.
+    """
+    if not heap:
+        return None
+    wakeup = latest(heap[0])
+    stack = [0]
+    while stack:
+        index = stack.pop()
+        entry = heap[index]
+        if entry.time > wakeup:
+            continue
+        if is_live(entry):
+            wakeup = min(wakeup, latest(entry))
+        stack.extend(child for child in (2 * index + 1, 2 * index + 2) if child < len(heap))
+    return wakeup
+
+
+def _latest(event: _Event) -> int:
+    return event.time + event.timer.slack_
+
+
+class _HeapQueue:
+    """
+    A binary heap of events. Dead events stay in the heap as tombstones until they
+    reach the top, or until there are enough of them to be worth compacting.
+    """
+    # Compact when at least this many tombstones make up more than half of the heap.
+    CompactionThreshold = 64
+
+    def __init__(self):
+        self.heap_ = []
+        self.tombstones_ = 0
+        self.compaction_count = 0
+
+    def __len__(self) -> int:
+        return len(self.heap_) - self.tombstones_
+
+    def push(self, event: _Event):
+        heapq.heappush(self.heap_, event)
+
+    def discard(self, event: _Event):
+        self.tombstones_ += 1
+        if self.tombstones_ < self.CompactionThreshold or self.tombstones_ * 2 < len(self.heap_):
+            return
+        self.heap_ = [event for event in self.heap_ if _is_live(event)]
+        heapq.heapify(self.heap_)
+        self.tombstones_ = 0
+        self.compaction_count += 1
+
+    def drop_tombstones_(self):
+        while self.heap_ and not _is_live(self.heap_[0]):
+            heapq.heappop(self.heap_)
+            self.tombstones_ -= 1
+
+    def next_time(self) -> int:
+        self.drop_tombstones_()
+        return self.heap_[0].time if self.heap_ else None
+
+    def next_wakeup(self) -> int:
+        self.drop_tombstones_()
+        return coalesced_wakeup(self.heap_, _is_live, _latest)
+
+    def wakeup_of(self, event: _Event) -> int:
+        """
+        When |event| would be fired if it were the only one queued.
+        """
+        return _latest(event)
+
+    def pop_due(self, now: int) -> _Event:
+        self.drop_tombstones_()
+        if not self.heap_ or self.heap_[0].time > now:
+            return None
+        return heapq.heappop(self.heap_)
+
+
+class _TimingWheel:
+    """
+    A hashed timing wheel of |slots| buckets that each cover |tick| nanoseconds. Each
+    slot groups its events by the absolute tick they are due in, so events more
+    than one revolution out can share a slot with nearer ones and simply wait for
+    a later pass. Events fire at the end of their tick, so up to one |tick| late,
+    and everything due in the same tick fires in one wakeup.
+
+    In Python, the wheel's dict operations cost more than heapq's C pushes and pops,
+    so it does not win on insert or cancel. It pays off only when a coarse tick
+    lets it fire many timers per wakeup and the wheel spans all of their deadlines,
+    so that finding the next one seldom has to pass empty ticks. By
+    bench/bench_scheduler.py, with 100k timers over an hour, a 1s tick and 4096
+    slots, in microseconds per timer:
+
+               insert  cancel  reschedule  drain   wakeups
+        heap      1.6     0.8         2.6    6.0     50000
+        wheel     2.4     0.8         2.8    1.9      3600
+
+    With a 10ms tick and 512 slots, the wheel loses on every operation.
+    """
+    # Slots are grouped into blocks, each with a count of the ticks queued in it, so that
+    # looking for the next tick with anything in it can skip empty blocks at once.
+    BlockSize = 64
+
+    def __init__(self, tick: int, slots: int, now: int):
+        assert tick > 0 and slots > 0
+        self.tick_ = tick
+        self.slots_ = [{} for _ in range(slots)]  #: [{int: {_Event: None}}] absolute tick -> events
+        self.block_ticks_ = [0] * -(-slots // self.BlockSize)  #: [int] queued ticks in each block of slots
+        self.current_tick_ = now // tick  # The last tick that has been expired.
+        self.due_ = deque()  #: [_Event] Expired events, in firing order; cancelled ones are skipped.
+        self.count_ = 0
+        self.compaction_count = 0  # Cancelled events are removed at once; nothing to compact.
+
+    def __len__(self) -> int:
+        return self.count_
+
+    def tick_of_(self, when: int) -> int:
+        return -(-when // self.tick_)
+
+    def push(self, event: _Event):
+        tick = -(-event.time // self.tick_)
+        self.count_ += 1
+        if tick <= self.current_tick_:
+            self.due_.append(event)
+            return
+        index = tick % len(self.slots_)
+        slot = self.slots_[index]
+        events = slot.get(tick)
+        if events is None:
+            events = slot[tick] = {}
+            self.block_ticks_[index // self.BlockSize] += 1
+        events[event] = None
+
+    def discard(self, event: _Event):
+        tick = self.tick_of_(event.time)
+        index = tick % len(self.slots_)
+        slot = self.slots_[index]
+        events = slot.get(tick)
+        if events is not None and event in events:
+            del events[event]
+            if not events:
+                del slot[tick]
+                self.block_ticks_[index // self.BlockSize] -= 1
+        # Otherwise it has expired, and pop_due will skip it: callers detach the event first.
+        self.count_ -= 1
+
+    def expire_(self, until_tick: int):
+        if until_tick <= self.current_tick_:
+            return
+        expired = []
+        if until_tick - self.current_tick_ > len(self.slots_):
+            # We slept through more than a revolution, so every slot may have something due.
+            for index, slot in enumerate(self.slots_):
+                for tick in [tick for tick in slot if tick <= until_tick]:
+                    expired.extend(slot.pop(tick))
+                    self.block_ticks_[index // self.BlockSize] -= 1
+        else:
+            tick = self.current_tick_ + 1
+            while tick <= until_tick:
+                index = tick % len(self.slots_)
+                if not self.block_ticks_[index // self.BlockSize]:
+                    tick += self.BlockSize - index % self.BlockSize
+                    continue
+                events = self.slots_[index].pop(tick, None)
+                if events:
+                    expired.extend(events)
+                    self.block_ticks_[index // self.BlockSize] -= 1
+                tick += 1
+        expired.sort()
+        self.due_.extend(expired)
+        self.current_tick_ = until_tick
+
+    def drop_cancelled_(self):
+        while self.due_ and not _is_live(self.due_[0]):
+            self.due_.popleft()
+
+    def next_time(self) -> int:
+        self.drop_cancelled_()
+        if self.due_:
+            return self.due_[0].time
+        if not self.count_:
+            return None
+        # Look for the next tick with something due in it. Anything further out than
+        # one revolution is picked up by waking once per revolution.
+        slots = len(self.slots_)
+        tick = self.current_tick_ + 1
+        last_tick = self.current_tick_ + slots
+        while tick <= last_tick:
+            index = tick % slots
+            if not self.block_ticks_[index // self.BlockSize]:
+                tick += self.BlockSize - index % self.BlockSize
+                continue
+            if tick in self.slots_[index]:
+                return tick * self.tick_
+            tick += 1
+        return last_tick * self.tick_
+
+    def next_wakeup(self) -> int:
+        """
+        The last tick boundary that is not past the latest time of any event due by
+        then, but no sooner than the next tick with anything in it.
+        """
+        first = self.next_time()
+        if first is None or self.due_:
+            return first
+        slots = len(self.slots_)
+        first_tick = first // self.tick_
+        wakeup = None
+        tick = first_tick
+        while tick <= self.current_tick_ + slots and (wakeup is None or tick * self.tick_ <= wakeup):
+            for event in self.slots_[tick % slots].get(tick, ()):
+                wakeup = _latest(event) if wakeup is None else min(wakeup, _latest(event))
+            tick += 1
+        if wakeup is None:
+            return first
+        return max(first, wakeup // self.tick_ * self.tick_)
+
+    def wakeup_of(self, event: _Event) -> int:
+        return max(self.tick_of_(event.time), _latest(event) // self.tick_) * self.tick_
+
+    def pop_due(self, now: int) -> _Event:
+        self.drop_cancelled_()
+        if not self.due_:
+            self.expire_(now // self.tick_)
+            self.drop_cancelled_()
+        if not self.due_:
+            return None
+        self.count_ -= 1
+        return self.due_.popleft()
+
+
+class CallbackStats:
+    """
+    How long the callbacks with one name have taken to run, in seconds.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def copy(self):
+        stats = CallbackStats()
+        stats.calls, stats.total_time, stats.max_time = self.calls, self.total_time, self.max_time
+        return stats
+
+    def record(self, elapsed: float):
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+
+def _callback_name(callback: callable) -> str:
+    return getattr(callback, '__qualname__', None) or repr(callback)
+
+
+class Timer:
+    """
+    The handle returned by Scheduler.set_timeout.
+    """
+    def __init__(self, scheduler, callback: callable, needs_lock: bool, slack: timedelta):
+        self.scheduler_ = scheduler
+        self.callback = callback
+        self.needs_lock = needs_lock
+        self.slack_ = to_ns(slack)  # How long after its deadline the timer may fire, in nanoseconds.
+
+        # The queued event that will fire this timer, or None if it is not pending.
+        self.event_ = None
+
+    @property
+    def pending(self) -> bool:
+        return self.event_ is not None
+
+    @property
+    def deadline(self) -> datetime:
+        event = self.event_
+        return self.scheduler_.clock_.to_wall(event.time) if event is not None else None
+
+    def cancel(self) -> bool:
+        """
+        Stop the timer from firing. Returns False if it had already fired or been
+        cancelled. Safe to call from any thread, including from a callback.
+        """
+        return self.scheduler_.cancel_(self)
+
+    def reschedule(self, delay: timedelta):
+        """
+        Fire the timer |delay| from now instead, whether or not it is still pending.
+        """
+        self.scheduler_.schedule_(self, delay)
 
 
 class Scheduler(Thread):
-    def __init__(self, lock: Lock):
+    Backends = ('heap', 'wheel')
+
+    # Timers that fire more than this long after their deadline are counted as late.
+    LateTolerance = timedelta(milliseconds=100)
+
+    # Threads for callbacks that do not need the model lock.
+    Workers = 4
+
+    def __init__(self, lock: Lock, backend: str='heap', tick: timedelta=timedelta(seconds=1),
+                 wheel_slots: int=4096, clock: Clock=None, workers: int=Workers):
+        """
+        The default |backend| is a binary heap, which fires timers on time, and is
+        the faster choice for most uses. The 'wheel' backend keeps timers in a
+        timing wheel of |wheel_slots| slots of |tick| each. It fires timers up to
+        one |tick| late, but all those in a tick at once, which makes it cheaper
+        to drain very many timers; see _TimingWheel.
+
+        Time comes from |clock|, which defaults to the system's monotonic clock.
+
+        Callbacks that do not need the model lock run on a pool of |workers|
+        threads, so that slow ones cannot hold up the others. With no workers
+        they run on the scheduler thread instead, which keeps their order
+        deterministic when driven by a VirtualClock.
+
+        Timers may be given some slack: a window after their deadline in which
+        firing is just as good. The scheduler then fires timers whose windows
+        overlap in a single wakeup, under a single acquisition of the model lock.
+        """
         super().__init__()
+        assert backend in self.Backends
         self.lock_ = lock
+        self.clock_ = clock or system_clock
 
+        # Wakes the scheduler thread when the queue changes; None means exit.
         self.queue_ = Queue()
-        self.heap_ = []
 
-    def set_timeout(self, delay: timedelta, callback: callable):
-        self.queue_.put((datetime.now() + delay, callback))
+        # The pending events, and everything else below, are guarded by mutex_.
+        self.mutex_ = Lock()
+        if backend == 'wheel':
+            self.events_ = _TimingWheel(to_ns(tick), wheel_slots, self.clock_.monotonic_ns())
+        else:
+            self.events_ = _HeapQueue()
+        self.sequence_ = itertools.count()
+        self.firing_ = set()  #: {_Event} Events taken from the queue that are waiting to fire.
+
+        self.pool_ = ThreadPoolExecutor(workers, thread_name_prefix='scheduler') if workers else None
+
+        # Statistics.
+        self.fired_count = 0
+        self.cancelled_count = 0
+        self.late_count = 0
+        self.wakeups_saved = 0  # Timers that fired early in their slack, alongside others, not on their own.
+        self.callback_stats_ = {}  #: {str: CallbackStats} by the callback's qualified name
+
+    @property
+    def compaction_count(self) -> int:
+        return self.events_.compaction_count
+
+    def set_timeout(self, delay: timedelta, callback: callable, needs_lock: bool=True,
+                    slack: timedelta=timedelta(0)) -> Timer:
+        """
+        Call |callback| under the model lock once |delay| has passed, or up to |slack|
+        after that if it can share a wakeup with other timers. Returns a Timer that
+        can be used to cancel or reschedule the call.
+
+        If |needs_lock| is False, the callback is run on a worker thread without the
+        model lock, and must take the lock itself before touching the model. It may
+        run at the same time as other callbacks.
+        """
+        timer = Timer(self, callback, needs_lock, slack)
+        self.schedule_(timer, delay)
+        return timer
+
+    def schedule_(self, timer: Timer, delay: timedelta):
+        with self.mutex_:
+            self.supersede_(timer)
+            timer.event_ = _Event(self.clock_.monotonic_ns() + to_ns(delay), next(self.sequence_), timer)
+            self.events_.push(timer.event_)
+        self.queue_.put(True)
+
+    def cancel_(self, timer: Timer) -> bool:
+        with self.mutex_:
+            if timer.event_ is None:
+                return False
+            self.supersede_(timer)
+            self.cancelled_count += 1
+        return True
+
+    def supersede_(self, timer: Timer):
+        # Drop the timer's current event, if any -- unless it has already left the queue.
+        event, timer.event_ = timer.event_, None
+        if event is not None and event not in self.firing_:
+            self.events_.discard(event)
+
+    @property
+    def pending_count(self) -> int:
+        with self.mutex_:
+            return len(self.events_)
+
+    def callback_stats(self) -> {str: CallbackStats}:
+        """
+        A snapshot of how long each callback has taken to run, by qualified name.
+        """
+        with self.mutex_:
+            return {name: stats.copy() for name, stats in self.callback_stats_.items()}
 
     def exit(self):
         self.queue_.put(None)
 
     def _compute_next_delay(self):
-        if self.heap_:
-            return max(0, (self.heap_[0].time - datetime.now()).total_seconds())
-        return None
+        next_time = self.next_wakeup_ns()
+        if next_time is None:
+            return None
+        return max(0, next_time - self.clock_.monotonic_ns()) / NanosPerSecond
+
+    def pop_due_(self) -> [_Event]:
+        with self.mutex_:
+            now = self.clock_.monotonic_ns()
+            batch = []
+            event = self.events_.pop_due(now)
+            while event is not None:
+                batch.append(event)
+                if now < self.events_.wakeup_of(event):
+                    self.wakeups_saved += 1
+                event = self.events_.pop_due(now)
+            self.firing_.update(batch)
+            return batch
+
+    def claim_(self, event: _Event) -> bool:
+        # Someone may have cancelled or rescheduled the timer since it left the queue.
+        with self.mutex_:
+            self.firing_.discard(event)
+            if not _is_live(event):
+                return False
+            event.timer.event_ = None
+            self.fired_count += 1
+            if self.clock_.monotonic_ns() - _latest(event) > to_ns(self.LateTolerance):
+                self.late_count += 1
+        return True
+
+    def fire_(self, batch: [_Event]):
+        # Fire in deadline order, taking the model lock once for each run of timers that need it.
+        index = 0
+        while index < len(batch):
+            event = batch[index]
+            if not event.timer.needs_lock:
+                if self.claim_(event):
+                    if self.pool_ is None:
+                        self.call_(event.timer.callback)
+                    else:
+                        self.pool_.submit(self.call_, event.timer.callback)
+                index += 1
+                continue
+
+            with self.lock_:
+                while index < len(batch) and batch[index].timer.needs_lock:
+                    if self.claim_(batch[index]):
+                        self.call_(batch[index].timer.callback)
+                    index += 1
+
+    def call_(self, callback: callable):
+        start = time.perf_counter()
+        try:
+            callback()
+        except Exception:
+            log.exception("scheduled callback failed")
+        elapsed = time.perf_counter() - start
+
+        name = _callback_name(callback)
+        with self.mutex_:
+            if name not in self.callback_stats_:
+                self.callback_stats_[name] = CallbackStats()
+            self.callback_stats_[name].record(elapsed)
+
+    def next_wakeup_ns(self) -> int:
+        with self.mutex_:
+            return self.events_.next_wakeup()
+
+    def run_due(self):
+        """
+        Fire every timer that is due. Called from run, or by a VirtualClock.
+        """
+        batch = self.pop_due_()
+        while batch:
+            self.fire_(batch)
+            batch = self.pop_due_()
 
     def run(self):
         while True:
             try:
-                # Block until we get an event if the heap is empty, or block
+                # Block until something changes if nothing is pending, or block
                 # until it is time to fire the next event.
-                event = self.queue_.get(block=True, timeout=self._compute_next_delay())
-
-                # A None event is the cue to exit.
-                if not event:
-                    return
+                if self.queue_.get(block=True, timeout=self._compute_next_delay()) is None:
+                    break
             except Empty:
-                # Not an external request, so it must be time to fire the next request.
-                top = heapq.heappop(self.heap_)
-                assert top.time < datetime.now(), "verify that enough time has passed waiting"
-                with self.lock_:
-                    top.action()
-                continue
+                pass
 
-            # Insert the new event into our heap.
-            assert event, "not an empty queue assertion, so we must have a new event to schedule"
-            heapq.heappush(self.heap_, _Event(*event))
+            self.run_due()
 
+        if self.pool_ is not None:
+            self.pool_.shutdown()
@@ -3,6 +3,8 @@
 # You can obtain one at https://www.gnu.org/licenses/gpl.txt.
 import logging
 
+from contextlib import nullcontext
+
 from mcp import network
 from mcp.sensors import Sensor, SensorEvent, MotionEvent, TemperatureEvent, HumidityEvent
 
@@ -10,18 +12,27 @@ log = logging.getLogger('nerve')
 
 
 class Nerve(Sensor):
+    # A healthy nerve sends a reading every few seconds. A flapping motion sensor can
+    # send far more than that; only its latest state of each kind is worth keeping.
+    # Every nerve is limited by default: over these limits, the Bus sheds by merging.
+    MaxMessageRate = 5
+    MaxMessageBurst = 20
+
     def __init__(self, name: str, address: (str, int)):
         super().__init__(name)
 
         # The bus protocol requires these properties:
         self.address = address
-        self.remote = network.Sensor(self)
+        self.remote = network.Sensor(self, rate=self.MaxMessageRate, burst=self.MaxMessageBurst, shed='merge')
 
         # Callbacks for the events we can send.
         self.on_temperature_ = self.fake_listener_
         self.on_humidity_ = self.fake_listener_
         self.on_motion_ = self.fake_listener_
 
+        # Makes the context that the events from one message are sent in.
+        self.batch_ = nullcontext
+
     def fake_listener_(self, evt: SensorEvent):
         log.warning("nerve {} dropping event {}".format(self.name, evt.name))
 
@@ -34,6 +45,13 @@ class Nerve(Sensor):
     def listen_motion(self, callback: callable):
         self.on_motion_ = callback
 
+    def listen_batch(self, context: callable):
+        """
+        Send the events from each message inside the context manager returned by
+        |context|(), so that listeners can apply them together.
+        """
+        self.batch_ = context
+
     def on_message(self, json):
         """
         Called by the sensor model to inform us of new messages from the network.
@@ -42,10 +60,11 @@ class Nerve(Sensor):
         if msg_type == 'TEMP_HUMIDITY':
             temp, humidity = float(json['temp']), float(json['humidity'])
             log.debug("from {} -> temperature: {}, humidity: {}".format(self.name, temp, humidity))
-            if self.on_temperature_:
-                self.on_temperature_(TemperatureEvent(temp))
-            if self.on_humidity_:
-                self.on_humidity_(HumidityEvent(humidity))
+            with self.batch_():
+                if self.on_temperature_:
+                    self.on_temperature_(TemperatureEvent(temp))
+                if self.on_humidity_:
+                    self.on_humidity_(HumidityEvent(humidity))
 
         elif msg_type == 'MOVEMENT':
             state = bool(json['state'])
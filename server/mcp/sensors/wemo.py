@@ -167,6 +167,9 @@ def auto_unlock(lock: Lock):
 
 class _WeMoDeviceService:
     SUBSCRIBE_TIMEOUT = 20  # seconds
+
+    # We resubscribe minutes before the subscription lapses, so this can wait to share a wakeup.
+    ResubscribeSlack = timedelta(seconds=30)
     TIMEOUT_RETRY_INTERVAL = timedelta(seconds=2 * 60)
     ERROR_RETRY_INTERVAL = timedelta(seconds=5 * 60)
 
@@ -187,6 +190,7 @@ class _WeMoDeviceService:
 
         # Subscription state.
         self.is_subscribed = False
+        self.subscription_timer_ = None  # The pending subscribe or resubscribe, if any.
 
     def load_spec_data(self):
         """
@@ -231,6 +235,13 @@ class _WeMoDeviceService:
             self_inner.resubscribe(scheduler_inner, sid_inner)
         return callback
 
+    def schedule_subscription_(self, scheduler: Scheduler, delay: timedelta, callback: callable,
+                               slack: timedelta=timedelta(0)):
+        # Only the latest subscription attempt matters; a stale one would just repeat its work.
+        if self.subscription_timer_ is not None:
+            self.subscription_timer_.cancel()
+        self.subscription_timer_ = scheduler.set_timeout(delay, callback, slack=slack)
+
     def subscribe(self, scheduler: Scheduler):
         """
         Note that in UPnP, SUBSCRIBE subscribes to /everything/ all the time, so there is no point not just doing it
@@ -297,7 +308,7 @@ class _WeMoDeviceService:
     def _handle_subscribe_failure(self, scheduler: Scheduler, retry_time: timedelta):
         # FIXME: retry a few times before setting the device as defunct.
         self.device_.set_defunct(True)
-        scheduler.set_timeout(retry_time, self.make_subscribe_closure(self, scheduler))
+        self.schedule_subscription_(scheduler, retry_time, self.make_subscribe_closure(self, scheduler))
 
         """
         self.timeout_state_.timed_out()
@@ -326,7 +337,8 @@ class _WeMoDeviceService:
         # TODO:    or something and not plumbing that number all the way down here.
         #time_to_resubscribe = timedelta(seconds=60)
         time_to_resubscribe = timeout - timedelta(seconds=30 * 10)
-        scheduler.set_timeout(time_to_resubscribe, self.make_resubscribe_closure(self, scheduler, sid))
+        self.schedule_subscription_(scheduler, time_to_resubscribe, self.make_resubscribe_closure(self, scheduler, sid),
+                                    self.ResubscribeSlack)
 
     def unsubscribe(self, sid: str, scheduler: Scheduler) -> bool:
         log.info("Sending UNSUBSCRIBE to {} for {}".format(urlunparse(self.event_url), sid))
@@ -347,6 +359,8 @@ class _WeMoDeviceService:
             return False
 
         self.is_subscribed = False
+        if self.subscription_timer_ is not None:
+            self.subscription_timer_.cancel()
 
         if res.status_code != 200:
             log.warning("UNSUBSCRIBE unsuccessful, result is {}".format(res.status_code))
@@ -391,6 +405,9 @@ class WeMoSensor(Sensor):
         # The services list.
         self.services = {}
 
+        # The pending periodic_update, if any.
+        self.update_timer_ = None
+
         # Who to notify on motion events.
         self.motion_listeners_ = []
         self.defunct_listeners_ = []
@@ -439,6 +456,10 @@ class WeMoSensor(Sensor):
         return data
 
     def periodic_update(self):
+        """
+        Scheduled without the model lock, so that fetching setup.xml does not stall
+        everyone else; the lock is only taken to apply the results.
+        """
         assert self.max_age != 0  # Ensure we've gotten at least one upnp update.
 
         now = datetime.now()
@@ -455,11 +476,15 @@ class WeMoSensor(Sensor):
         except TimeoutError as ex:
             log.error("Timed out fetching services.xml for {}")
             log.exception(ex)
-            self.set_defunct(True)
+            with self.manager.lock_:
+                self.set_defunct(True)
             return
 
         xml = objectify.fromstring(data.decode('UTF-8'))
+        with self.manager.lock_:
+            self.apply_setup_xml_(xml, now)
 
+    def apply_setup_xml_(self, xml, now: datetime):
         self.setup_last_update = now
         self.spec_version = (int(xml.specVersion.major), int(xml.specVersion.minor))
         self.friendly_name = str(xml.device.friendlyName)
@@ -732,8 +757,10 @@ class WeMoManager(Thread):
                 return
             state.update_upnp_info(headers)
 
-        # Enqueue us for updating.
-        self.scheduler.set_timeout(timedelta(seconds=0), state.periodic_update)
+        # Enqueue us for updating, unless an update is already queued.
+        if state.update_timer_ is None or not state.update_timer_.pending:
+            state.update_timer_ = self.scheduler.set_timeout(timedelta(seconds=0), state.periodic_update,
+                                                             needs_lock=False)
 
         # The handler method is called from init, so the handler is totally extraneous.
         return _FakeHandler(request, client_address, server)
@@ -0,0 +1,202 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+"""
+Sensor ingestion in worker processes.
+
+A SensorShard takes a group of network.Sensors -- say, all the nerves in one room --
+and listens to them from a separate process, with its own interpreter and its own
+GIL. The worker decodes each message, drops heartbeats and applies the sensors'
+rate limits, then forwards what is left to the Bus over an ipc:// socket:
+
+    name | meta: heartbeats u32, shed u32 | payload | payload | ...
+
+Payloads are re-encoded with the nerve codec, which packs nerve readings into a
+few bytes and carries anything else as JSON. The Bus hands each batch to the
+sensor's instance in the main process, so sharding is invisible to the model.
+
+Workers are forked when the shard is added to the Bus, so shards must be added
+before any other threads are started.
+"""
+import logging
+import multiprocessing
+import os
+import struct
+import time
+
+import zmq
+
+from mcp import codec, journal, network
+
+log = logging.getLogger('shard')
+
+
+ShardMeta = struct.Struct('<II')
+
+
+class _ShardedDevice:
+    """
+    The stand-in for a sensor's instance inside a worker process.
+    """
+    def __init__(self, name: str, address: (str, int) or str):
+        self.name = name
+        self.address = address
+
+    def on_message(self, message: object):
+        # The worker only forwards messages; the sensor's real instance handles them in the main process.
+        log.warning("sharded sensor {} dropping message delivered in the worker".format(self.name))
+
+
+class SensorShard:
+    # How long the worker waits on its sockets before checking for deferred messages.
+    Interval = 500
+
+    def __init__(self, name: str, endpoint: str=None):
+        """
+        Create an empty shard. Workers forward to the Bus at |endpoint|, which is a
+        fresh ipc:// path by default.
+        """
+        self.name = name
+        self.endpoint = endpoint or 'ipc:///tmp/mcp-shard-{}-{}'.format(os.getpid(), name)
+        self.sensors = {}  # {str: network.Sensor}
+        self.bus = None
+        self.socket = None  # ZMQ PULL socket, assigned by Bus.
+        self.process_ = None
+
+    def add_sensor(self, sensor: network.Sensor) -> network.Sensor:
+        assert self.process_ is None, "sensors must be added before the shard is started"
+        assert sensor.name not in self.sensors
+        self.sensors[sensor.name] = sensor
+        return sensor
+
+    def specs_(self) -> [(str, object, float, float, str)]:
+        specs = []
+        for sensor in self.sensors.values():
+            bucket = sensor.bucket_
+            specs.append((sensor.name, sensor.address,
+                          bucket.rate if bucket else None, bucket.burst if bucket else None, sensor.shed))
+        return specs
+
+    def start_(self, bus):
+        """
+        Fork the worker. Called by Bus.add_shard.
+        """
+        self.bus = bus
+        ctx = multiprocessing.get_context('fork')
+        self.process_ = ctx.Process(target=run_shard, name='shard-{}'.format(self.name),
+                                    args=(self.endpoint, self.specs_(), bus.SensorBatchBudget, os.getpid()),
+                                    daemon=True)
+        self.process_.start()
+
+    def stop_(self):
+        if self.process_ is None:
+            return
+        self.process_.terminate()
+        self.process_.join()
+        self.process_ = None
+        if self.endpoint.startswith('ipc://'):
+            try:
+                os.unlink(self.endpoint[len('ipc://'):])
+            except OSError:
+                pass
+
+    @property
+    def is_alive(self) -> bool:
+        return self.process_ is not None and self.process_.is_alive()
+
+    def receive_(self, budget: int) -> [(network.Sensor, [object])]:
+        """
+        Drain up to |budget| forwarded batches without blocking. Must be called from
+        the Bus thread.
+        """
+        batches = []
+        now = time.monotonic()
+        for _ in range(budget):
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+
+            name = frames[0].bytes.decode('UTF-8')
+            sensor = self.sensors.get(name)
+            if sensor is None:
+                log.warning("shard {} forwarded a message for unknown sensor: {}".format(self.name, name))
+                continue
+
+            heartbeats, shed = ShardMeta.unpack(frames[1].bytes)
+            sensor.last_seen = now
+            sensor.heartbeat_count += heartbeats
+            sensor.shed_count += shed
+
+            messages = []
+            for frame in frames[2:]:
+                self.bus.record_(journal.SensorMessage, name, frame.buffer)
+                try:
+                    messages.append(codec.decode(frame.buffer))
+                except Exception:
+                    log.exception("failed to decode message forwarded by shard {}".format(self.name))
+            if messages:
+                batches.append((sensor, messages))
+        return batches
+
+
+def run_shard(endpoint: str, specs: [(str, object, float, float, str)], budget: int, parent_pid: int):
+    """
+    The body of a worker process: listen to the sensors in |specs| and forward
+    to the Bus at |endpoint| until terminated, or until the parent goes away.
+    """
+    ctx = zmq.Context()
+    forward = ctx.socket(zmq.PUSH)
+    forward.setsockopt(zmq.LINGER, 0)
+    forward.connect(endpoint)
+
+    poller = zmq.Poller()
+    sensors = {}  # {zmq.socket: network.Sensor}
+    for name, address, rate, burst, shed in specs:
+        sensor = network.Sensor(_ShardedDevice(name, address), rate=rate, burst=burst, shed=shed)
+        sensor.socket = ctx.socket(zmq.SUB)
+        sensor.socket.setsockopt(zmq.SUBSCRIBE, b'')
+        sensor.socket.connect(network.Bus.endpoint_(address))
+        poller.register(sensor.socket, zmq.POLLIN)
+        sensors[sensor.socket] = sensor
+
+    shed_reported = {sensor: 0 for sensor in sensors.values()}
+
+    def forward_batch(sensor: network.Sensor, messages: [object], heartbeats: int):
+        shed = sensor.shed_count - shed_reported[sensor]
+        if not messages and not heartbeats and not shed:
+            return
+        frames = [sensor.name.encode('UTF-8'), ShardMeta.pack(heartbeats, shed)]
+        frames += [codec.NerveCodec.encode(message) for message in messages]
+        try:
+            forward.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            # The Bus is not keeping up; these are shed too, and reported with the next batch.
+            sensor.shed_count += len(messages)
+            return
+        shed_reported[sensor] = sensor.shed_count
+
+    while os.getppid() == parent_pid:
+        timeout = SensorShard.Interval
+        now = time.monotonic()
+        for sensor in sensors.values():
+            if sensor.has_deferred:
+                timeout = min(timeout, int(sensor.deferred_wait_time_(now) * 1000) + 1)
+
+        ready = dict(poller.poll(timeout))
+        now = time.monotonic()
+        for socket, sensor in sensors.items():
+            messages = []
+            if socket in ready:
+                for _ in range(budget):
+                    try:
+                        messages.append(codec.decode(socket.recv(zmq.NOBLOCK, copy=False).buffer))
+                    except zmq.Again:
+                        break
+                    except Exception:
+                        log.exception("failed to receive sensor message")
+            heartbeats = sum(1 for message in messages if sensor.is_heartbeat(message))
+            messages = [message for message in messages if not sensor.is_heartbeat(message)]
+            if messages or sensor.has_deferred:
+                messages = sensor.admit_(messages, now)
+            forward_batch(sensor, messages, heartbeats)
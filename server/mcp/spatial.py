@@ -0,0 +1,148 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+"""
+Find the areas of an Abode that contain a point or overlap a box.
+
+Each Area's position is relative to its parent, so an area's box in the Abode's
+coordinates is found by adding up the positions of it and its ancestors. Boxes
+are closed: a point on the wall between two rooms is in both.
+
+The index is a uniform grid over the floor plan. Every box is listed in each
+grid cell its footprint covers, so a point query only has to check the areas
+in one cell, however many areas the house has. Heights are checked exactly,
+but are not gridded: houses are wide, not tall.
+
+Batched queries for many points at once, say from a depth camera, use NumPy
+when it is installed, and fall back to one query per point when it is not.
+"""
+import logging
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mcp.dimension import Coord, Size
+
+log = logging.getLogger('spatial')
+
+
+class _Box:
+    def __init__(self, low: (float, float, float), high: (float, float, float)):
+        self.low = low
+        self.high = high
+
+    @classmethod
+    def of_area(cls, area):
+        x, y, z = 0.0, 0.0, 0.0
+        parent = area
+        while parent is not None:
+            x, y, z = x + parent.position.x, y + parent.position.y, z + parent.position.z
+            parent = parent.parent
+        return cls((x, y, z), (x + area.size.x, y + area.size.y, z + area.size.z))
+
+    def contains(self, point: (float, float, float)) -> bool:
+        # A point without a height is in the box if it is anywhere above its footprint.
+        return all(point[i] is None or self.low[i] <= point[i] <= self.high[i] for i in range(3))
+
+    def overlaps(self, other) -> bool:
+        return all(self.low[i] <= other.high[i] and other.low[i] <= self.high[i] for i in range(3))
+
+
+class SpatialIndex:
+    # The side of a grid cell, in meters.
+    CellSize = 1.0
+
+    def __init__(self, cell_size: float=CellSize):
+        assert cell_size > 0
+        self.cell_size_ = cell_size
+        self.cells_ = {}  #: {(int, int): {Area: None}}
+        self.boxes_ = {}  #: {Area: _Box}
+
+        # Every box as arrays, for batched queries. Rebuilt after the areas change.
+        self.arrays_ = None  #: ([Area], numpy.ndarray, numpy.ndarray) or None
+
+    def __len__(self) -> int:
+        return len(self.boxes_)
+
+    def cells_of_(self, box: _Box) -> [(int, int)]:
+        low_x, low_y = (math.floor(box.low[i] / self.cell_size_) for i in range(2))
+        high_x, high_y = (math.floor(box.high[i] / self.cell_size_) for i in range(2))
+        return [(x, y) for x in range(low_x, high_x + 1) for y in range(low_y, high_y + 1)]
+
+    def insert(self, area):
+        """
+        Add |area| to the index. Its ancestors must already be in their final places.
+        """
+        box = _Box.of_area(area)
+        self.boxes_[area] = box
+        for cell in self.cells_of_(box):
+            self.cells_.setdefault(cell, {})[area] = None
+        self.arrays_ = None
+
+    def remove(self, area):
+        box = self.boxes_.pop(area)
+        for cell in self.cells_of_(box):
+            del self.cells_[cell][area]
+            if not self.cells_[cell]:
+                del self.cells_[cell]
+        self.arrays_ = None
+
+    @staticmethod
+    def sorted_(areas) -> list:
+        return sorted(areas, key=lambda area: area.path())
+
+    def at_point(self, x: float, y: float, z: float=None) -> list:
+        """
+        Return every area whose box contains the point (|x|, |y|, |z|), in path order,
+        so that outer areas come before the areas inside them. If |z| is None, only
+        the floor plan is considered.
+        """
+        cell = (math.floor(x / self.cell_size_), math.floor(y / self.cell_size_))
+        point = (x, y, z)
+        return self.sorted_(area for area in self.cells_.get(cell, ()) if self.boxes_[area].contains(point))
+
+    def overlapping(self, position: Coord, size: Size) -> list:
+        """
+        Return every area whose box overlaps the box at |position| of |size|, in path order.
+        """
+        query = _Box((position.x, position.y, position.z),
+                     (position.x + size.x, position.y + size.y, position.z + size.z))
+        found = {}
+        for cell in self.cells_of_(query):
+            for area in self.cells_.get(cell, ()):
+                if area not in found and self.boxes_[area].overlaps(query):
+                    found[area] = None
+        return self.sorted_(found)
+
+    def contains_points(self, points) -> (list, object):
+        """
+        Test many points against every area at once. |points| is an N x 2 or N x 3
+        array of x, y and optionally z. Returns the areas, in path order, and an
+        N x len(areas) boolean array that is True where a point is in an area.
+        Requires NumPy.
+        """
+        if numpy is None:
+            raise RuntimeError("batched spatial queries need numpy")
+        points = numpy.asarray(points, dtype=float)
+        assert points.ndim == 2 and points.shape[1] in (2, 3)
+        if self.arrays_ is None:
+            areas = self.sorted_(self.boxes_)
+            self.arrays_ = (areas,
+                            numpy.array([self.boxes_[area].low for area in areas], dtype=float).reshape(-1, 3),
+                            numpy.array([self.boxes_[area].high for area in areas], dtype=float).reshape(-1, 3))
+        areas, low, high = self.arrays_
+        dims = points.shape[1]
+        inside = ((points[:, None, :] >= low[None, :, :dims]) & (points[:, None, :] <= high[None, :, :dims]))
+        return areas, inside.all(axis=2)
+
+    def at_points(self, points) -> [list]:
+        """
+        Return, for each of |points|, the areas that contain it, as at_point would.
+        """
+        if numpy is None:
+            return [self.at_point(*point) for point in points]
+        areas, inside = self.contains_points(points)
+        return [[areas[index] for index in numpy.flatnonzero(row)] for row in inside]
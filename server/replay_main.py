@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+import mcp
+from eyrie import Eyrie
+from mcp.journal import JournalReader, replay
+
+import argparse
+import logging
+import os
+import os.path
+
+parser = argparse.ArgumentParser(description='Replay a recorded bus journal into a fresh Eyrie.')
+parser.add_argument('journal', metavar='JOURNAL',
+                    help='A journal recorded with eyrie_main.py --record.')
+parser.add_argument('--speed', '-s', default=1.0, type=float,
+                    help="Replay speed: 1 for real time, N for N times faster, 0 for as fast as possible.")
+parser.add_argument('--db-path', default=os.path.expanduser("~/.local/var/db/mcp-replay/"),
+                    help='Where to store our data. Keep this away from the live database.')
+parser.add_argument('--record', metavar='JOURNAL', default=None,
+                    help="Record the replayed run's bus traffic, to compare against the original.")
+parser.add_argument('--log-level', '-l', default='WARNING',
+                    help="Set the log level (default: WARNING).")
+args = parser.parse_args()
+
+mcp.enable_logging(level=args.log_level)
+log = logging.getLogger('replay')
+
+eyrie = Eyrie(args.db_path, args.record)
+
+# Sensor traffic comes from the journal rather than the network, but everything
+# downstream of the sensors runs as usual. The bus thread still sends actuator traffic.
+eyrie.network.mute_sensors()
+for thread in eyrie.threads:
+    thread.start()
+
+stats = replay(JournalReader(args.journal), eyrie.network, args.speed)
+print(stats)
+
+eyrie.cleanup()
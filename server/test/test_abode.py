@@ -102,3 +102,133 @@ class TestAbode(TestCase):
 
 
 
+
+    def test_lookup_missing(self):
+        abode, room1, room2, room3, area1, area2, area3 = self.build_abode()
+        self.assertRaises(KeyError, lambda: abode.lookup('/Other'))
+        self.assertRaises(KeyError, lambda: abode.lookup('/Test/Room4'))
+        self.assertRaises(KeyError, lambda: abode.lookup('/Test/Room1/Area1/Area1'))
+
+    def test_find(self):
+        abode, room1, room2, room3, area1, area2, area3 = self.build_abode()
+        self.assertIs(room2, abode.find('Room2'))
+        self.assertIs(abode, abode.find('Test'))
+        self.assertRaises(KeyError, lambda: abode.find('Room4'))
+        self.assertRaises(KeyError, lambda: abode.find('Area1'))  # One in every room.
+
+    def test_replace_subarea(self):
+        abode, room1, room2, room3, area1, area2, area3 = self.build_abode()
+        replacement = abode.create_room('Room3', Coord(0, 0), Size(1, 1, 1))
+        self.assertIs(replacement, abode.lookup('/Test/Room3'))
+        self.assertIs(replacement, abode.find('Room3'))
+        self.assertRaises(KeyError, lambda: abode.lookup('/Test/Room3/Area1'))
+        self.assertEqual(len(abode.names_['Area1']), 2)
+
+    def test_transaction(self):
+        abode, room1, room2, room3, area1, area2, area3 = self.build_abode()
+        events = []
+        room1.listen('temperature', 'propertyChanged', lambda event: events.append(event.property_value))
+        with abode.transaction():
+            room1.set('temperature', 20)
+            room1.set('temperature', 21)
+            room1.set('temperature', 22)
+            self.assertEqual(events, [])
+            self.assertRaises(KeyError, lambda: room1.get('temperature'))
+        self.assertEqual(events, [22])
+        self.assertEqual(room1.get('temperature'), 22)
+
+    def test_transaction_rollback(self):
+        abode, room1, room2, room3, area1, area2, area3 = self.build_abode()
+        room1.set('temperature', 20)
+        try:
+            with abode.transaction():
+                room1.set('temperature', 21)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(room1.get('temperature'), 20)
+
+    def test_batched_listener(self):
+        abode, room1, room2, room3, area1, area2, area3 = self.build_abode()
+        batches = []
+        def on_batch(batch):
+            batches.append([(event.target.name, event.property_name, event.property_value) for event in batch.events])
+        for room in (room1, room2):
+            for prop_name in ('temperature', 'humidity'):
+                room.listen(prop_name, 'propertyTouched', on_batch, batched=True)
+
+        # Outside a transaction, each event is a batch of its own.
+        room1.set('temperature', 20)
+        self.assertEqual(batches, [[('Room1', 'temperature', 20)]])
+
+        with abode.transaction():
+            room1.set('temperature', 21)
+            with abode.transaction():
+                room1.set('humidity', 40)
+            room2.set('humidity', 50)
+            room1.set('temperature', 22)
+            self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[1], [('Room1', 'temperature', 22), ('Room1', 'humidity', 40),
+                                      ('Room2', 'humidity', 50)])
+
+    def test_listen_subtree(self):
+        abode, room1, room2, room3, area1, area2, area3 = self.build_abode()
+        seen = []
+        def receiver(name: str):
+            return lambda event: seen.append((name, event.target.path(), event.property_name))
+        room3.listen('wemomotion_desk', 'propertyChanged', receiver('local'))
+        room3.listen_subtree('wemomotion_*', 'propertyChanged', receiver('room3'))
+        abode.listen_subtree('*', 'propertyChanged', receiver('abode'))
+
+        area2.set('wemomotion_desk', True)
+        room3.set('wemomotion_desk', True)
+        room1.set('wemomotion_desk', True)
+        room3.set('temperature', 20)
+        self.assertEqual(seen, [
+            ('room3', '/Test/Room3/Area2', 'wemomotion_desk'),
+            ('abode', '/Test/Room3/Area2', 'wemomotion_desk'),
+            ('local', '/Test/Room3', 'wemomotion_desk'),
+            ('room3', '/Test/Room3', 'wemomotion_desk'),
+            ('abode', '/Test/Room3', 'wemomotion_desk'),
+            ('abode', '/Test/Room1', 'wemomotion_desk'),
+            ('abode', '/Test/Room3', 'temperature'),
+        ])
+
+        # Areas created later are covered too.
+        seen.clear()
+        area4 = room3.create_subarea('Area4', Coord(0, 0), Size(1, 1, 1))
+        area4.set('wemomotion_east', True)
+        self.assertEqual([name for name, _, _ in seen], ['room3', 'abode'])
+
+    def test_listen_subtree_batched(self):
+        abode, room1, room2, room3, area1, area2, area3 = self.build_abode()
+        batches = []
+        abode.listen_subtree('wemomotion_*', 'propertyTouched', lambda batch: batches.append(len(batch.events)),
+                             batched=True)
+        with abode.transaction():
+            room1.set('wemomotion_desk', True)
+            room2.set('wemomotion_desk', True)
+            room2.set('humidity', 40)
+        self.assertEqual(batches, [2])
+
+    def test_nested_rollback(self):
+        abode, room1, room2, room3, area1, area2, area3 = self.build_abode()
+        with abode.transaction():
+            room1.set('x', 0)
+            room1.set('y', 0)
+            try:
+                with abode.transaction():
+                    room1.set('x', 1)
+                    room2.set('x', 1)
+                    raise ValueError()
+            except ValueError:
+                pass
+            room1.set('y', 2)
+        self.assertEqual((room1.get('x'), room1.get('y')), (0, 2))
+        self.assertNotIn('x', room2.property_names())
+
+    def test_listen_subtree_needs_abode(self):
+        area = Area(None, 'Loose', Coord(0, 0), Size(1, 1, 1))
+        subarea = area.create_subarea('Inner', Coord(0, 0), Size(1, 1, 1))
+        self.assertRaises(TypeError, lambda: subarea.listen_subtree('*', 'propertyChanged', lambda event: None))
+        subarea.set('x', 1)  # Plain listeners and sets still work.
@@ -2,11 +2,13 @@
 # License, version 3. If a copy of the GPL was not distributed with this file,
 # You can obtain one at https://www.gnu.org/licenses/gpl.txt.
 from contextlib import contextmanager
+from datetime import datetime, timedelta
 from threading import Lock
 from time import sleep
 from unittest import TestCase
 
 from mcp.animation import AnimationController, CallbackAnimation, LinearAnimation
+from mcp.clock import VirtualClock
 
 
 @contextmanager
@@ -32,35 +34,38 @@ class TestAnimationController(TestCase):
         self.assertTrue(7 < count < 13)
 
     def test_cancel_ongoing_animation(self):
-        with Animator() as animator:
-            count = 0
-            def callback1():
-                nonlocal count
-                count += 1
-            animator.animate(CallbackAnimation(callback1))
+        clock = VirtualClock(datetime(2016, 3, 1))
+        animator = clock.attach(AnimationController(0.1, Lock(), clock=clock))
+        count = 0
+        def callback1():
+            nonlocal count
+            count += 1
+        animator.animate(CallbackAnimation(callback1))
 
-            sleep(1)
-            animator.cancel_ongoing_animation()
-            sleep(1)
+        clock.advance(timedelta(seconds=0.95))
+        animator.cancel_ongoing_animation()
+        clock.advance(timedelta(seconds=1))
 
-        self.assertTrue(7 < count < 13)
+        self.assertEqual(count, 10)
 
     def test_linear_animation(self):
-        with Animator() as animator:
-            last = -1
-            finished = False
+        clock = VirtualClock(datetime(2016, 3, 1))
+        animator = clock.attach(AnimationController(0.1, Lock(), clock=clock))
+        last = -1
+        finished = False
 
-            def tick(v: float):
-                nonlocal last
-                self.assertGreater(v, last)
-                last = v
+        def tick(v: float):
+            nonlocal last
+            self.assertGreater(v, last)
+            last = v
 
-            def finish():
-                nonlocal finished
-                finished = True
+        def finish():
+            nonlocal finished
+            finished = True
 
-            animator.animate(LinearAnimation(0, 1, 1, tick, finish))
-            sleep(1.5)
-            self.assertEqual(last, 1)
-            self.assertTrue(finished)
+        animator.animate(LinearAnimation(0, 1, 1, tick, finish))
+        clock.advance(timedelta(seconds=1.5))
+        self.assertEqual(last, 1)
+        self.assertTrue(finished)
+        self.assertIsNone(animator.next_wakeup_ns())
 
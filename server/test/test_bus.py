@@ -2,17 +2,32 @@
 # License, version 3. If a copy of the GPL was not distributed with this file,
 # You can obtain one at https://www.gnu.org/licenses/gpl.txt.
 from unittest import TestCase
-from mcp import network
+from mcp import codec, network
+from mcp.shard import SensorShard
 import time
+import json
+import os
+import tempfile
 import threading
 import zmq
 
 
+def bind(socket, endpoint: str) -> int:
+    """
+    Bind to |endpoint|, or to a free TCP port on the loopback interface if it is
+    None. Returns the port, if any.
+    """
+    if endpoint is None:
+        return socket.bind_to_random_port('tcp://127.0.0.1')
+    socket.bind(endpoint)
+    return None
+
+
 class FakeActuator:
-    def __init__(self):
-        self.ctx = zmq.Context()
+    def __init__(self, ctx=None, endpoint=None):
+        self.ctx = ctx or zmq.Context()
         self.socket = self.ctx.socket(zmq.REP)
-        self.socket.bind("tcp://*:" + str(network.Bus.DefaultActuatorPort))
+        self.port = bind(self.socket, endpoint)
         self.request = None
 
     def wait_for_message(self):
@@ -22,10 +37,48 @@ class FakeActuator:
         self.socket.close()
 
 
+class FakeSteppedActuator:
+    """
+    A REP actuator that answers one request at a time, on demand.
+    """
+    def __init__(self, ctx=None, endpoint=None):
+        self.ctx = ctx or zmq.Context()
+        self.socket = self.ctx.socket(zmq.REP)
+        self.port = bind(self.socket, endpoint)
+        self.requests = []
+
+    def receive(self):
+        self.requests.append(self.socket.recv_json())
+
+    def reply(self):
+        self.socket.send_json({'hi': 'actuator'})
+
+
+class FakePipelinedActuator:
+    """
+    A ROUTER-based actuator that collects |count| requests before answering any
+    of them, then answers them in reverse order.
+    """
+    def __init__(self, count: int, ctx=None, endpoint=None):
+        self.ctx = ctx or zmq.Context()
+        self.socket = self.ctx.socket(zmq.ROUTER)
+        self.port = bind(self.socket, endpoint)
+        self.count = count
+        self.requests = []
+
+    def wait_for_messages(self):
+        frames = [self.socket.recv_multipart() for _ in range(self.count)]
+        self.requests = [json.loads(f[-1].decode('UTF-8')) for f in frames]
+        for envelope, request in reversed(list(zip(frames, self.requests))):
+            reply = json.dumps({'seq': request['seq']}).encode('UTF-8')
+            self.socket.send_multipart(envelope[:-1] + [reply])
+        self.socket.close()
+
+
 class LocalActuator:
-    def __init__(self):
+    def __init__(self, address):
         self.name = "TestActuator"
-        self.address = ("127.0.0.1", network.Bus.DefaultActuatorPort)
+        self.address = address
         self.remote = None
         self.reply = None
 
@@ -42,31 +95,62 @@ class LocalActuator:
             time.sleep(0.1)
 
 
+class LocalPipelinedActuator(LocalActuator):
+    def __init__(self, address):
+        super().__init__(address)
+        self.replies = []
+
+    def actuate(self, message: object):
+        self.remote.send_message(message)
+
+    def on_reply(self, reply: object):
+        self.replies.append(reply)
+
+    def wait_for_replies(self, count: int):
+        while len(self.replies) < count:
+            time.sleep(0.1)
+
+
 class FakeSensor:
-    def __init__(self):
-        self.ctx = zmq.Context()
+    def __init__(self, ctx=None, endpoint=None):
+        self.ctx = ctx or zmq.Context()
         self.socket = self.ctx.socket(zmq.PUB)
-        self.socket.bind("tcp://*:" + str(network.Bus.DefaultSensorPort))
+        self.port = bind(self.socket, endpoint)
+
+    def publish(self, data=None):
+        self.socket.send_json(data or {'some': 'data'})
 
-    def publish(self):
-        self.socket.send_json({'some': 'data'})
+    def publish_encoded(self, data, encoder):
+        self.socket.send(encoder.encode(data))
 
 
 class LocalSensor:
-    def __init__(self):
+    def __init__(self, address):
         self.name = "TestSensor"
-        self.address = ("127.0.0.1", network.Bus.DefaultSensorPort)
+        self.address = address
         self.message = None
 
     def on_message(self, message):
         self.message = message
 
 
+class LocalBatchSensor(LocalSensor):
+    def __init__(self, address):
+        super().__init__(address)
+        self.batches = []
+
+    def on_messages(self, messages):
+        self.batches.append(messages)
+
+    def received(self):
+        return [message for batch in self.batches for message in batch]
+
+
 class TestBus(TestCase):
     def test_add_actuator(self):
         remote = FakeActuator()
 
-        local = LocalActuator()
+        local = LocalActuator(("127.0.0.1", remote.port))
         local.remote = network.Actuator(local)
 
         bus = network.Bus(threading.Lock())
@@ -85,10 +169,183 @@ class TestBus(TestCase):
         bus.exit()
         bus.join()
 
+    def test_pipelined_actuator(self):
+        bus = network.Bus(threading.Lock())
+        remote = FakePipelinedActuator(3, bus.ctx, 'inproc://actuator')
+
+        local = LocalPipelinedActuator('inproc://actuator')
+        local.remote = network.Actuator(local, window=3)
+
+        bus.add_actuator(local.remote)
+        bus.start()
+
+        # All three requests must be in flight at once for the remote to answer.
+        for i in range(3):
+            local.actuate({'seq': i})
+        remote.wait_for_messages()
+        self.assertEqual(remote.requests, [{'seq': 0}, {'seq': 1}, {'seq': 2}])
+
+        # Replies were sent in reverse, but must be delivered in request order.
+        local.wait_for_replies(3)
+        self.assertEqual(local.replies, [{'seq': 0}, {'seq': 1}, {'seq': 2}])
+
+        bus.exit()
+        bus.join()
+
+    def test_pipelined_actuator_with_rep_peer(self):
+        bus = network.Bus(threading.Lock())
+        remote = FakeActuator(bus.ctx, 'inproc://actuator')
+
+        local = LocalActuator('inproc://actuator')
+        local.remote = network.Actuator(local, window=4)
+
+        bus.add_actuator(local.remote)
+        bus.start()
+
+        local.actuate({'hello': 'world'})
+        remote.wait_for_message()
+        self.assertEqual(remote.request, {'hello': 'world'})
+
+        local.wait_for_reply()
+        self.assertEqual(local.reply, {'hi': 'actuator'})
+
+        bus.exit()
+        bus.join()
+
+    def test_coalescing_actuator(self):
+        bus = network.Bus(threading.Lock())
+        remote = FakeSteppedActuator(bus.ctx, 'inproc://actuator')
+
+        local = LocalPipelinedActuator('inproc://actuator')
+        local.remote = network.Actuator(local, coalesce=True)
+
+        bus.add_actuator(local.remote)
+        bus.start()
+
+        # Put one message in flight, then pile up superseded messages behind it.
+        local.actuate({'target': 'a', 'type': 'set_state', 'state': 0})
+        remote.receive()
+        for i in range(1, 4):
+            local.actuate({'target': 'a', 'type': 'set_state', 'state': i})
+        local.actuate({'target': 'b', 'type': 'set_state', 'state': 0})
+        remote.reply()
+
+        remote.receive()
+        remote.reply()
+        remote.receive()
+        remote.reply()
+        local.wait_for_replies(3)
+        self.assertEqual(remote.requests, [{'target': 'a', 'type': 'set_state', 'state': 0},
+                                           {'target': 'a', 'type': 'set_state', 'state': 3},
+                                           {'target': 'b', 'type': 'set_state', 'state': 0}])
+        self.assertEqual(local.remote.coalesced_count, 2)
+        self.assertEqual(bus.coalesced_count, 2)
+
+        bus.exit()
+        bus.join()
+        remote.socket.close()
+
+    def test_actuator_reply_timeout(self):
+        bus = network.Bus(threading.Lock())
+        remote = FakeSteppedActuator(bus.ctx, 'inproc://actuator')
+
+        local = LocalActuator('inproc://actuator')
+        local.remote = network.Actuator(local, reply_timeout=0.2)
+
+        bus.add_actuator(local.remote)
+        bus.start()
+
+        # The remote swallows the first request, so the bus must give up on it.
+        local.actuate({'seq': 0})
+        remote.receive()
+        while local.remote.reconnect_count == 0:
+            time.sleep(0.1)
+        self.assertEqual(local.remote.lost_count, 1)
+        self.assertIsNone(local.reply)
+        remote.reply()
+
+        # The new socket works.
+        local.actuate({'seq': 1})
+        remote.receive()
+        remote.reply()
+        local.wait_for_reply()
+        self.assertEqual(local.reply, {'hi': 'actuator'})
+
+        stats = bus.device_stats()['TestActuator']
+        self.assertEqual(stats['reconnects'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertIsNotNone(stats['last_seen_ago'])
+
+        bus.exit()
+        bus.join()
+        remote.socket.close()
+
+    def test_heartbeats(self):
+        bus = network.Bus(threading.Lock())
+        remote_actuator = FakeSteppedActuator(bus.ctx, 'inproc://actuator')
+        remote_sensor = FakeSensor(bus.ctx, 'inproc://sensor')
+
+        local_actuator = LocalActuator('inproc://actuator')
+        local_actuator.remote = network.Actuator(local_actuator, heartbeat_interval=0.1)
+        local_sensor = LocalSensor('inproc://sensor')
+        local_sensor.remote = network.Sensor(local_sensor)
+
+        bus.add_actuator(local_actuator.remote)
+        bus.add_sensor(local_sensor.remote)
+        self.assertIsNone(bus.device_stats()['TestSensor']['last_seen_ago'])
+        bus.start()
+
+        # An idle actuator is pinged, and the reply is not passed on.
+        remote_actuator.receive()
+        self.assertEqual(remote_actuator.requests, [network.Actuator.HeartbeatMessage])
+        remote_actuator.reply()
+        while local_actuator.remote.last_seen is None:
+            time.sleep(0.1)
+        self.assertIsNone(local_actuator.reply)
+
+        # Sensor heartbeats keep the sensor alive but are not passed on.
+        while local_sensor.remote.heartbeat_count == 0:
+            remote_sensor.publish({'type': 'heartbeat'})
+            time.sleep(0.1)
+        self.assertIsNone(local_sensor.message)
+        self.assertIsNotNone(bus.device_stats()['TestSensor']['last_seen_ago'])
+
+        bus.exit()
+        bus.join()
+        remote_actuator.socket.close()
+
+    def test_actuator_codec_follows_replies(self):
+        bus = network.Bus(threading.Lock())
+        remote = bus.ctx.socket(zmq.REP)
+        remote.bind('inproc://actuator')
+
+        local = LocalPipelinedActuator('inproc://actuator')
+        local.remote = network.Actuator(local, codecs=('nerve', 'json'))
+        bus.add_actuator(local.remote)
+        bus.start()
+
+        # Until the remote shows it can read the nerve codec, we must send JSON.
+        local.actuate({'seq': 0})
+        self.assertIs(codec.codec_of(remote.recv()), codec.JsonCodec)
+        remote.send(codec.NerveCodec.encode({'seq': 0}))
+        local.wait_for_replies(1)
+
+        local.actuate({'seq': 1})
+        data = remote.recv()
+        self.assertIs(codec.codec_of(data), codec.NerveCodec)
+        self.assertEqual(codec.decode(data), {'seq': 1})
+        remote.send(codec.NerveCodec.encode({'seq': 1}))
+        local.wait_for_replies(2)
+        self.assertEqual(local.replies, [{'seq': 0}, {'seq': 1}])
+
+        bus.exit()
+        bus.join()
+        remote.close()
+
     def test_add_sensor(self):
         remote = FakeSensor()
 
-        local = LocalSensor()
+        local = LocalSensor(("127.0.0.1", remote.port))
         local.remote = network.Sensor(local)
 
         bus = network.Bus(threading.Lock())
@@ -103,14 +360,106 @@ class TestBus(TestCase):
         bus.exit()
         bus.join()
 
+    def test_sensor_batches(self):
+        bus = network.Bus(threading.Lock())
+        remote = FakeSensor(bus.ctx, 'inproc://sensor')
+
+        local = LocalBatchSensor('inproc://sensor')
+        local.remote = network.Sensor(local)
+
+        bus.SensorBatchBudget = 4
+        bus.add_sensor(local.remote)
+        bus.start()
+
+        # Pump until the subscription is live.
+        while not local.batches:
+            remote.publish({'seq': -1})
+            time.sleep(0.1)
+        local.batches = []
+
+        for i in range(10):
+            remote.publish({'seq': i})
+        while len(local.received()) < 10:
+            time.sleep(0.1)
+
+        bus.exit()
+        bus.join()
+
+        self.assertEqual([m['seq'] for m in local.received() if m['seq'] >= 0], list(range(10)))
+        self.assertTrue(all(len(batch) <= 4 for batch in local.batches))
+        self.assertGreaterEqual(len(local.batches), 3)
+
+    def test_sensor_rate_limit(self):
+        bus = network.Bus(threading.Lock())
+        publisher = bus.bind_local('inproc://local-sensor')
+
+        local = LocalBatchSensor('inproc://local-sensor')
+        local.remote = network.Sensor(local, rate=0.1, burst=2)
+        bus.add_sensor(local.remote)
+        bus.start()
+
+        for i in range(10):
+            publisher.send({'type': 'MOVEMENT', 'seq': i})
+        while local.remote.shed_count < 8:
+            time.sleep(0.1)
+        self.assertEqual([m['seq'] for m in local.received()], [0, 1])
+        self.assertEqual(bus.device_stats()['TestSensor']['shed'], 8)
+
+        bus.exit()
+        bus.join()
+        publisher.close()
+
+    def test_sensor_rate_limit_merge(self):
+        bus = network.Bus(threading.Lock())
+        publisher = bus.bind_local('inproc://local-sensor')
+
+        local = LocalBatchSensor('inproc://local-sensor')
+        local.remote = network.Sensor(local, rate=5, burst=1, shed='merge')
+        bus.add_sensor(local.remote)
+        bus.start()
+
+        for i in range(5):
+            publisher.send({'type': 'MOVEMENT', 'seq': i})
+        publisher.send({'type': 'TEMP_HUMIDITY', 'seq': 5})
+        publisher.send({'type': 'MOVEMENT', 'seq': 6})
+
+        # The first message goes straight through; the latest of each type follows in arrival order.
+        while len(local.received()) < 3:
+            time.sleep(0.1)
+        self.assertEqual([m['seq'] for m in local.received()], [0, 5, 6])
+        self.assertEqual(local.remote.shed_count, 4)
+
+        bus.exit()
+        bus.join()
+        publisher.close()
+
+    def test_sensor_codecs(self):
+        bus = network.Bus(threading.Lock())
+        remote = FakeSensor(bus.ctx, 'inproc://sensor')
+
+        local = LocalSensor('inproc://sensor')
+        local.remote = network.Sensor(local)
+
+        bus.add_sensor(local.remote)
+        bus.start()
+
+        message = {'type': 'TEMP_HUMIDITY', 'temp': 20.5, 'humidity': 45.0}
+        while local.message is None:
+            remote.publish_encoded(message, codec.NerveCodec)
+            time.sleep(0.1)
+        self.assertEqual(local.message, message)
+
+        bus.exit()
+        bus.join()
+
     def test_add_device(self):
         remote_sensor = FakeSensor()
         remote_actuator = FakeActuator()
 
-        local_sensor = LocalSensor()
+        local_sensor = LocalSensor(("127.0.0.1", remote_sensor.port))
         local_sensor.remote = network.Sensor(local_sensor)
 
-        local_actuator = LocalActuator()
+        local_actuator = LocalActuator(("127.0.0.1", remote_actuator.port))
         local_actuator.remote = network.Actuator(local_actuator)
 
         bus = network.Bus(threading.Lock())
@@ -135,6 +484,111 @@ class TestBus(TestCase):
         bus.exit()
         bus.join()
 
+    def test_ipc_devices(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sensor_endpoint = 'ipc://' + os.path.join(tmpdir, 'sensor')
+            actuator_endpoint = 'ipc://' + os.path.join(tmpdir, 'actuator')
+            remote_sensor = FakeSensor(endpoint=sensor_endpoint)
+            remote_actuator = FakeActuator(endpoint=actuator_endpoint)
+
+            local_sensor = LocalSensor(sensor_endpoint)
+            local_sensor.remote = network.Sensor(local_sensor)
+
+            local_actuator = LocalActuator(actuator_endpoint)
+            local_actuator.remote = network.Actuator(local_actuator)
+
+            bus = network.Bus(threading.Lock())
+            bus.add_device(local_sensor.remote)
+            bus.add_device(local_actuator.remote)
+            bus.start()
+
+            while local_sensor.message is None:
+                remote_sensor.publish()
+                time.sleep(0.1)
+            self.assertEqual(local_sensor.message, {'some': 'data'})
+
+            local_actuator.actuate({'hello': 'world'})
+            remote_actuator.wait_for_message()
+            self.assertEqual(remote_actuator.request, {'hello': 'world'})
+            local_actuator.wait_for_reply()
+            self.assertEqual(local_actuator.reply, {'hi': 'actuator'})
+
+            bus.exit()
+            bus.join()
+            remote_sensor.socket.close()
+
+    def test_sensor_shard(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sensor_endpoint = 'ipc://' + os.path.join(tmpdir, 'sensor')
+            remote = FakeSensor(endpoint=sensor_endpoint)
+
+            local = LocalBatchSensor(sensor_endpoint)
+            local.remote = network.Sensor(local)
+            shard = SensorShard('test', 'ipc://' + os.path.join(tmpdir, 'shard'))
+            shard.add_sensor(local.remote)
+
+            bus = network.Bus(threading.Lock())
+            bus.add_shard(shard)
+            self.assertTrue(shard.is_alive)
+            bus.start()
+
+            # Messages are decoded in the worker and arrive here intact; heartbeats stay there.
+            while not local.batches:
+                remote.publish({'type': 'heartbeat'})
+                remote.publish({'type': 'TEMP_HUMIDITY', 'temp': 20.5, 'humidity': 45.0})
+                time.sleep(0.1)
+            self.assertEqual(local.received()[0], {'type': 'TEMP_HUMIDITY', 'temp': 20.5, 'humidity': 45.0})
+            self.assertFalse(any(message['type'] == 'heartbeat' for message in local.received()))
+            while local.remote.heartbeat_count == 0:
+                remote.publish({'type': 'heartbeat'})
+                time.sleep(0.1)
+            self.assertIsNotNone(bus.device_stats()['TestSensor']['last_seen_ago'])
+
+            bus.exit()
+            bus.join()
+            self.assertFalse(shard.is_alive)
+            remote.socket.close()
+
+    def test_local_publisher(self):
+        bus = network.Bus(threading.Lock())
+        publisher = bus.bind_local('inproc://local-sensor')
+
+        local = LocalBatchSensor('inproc://local-sensor')
+        local.remote = network.Sensor(local)
+        bus.add_sensor(local.remote)
+        bus.start()
+
+        # Messages are passed by reference, so even objects with no wire format arrive intact.
+        messages = [{'seq': i, 'payload': object()} for i in range(5)]
+        for message in messages:
+            publisher.send(message)
+        while len(local.received()) < len(messages):
+            time.sleep(0.1)
+        for sent, received in zip(messages, local.received()):
+            self.assertIs(sent, received)
+
+        bus.exit()
+        bus.join()
+        publisher.close()
+
+    def test_unsupported_address(self):
+        bus = network.Bus(threading.Lock())
+        local = LocalSensor('udp://127.0.0.1:1234')
+        self.assertRaises(ValueError, lambda: bus.add_sensor(network.Sensor(local)))
+        bus.cleanup()
+
+    def test_local_publisher_without_sensor(self):
+        bus = network.Bus(threading.Lock())
+        publisher = bus.bind_local('inproc://local-sensor')
+
+        # Nobody is listening, so sending must drop rather than block.
+        self.assertFalse(publisher.send({'seq': 0}))
+        self.assertEqual(publisher.dropped_count, 1)
+        self.assertEqual(len(publisher.queue_), 0)
+
+        publisher.close()
+        bus.cleanup()
+
     def test_run(self):
         bus = network.Bus(threading.Lock())
         bus.start()
@@ -0,0 +1,172 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+import tempfile
+import threading
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from mcp.animation import AnimationController, CallbackAnimation, LinearAnimation
+from mcp.clock import Clock, NanosPerSecond, VirtualClock, system_clock, to_ns
+from mcp.cronish import Cronish
+from mcp.scheduler import Scheduler
+
+
+class ManualClock(Clock):
+    def __init__(self, wall: datetime):
+        self.monotonic_ = 5 * NanosPerSecond
+        self.wall_ = int(wall.timestamp() * NanosPerSecond)
+
+    def monotonic_ns(self) -> int:
+        return self.monotonic_
+
+    def time_ns(self) -> int:
+        return self.wall_
+
+    def advance(self, delta: timedelta):
+        self.monotonic_ += to_ns(delta)
+        self.wall_ += to_ns(delta)
+
+
+class TestClock(TestCase):
+    def test_to_ns(self):
+        self.assertEqual(to_ns(timedelta(seconds=1)), NanosPerSecond)
+        self.assertEqual(to_ns(timedelta(microseconds=-3)), -3000)
+        self.assertEqual(to_ns(timedelta(days=1, milliseconds=1)), 86400 * NanosPerSecond + 1000000)
+
+    def test_system_clock(self):
+        first = system_clock.monotonic_ns()
+        self.assertLessEqual(first, system_clock.monotonic_ns())
+        self.assertLess(abs(system_clock.now() - datetime.now()), timedelta(seconds=1))
+
+    def test_to_wall(self):
+        clock = ManualClock(datetime(2016, 3, 1, 7, 30))
+        later = clock.monotonic_ns() + to_ns(timedelta(minutes=5))
+        self.assertEqual(clock.to_wall(later), datetime(2016, 3, 1, 7, 35))
+
+        # Stepping the wall clock moves where deadlines land, not the deadlines themselves.
+        clock.wall_ += to_ns(timedelta(hours=1))
+        self.assertEqual(clock.to_wall(later), datetime(2016, 3, 1, 8, 35))
+
+    def test_scheduler_deadline(self):
+        clock = ManualClock(datetime(2016, 3, 1, 7, 30))
+        scheduler = Scheduler(threading.Lock(), clock=clock)
+        timer = scheduler.set_timeout(timedelta(seconds=90), lambda: None)
+        self.assertEqual(timer.deadline, datetime(2016, 3, 1, 7, 31, 30))
+
+    def test_cronish_offset(self):
+        clock = ManualClock(datetime(2016, 3, 1, 23, 59))
+        cronish = Cronish(tempfile.mkdtemp(), threading.Lock(), clock=clock)
+        cronish.register_task('foo', lambda: None)
+        cronish.schedule_at_offset('foo', timedelta(minutes=2))
+        self.assertEqual(cronish.get_task('foo').once, datetime(2016, 3, 2, 0, 1))
+
+    def test_linear_animation(self):
+        clock = ManualClock(datetime(2016, 3, 1, 7, 30))
+        animator = AnimationController(1, threading.Lock(), clock=clock)
+        values = []
+        finished = []
+        animation = LinearAnimation(0, 10, 10, values.append, lambda: finished.append(True))
+        animator.animate(animation)
+
+        # Time starts when the animation first runs.
+        clock.advance(timedelta(seconds=30))
+        animator._apply_animation()
+        clock.advance(timedelta(seconds=4))
+        animator._apply_animation()
+        clock.advance(timedelta(seconds=6))
+        animator._apply_animation()
+        self.assertEqual(values, [0, 4, 10])
+        self.assertEqual(finished, [True])
+
+
+class TestVirtualClock(TestCase):
+    def simulate_day(self) -> [(datetime, str)]:
+        """
+        A day of wakeup and bedtime alarms, a fade, motion-driven presence timeouts
+        and a periodic poll, in the shape that Eyrie wires them up.
+        """
+        clock = VirtualClock(datetime(2016, 3, 1, 0, 0))
+        lock = threading.Lock()
+        scheduler = clock.attach(Scheduler(lock, clock=clock))
+        cronish = clock.attach(Cronish(tempfile.mkdtemp(), lock, clock=clock))
+        animator = clock.attach(AnimationController(2, lock, clock=clock))
+        log = []
+
+        def record(what: str):
+            log.append((clock.now(), what))
+
+        def wakeup():
+            record('wakeup')
+            animator.animate(LinearAnimation(0, 10, 60, lambda v: None, lambda: record('faded')))
+        cronish.register_task('wakeup', wakeup)
+        cronish.update_task_time('wakeup', {1}, {7}, {30})
+        cronish.register_task('bedtime', lambda: record('bedtime'))
+        cronish.update_task_time('bedtime', {1}, {23}, {0})
+
+        def timeout_presence():
+            record('away')
+            cronish.unschedule_task('presence')
+        cronish.register_task('presence', timeout_presence)
+        cronish.unschedule_task('presence')
+
+        def motion():
+            record('motion')
+            cronish.schedule_at_offset('presence', timedelta(minutes=5))
+        for hour, minute in ((8, 0), (8, 2), (18, 45)):
+            delay = datetime(2016, 3, 1, hour, minute) - clock.now()
+            scheduler.set_timeout(delay, motion)
+
+        polls = 0
+        def poll():
+            nonlocal polls
+            polls += 1
+            scheduler.set_timeout(timedelta(minutes=10), poll)
+        scheduler.set_timeout(timedelta(minutes=10), poll)
+
+        clock.advance(timedelta(days=1))
+        record('polls {}'.format(polls))
+        return log
+
+    def test_day(self):
+        log = self.simulate_day()
+        t = lambda hour, minute, second=0: datetime(2016, 3, 1, hour, minute, second)
+        self.assertEqual(log, [
+            (t(7, 30), 'wakeup'),
+            (t(7, 31), 'faded'),
+            (t(8, 0), 'motion'),
+            (t(8, 2), 'motion'),
+            (t(8, 7), 'away'),
+            (t(18, 45), 'motion'),
+            (t(18, 50), 'away'),
+            (t(23, 0), 'bedtime'),
+            (datetime(2016, 3, 2), 'polls 144'),
+        ])
+
+        # The same inputs always play out the same way.
+        self.assertEqual(self.simulate_day(), log)
+
+    def test_ties_run_in_attach_order(self):
+        clock = VirtualClock(datetime(2016, 3, 1))
+        lock = threading.Lock()
+        log = []
+        schedulers = [clock.attach(Scheduler(lock, clock=clock)) for _ in range(3)]
+        for i, scheduler in reversed(list(enumerate(schedulers))):
+            scheduler.set_timeout(timedelta(seconds=1), lambda i=i: log.append(i))
+        clock.advance(timedelta(seconds=1))
+        self.assertEqual(log, [0, 1, 2])
+        self.assertEqual(clock.monotonic_ns(), NanosPerSecond)
+
+    def test_callback_animation(self):
+        clock = VirtualClock(datetime(2016, 3, 1))
+        animator = clock.attach(AnimationController(0.5, threading.Lock(), clock=clock))
+        count = 0
+        def callback():
+            nonlocal count
+            count += 1
+            return count < 4
+        animator.animate(CallbackAnimation(callback))
+        clock.advance(timedelta(seconds=10))
+        self.assertEqual(count, 4)
+        self.assertIsNone(animator.next_wakeup_ns())
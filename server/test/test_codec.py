@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+from unittest import TestCase, skipUnless
+
+from mcp import codec
+
+
+class TestCodec(TestCase):
+    Messages = [
+        {'type': 'TEMP_HUMIDITY', 'temp': 21.5, 'humidity': 40.25},
+        {'type': 'MOVEMENT', 'state': True},
+        {'type': 'MOVEMENT', 'state': False},
+        {'command': 'auto:daytime'},
+        {'target': 'wemoswitch-office-fountain', 'type': 'set_state', 'state': True},
+    ]
+
+    def test_json_is_untagged(self):
+        for message in self.Messages:
+            data = codec.JsonCodec.encode(message)
+            self.assertNotEqual(data[0], codec.TagMarker)
+            self.assertEqual(message, codec.decode(data))
+
+    def test_nerve(self):
+        for message in self.Messages:
+            data = codec.NerveCodec.encode(message)
+            self.assertEqual(data[:2], bytes((codec.TagMarker, codec.NerveCodec.tag)))
+            self.assertEqual(message, codec.decode(data))
+
+        # The fixed layouts must be much smaller than the JSON text.
+        message = self.Messages[0]
+        self.assertLess(len(codec.NerveCodec.encode(message)), len(codec.JsonCodec.encode(message)) // 2)
+
+    @skipUnless(codec.is_available('msgpack'), "msgpack is not installed")
+    def test_msgpack(self):
+        for message in self.Messages:
+            data = codec.MsgpackCodec.encode(message)
+            self.assertEqual(message, codec.decode(memoryview(data)))
+
+    def test_negotiate(self):
+        self.assertIs(codec.JsonCodec, codec.negotiate('json'))
+        self.assertIs(codec.NerveCodec, codec.negotiate(['nerve', 'json']))
+        expect = codec.MsgpackCodec if codec.is_available('msgpack') else codec.NerveCodec
+        self.assertIs(expect, codec.negotiate(['msgpack', 'nerve']))
+        self.assertRaises(codec.CodecError, lambda: codec.negotiate(['carrier-pigeon']))
+
+    def test_unknown_tag(self):
+        self.assertRaises(codec.CodecError, lambda: codec.decode(bytes((codec.TagMarker, 255))))
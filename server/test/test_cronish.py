@@ -1,11 +1,13 @@
+import json
+import os.path
 import tempfile
 import threading
-import time
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from mcp.cronish import Cronish
+from mcp.clock import VirtualClock
+from mcp.cronish import Cronish, _Task
 
 
 class TestCronish(TestCase):
@@ -37,21 +39,232 @@ class TestCronish(TestCase):
         cronish.register_task('foo', call_foo)
         cronish.update_task_time('foo', days_of_week={0}, hours={0}, minutes={0})
 
-    def _test_calls_task_once(self):
-        """Disabled by default as can take up to a minute."""
-        cronish = Cronish(tempfile.gettempdir(), threading.Lock())
+    def test_calls_task_once(self):
+        clock = VirtualClock(datetime(2016, 3, 1, 7, 29, 40))
+        cronish = clock.attach(Cronish(tempfile.mkdtemp(), threading.Lock(), clock=clock))
 
         foo_calls = 0
         def call_foo():
             nonlocal foo_calls
             foo_calls += 1
-        now = datetime.now()
+        now = clock.now()
         cronish.register_task('foo', call_foo)
         cronish.update_task_time('foo', days_of_week={now.weekday()}, hours={now.hour}, minutes={(now.minute + 1) % 60})
 
+        clock.advance(timedelta(minutes=3))
+
+        self.assertEqual(foo_calls, 1)
+
+    def test_next_run_after(self):
+        task = _Task('foo')
+        self.assertIsNone(task.next_run_after(datetime(2016, 3, 1, 7, 0)))
+
+        # Tuesdays and Thursdays at 7:30 and 22:05.
+        task.set_time({1, 3}, {7, 22}, {5, 30})
+        self.assertEqual(task.next_run_after(datetime(2016, 3, 1, 7, 0)), datetime(2016, 3, 1, 7, 5))
+        self.assertEqual(task.next_run_after(datetime(2016, 3, 1, 7, 5)), datetime(2016, 3, 1, 7, 30))
+        self.assertEqual(task.next_run_after(datetime(2016, 3, 1, 7, 5, 59)), datetime(2016, 3, 1, 7, 30))
+        self.assertEqual(task.next_run_after(datetime(2016, 3, 1, 22, 30)), datetime(2016, 3, 3, 7, 5))
+        self.assertEqual(task.next_run_after(datetime(2016, 3, 3, 23, 0)), datetime(2016, 3, 8, 7, 5))
+
+    def test_sleeps_until_next_task(self):
+        clock = VirtualClock(datetime(2016, 3, 1, 7, 0, 30))
+        cronish = Cronish(tempfile.mkdtemp(), threading.Lock(), clock=clock)
+        self.assertIsNone(cronish.next_wakeup_ns())
+
+        calls = []
+        cronish.register_task('foo', lambda: calls.append(clock.now()))
+        cronish.register_task('bar', lambda: calls.append(clock.now()))
+        cronish.update_task_time('foo', {1}, {9}, {0})
+        cronish.update_task_time('bar', {1}, {8}, {15})
+        cronish.flush()
+        self.assertEqual(clock.to_wall(cronish.next_wakeup_ns()), datetime(2016, 3, 1, 8, 15))
+
+        # Changing a task's time replaces its old entry.
+        cronish.update_task_time('bar', {1}, {9}, {30})
+        cronish.flush()
+        self.assertEqual(clock.to_wall(cronish.next_wakeup_ns()), datetime(2016, 3, 1, 9, 0))
+
+        clock.attach(cronish)
+        clock.advance(timedelta(hours=3))
+        self.assertEqual(calls, [datetime(2016, 3, 1, 9, 0), datetime(2016, 3, 1, 9, 30)])
+        self.assertEqual(clock.to_wall(cronish.next_wakeup_ns()), datetime(2016, 3, 8, 9, 0))
+
+    def test_journal(self):
+        path = tempfile.mkdtemp()
+        clock = VirtualClock(datetime(2016, 3, 1, 7, 0))
+        cronish = clock.attach(Cronish(path, threading.Lock(), clock=clock))
+        cronish.register_task('foo', lambda: None)
+        cronish.register_task('bar', lambda: None)
+
+        # A burst of changes is coalesced, and nothing is written until the flush window passes.
+        for minute in range(10):
+            cronish.update_task_time('foo', {1}, {8}, {minute})
+        cronish.update_task_time('bar', {2}, {9}, {30})
+        journal = os.path.join(path, 'crontab.journal')
+        self.assertFalse(os.path.exists(journal))
+        clock.advance(Cronish.FlushWindow)
+        with open(journal) as fp:
+            self.assertEqual(len(fp.readlines()), 2)
+
+        # A restart sees the snapshot plus the journal, folded into a new snapshot.
+        cronish.update_task_time('foo', {3}, {10}, {45})
+        cronish.flush()
+        with open(journal, 'a') as fp:
+            fp.write('["foo", {"days_of')  # Torn by a crash.
+        reloaded = Cronish(path, threading.Lock(), clock=clock)
+        task = reloaded.get_task('foo')
+        self.assertEqual((task.days_of_week, task.hours, task.minutes), ({3}, {10}, {45}))
+        task = reloaded.get_task('bar')
+        self.assertEqual((task.days_of_week, task.hours, task.minutes), ({2}, {9}, {30}))
+        self.assertEqual(os.path.getsize(journal), 0)
+        with open(os.path.join(path, 'crontab.json')) as fp:
+            self.assertEqual(json.load(fp)['foo'], {'days_of_week': [3], 'hours': [10], 'minutes': [45], 'seconds': [0],
+                                                    'once': None, 'last_run': None})
+
+    def test_journal_compaction(self):
+        path = tempfile.mkdtemp()
+        cronish = Cronish(path, threading.Lock())
+        cronish.register_task('foo', lambda: None)
+        for i in range(Cronish.CompactionThreshold):
+            cronish.update_task_time('foo', {i % 7}, {0}, {0})
+            cronish.flush()
+        self.assertEqual(os.path.getsize(os.path.join(path, 'crontab.journal')), 0)
+        self.assertEqual(Cronish(path, threading.Lock()).get_task('foo').days_of_week,
+                         {(Cronish.CompactionThreshold - 1) % 7})
+
+    def test_flush_on_exit(self):
+        path = tempfile.mkdtemp()
+        cronish = Cronish(path, threading.Lock())
         cronish.start()
-        time.sleep(60)
+        cronish.register_task('foo', lambda: None)
+        cronish.update_task_time('foo', {0}, {1}, {2})
         cronish.exit()
         cronish.join()
+        self.assertEqual(Cronish(path, threading.Lock()).get_task('foo').hours, {1})
 
-        self.assertEqual(foo_calls, 1)
+    def test_one_shot(self):
+        clock = VirtualClock(datetime(2016, 3, 1, 7, 0, 10))
+        cronish = clock.attach(Cronish(tempfile.mkdtemp(), threading.Lock(), clock=clock))
+        calls = []
+        cronish.register_task('foo', lambda: calls.append(clock.now()))
+
+        # Offsets are honoured to the second, not rounded to a minute.
+        cronish.schedule_at_offset('foo', timedelta(seconds=95))
+        self.assertEqual(cronish.get_task('foo').once, datetime(2016, 3, 1, 7, 1, 45))
+        clock.advance(timedelta(days=8))
+        self.assertEqual(calls, [datetime(2016, 3, 1, 7, 1, 45)])
+        self.assertIsNone(cronish.get_task('foo').once)
+
+    def test_seconds(self):
+        clock = VirtualClock(datetime(2016, 3, 1, 7, 0, 10))
+        cronish = clock.attach(Cronish(tempfile.mkdtemp(), threading.Lock(), clock=clock))
+        calls = []
+        cronish.register_task('foo', lambda: calls.append(clock.now()))
+        cronish.update_task_time('foo', {1}, {7}, {0, 1}, seconds={0, 30})
+        clock.advance(timedelta(minutes=3))
+        self.assertEqual(calls, [datetime(2016, 3, 1, 7, 0, 30), datetime(2016, 3, 1, 7, 1, 0),
+                                 datetime(2016, 3, 1, 7, 1, 30)])
+
+    def test_persist_one_shot(self):
+        path = tempfile.mkdtemp()
+        with open(os.path.join(path, 'crontab.json'), 'w') as fp:
+            json.dump({'old': {'days_of_week': [1], 'hours': [7], 'minutes': [30]}}, fp)
+        cronish = Cronish(path, threading.Lock())
+        self.assertEqual(cronish.get_task('old').seconds, {0})
+        cronish.register_task('foo', lambda: None)
+        cronish.schedule_once('foo', datetime(2016, 3, 1, 7, 0, 10, 500))
+        cronish.flush()
+
+        task = Cronish(path, threading.Lock()).get_task('foo')
+        self.assertEqual(task.once, datetime(2016, 3, 1, 7, 0, 10))
+        self.assertEqual(task.next_run_after(datetime(2016, 3, 2)), datetime(2016, 3, 1, 7, 0, 10))
+
+    def make_stalled_(self, catch_up: str):
+        # A task every ten minutes, and a half-hour stall before the scheduler next gets to run.
+        clock = VirtualClock(datetime(2016, 3, 1, 7, 0, 30))
+        cronish = Cronish(tempfile.mkdtemp(), threading.Lock(), clock=clock)
+        calls = []
+        cronish.register_task('foo', lambda: calls.append(clock.now()), catch_up=catch_up)
+        cronish.update_task_time('foo', days_of_week=set(range(7)), hours=set(range(24)), minutes={0, 10, 20, 30, 40, 50})
+        clock.advance(timedelta(minutes=35))
+        cronish.run_due()
+        return clock, cronish, calls
+
+    def test_catch_up_skip(self):
+        clock, cronish, calls = self.make_stalled_('skip')
+        self.assertEqual(calls, [])
+        self.assertEqual(cronish.task_stats()['foo'].skipped, 1)
+
+        # Runs on time pick up as normal.
+        clock.advance(timedelta(minutes=4, seconds=30))
+        cronish.run_due()
+        self.assertEqual(calls, [datetime(2016, 3, 1, 7, 40)])
+
+    def test_catch_up_once(self):
+        clock, cronish, calls = self.make_stalled_('once')
+        self.assertEqual(calls, [datetime(2016, 3, 1, 7, 35, 30)])
+        self.assertEqual(cronish.get_task('foo').last_run, datetime(2016, 3, 1, 7, 35, 30))
+        self.assertEqual(cronish.get_task('foo').entry_.time, datetime(2016, 3, 1, 7, 40))
+
+    def test_catch_up_all(self):
+        clock, cronish, calls = self.make_stalled_('all')
+        self.assertEqual(calls, [datetime(2016, 3, 1, 7, 35, 30)] * 3)
+        self.assertEqual(cronish.get_task('foo').last_run, datetime(2016, 3, 1, 7, 30))
+
+    def test_lateness_stats(self):
+        clock, cronish, calls = self.make_stalled_('all')
+        stats = cronish.task_stats()['foo']
+        self.assertEqual((stats.runs, stats.skipped), (3, 0))
+        self.assertEqual(stats.max_lateness, 25 * 60 + 30)
+        self.assertEqual(stats.last_lateness, 5 * 60 + 30)
+        self.assertEqual(stats.mean_lateness, 15 * 60 + 30)
+
+    def test_catch_up_after_restart(self):
+        path = tempfile.mkdtemp()
+        clock = VirtualClock(datetime(2016, 3, 1, 7, 0, 30))
+        cronish = clock.attach(Cronish(path, threading.Lock(), clock=clock))
+        cronish.register_task('foo', lambda: None)
+        cronish.update_task_time('foo', days_of_week=set(range(7)), hours=set(range(24)), minutes={0, 10, 20, 30, 40, 50})
+        clock.advance(timedelta(minutes=10))
+        cronish.flush()
+
+        # Down from 7:10:30 until 7:35:30: the runs at 7:20 and 7:30 were missed.
+        for catch_up, expect in (('once', 1), ('all', 2)):
+            clock = VirtualClock(datetime(2016, 3, 1, 7, 35, 30))
+            reloaded = Cronish(path, threading.Lock(), clock=clock)
+            self.assertEqual(reloaded.get_task('foo').last_run, datetime(2016, 3, 1, 7, 10))
+            calls = []
+            reloaded.register_task('foo', lambda: calls.append(clock.now()), catch_up=catch_up)
+            reloaded.run_due()
+            self.assertEqual(len(calls), expect)
+
+    def test_slack(self):
+        clock = VirtualClock(datetime(2016, 3, 1, 7, 0, 0))
+        cronish = clock.attach(Cronish(tempfile.mkdtemp(), threading.Lock(), clock=clock))
+        calls = []
+        cronish.register_task('foo', lambda: calls.append(('foo', clock.now())), slack=timedelta(seconds=5))
+        cronish.register_task('bar', lambda: calls.append(('bar', clock.now())))
+        cronish.schedule_at_offset('foo', timedelta(seconds=10))
+        cronish.schedule_at_offset('bar', timedelta(seconds=12))
+        clock.advance(timedelta(minutes=1))
+        self.assertEqual(calls, [('foo', datetime(2016, 3, 1, 7, 0, 12)), ('bar', datetime(2016, 3, 1, 7, 0, 12))])
+        self.assertEqual(cronish.wakeups_saved, 1)
+
+    def test_missed_alarm_after_restart(self):
+        # An alarm last run yesterday at 7:00, when we were down for today's, must not go off hours late.
+        path = tempfile.mkdtemp()
+        clock = VirtualClock(datetime(2016, 3, 1, 6, 59, 30))
+        cronish = clock.attach(Cronish(path, threading.Lock(), clock=clock))
+        cronish.register_task('alarm', lambda: None)
+        cronish.update_task_time('alarm', days_of_week=set(range(7)), hours={7}, minutes={0})
+        clock.advance(timedelta(minutes=1))
+        cronish.flush()
+
+        clock = VirtualClock(datetime(2016, 3, 2, 15, 0, 0))
+        reloaded = clock.attach(Cronish(path, threading.Lock(), clock=clock))
+        calls = []
+        reloaded.register_task('alarm', lambda: calls.append(clock.now()))
+        clock.advance(timedelta(hours=20))
+        self.assertEqual(calls, [datetime(2016, 3, 3, 7, 0)])
+        self.assertEqual(reloaded.task_stats()['alarm'].skipped, 1)
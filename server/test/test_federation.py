@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+from datetime import datetime
+from unittest import TestCase
+from mcp.abode import Abode
+from mcp.dimension import Coord, Size
+from mcp.federation import FederationNode
+import threading
+import time
+import zmq
+
+
+def build_abode():
+    abode = Abode('test')
+    for name in ('upstairs', 'downstairs'):
+        floor = abode.create_room(name, Coord(0, 0), Size(10, 10, 8))
+        floor.create_subarea('closet', Coord(0, 0), Size(2, 2, 8))
+    return abode
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+class TestFederation(TestCase):
+    def setUp(self):
+        self.ctx = zmq.Context()
+        self.lock = threading.Lock()
+        self.up_abode, self.down_abode = build_abode(), build_abode()
+        self.up = FederationNode(self.up_abode, 'up', ['/test/upstairs'], 'inproc://up', [], self.lock, self.ctx)
+        self.down = FederationNode(self.down_abode, 'down', ['/test/downstairs'], 'inproc://down', ['inproc://up'],
+                                   self.lock, self.ctx)
+        self.up.sub_socket.connect('inproc://down')
+
+    def tearDown(self):
+        for node in (self.up, self.down):
+            node.exit()
+            node.join()
+        self.ctx.term()
+
+    def start(self):
+        for node in (self.up, self.down):
+            node.SnapshotInterval = 0.2
+            node.start()
+        # Wait for the first snapshots to show that both subscriptions are live.
+        wait_for(lambda: len(self.up.version_vector()) == 2 and len(self.down.version_vector()) == 2)
+
+    def test_replicate(self):
+        self.start()
+        changes = []
+        self.down_abode.lookup('/test/upstairs/closet').listen('temperature', 'propertyChanged',
+                                                               lambda event: changes.append(event.property_value))
+
+        with self.lock:
+            self.up_abode.lookup('/test/upstairs/closet').set('temperature', 21)
+        wait_for(lambda: changes == [21])
+        self.assertEqual(self.down_abode.lookup('/test/upstairs/closet').get('temperature'), 21)
+
+        # Changes to areas we do not own are not echoed back.
+        with self.lock:
+            self.down_abode.lookup('/test/upstairs').set('rogue', True)
+            self.down_abode.lookup('/test/downstairs').set('humidity', 40)
+        wait_for(lambda: 'humidity' in self.up_abode.lookup('/test/downstairs').property_names())
+        self.assertNotIn('rogue', self.up_abode.lookup('/test/upstairs').property_names())
+
+    def test_batching(self):
+        self.up.BatchInterval = 0.5
+        self.start()
+        changes = []
+        self.down_abode.lookup('/test/upstairs').listen('motion', 'propertyChanged',
+                                                        lambda event: changes.append(event.property_value))
+        sent = self.up.changes_sent
+        with self.lock:
+            for i in range(100):
+                self.up_abode.lookup('/test/upstairs').set('motion', i)
+        wait_for(lambda: changes and changes[-1] == 99)
+        self.assertLess(len(changes), 100)
+        self.assertLess(self.up.changes_sent - sent, 100)
+
+    def test_catch_up_from_snapshot(self):
+        # Changes made before anyone is listening are lost, then recovered.
+        self.up.SnapshotInterval = 0.2
+        self.up_abode.lookup('/test/upstairs').set('early', 'bird')
+        self.up.start()
+        self.down.start()
+        wait_for(lambda: 'early' in self.down_abode.lookup('/test/upstairs').property_names())
+        self.assertEqual(self.down_abode.lookup('/test/upstairs').get('early'), 'bird')
+        self.assertGreaterEqual(self.down.version_vector()['up'], 1)
+
+    def test_unencodable_values(self):
+        # A value the codec cannot carry must not hold up the rest of the batch or snapshot.
+        seen = datetime(2016, 3, 1, 7, 30)
+        with self.lock:
+            closet = self.up_abode.lookup('/test/upstairs/closet')
+            closet.set('last_detected_humans', seen)
+            closet.set('sensor', object())
+            closet.set('temperature', 21)
+        self.start()
+        closet = self.down_abode.lookup('/test/upstairs/closet')
+        wait_for(lambda: 'temperature' in closet.property_names())
+        self.assertEqual(closet.get('temperature'), 21)
+        self.assertEqual(closet.get('last_detected_humans'), seen)
+        self.assertNotIn('sensor', closet.property_names())
+
+        with self.lock:
+            self.up_abode.lookup('/test/upstairs/closet').set('sensor', object())
+            self.up_abode.lookup('/test/upstairs/closet').set('humidity', 40)
+        wait_for(lambda: 'humidity' in closet.property_names())
@@ -0,0 +1,55 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from mcp.abode import Abode
+from mcp.clock import VirtualClock
+from mcp.dimension import Coord, Size
+from mcp.history import History
+
+
+class TestHistory(TestCase):
+    def test_window_stats(self):
+        clock = VirtualClock(datetime(2016, 3, 1))
+        history = History(16, clock)
+        self.assertEqual(history.stats(), (0, None, None, None))
+        for value in (20, 22, 21, 19):
+            history.append(value)
+            clock.advance(timedelta(minutes=10))
+        self.assertEqual(history.stats(), (4, 19, 22, 20.5))
+        self.assertEqual(history.stats(timedelta(minutes=25)), (2, 19, 21, 20))
+        self.assertEqual(history.stats(timedelta(minutes=5)), (0, None, None, None))
+        self.assertEqual(history.samples(timedelta(minutes=15)), [(datetime(2016, 3, 1, 0, 30), 19)])
+
+    def test_bounded(self):
+        clock = VirtualClock(datetime(2016, 3, 1))
+        history = History(3, clock)
+        for value in range(10):
+            history.append(value)
+            clock.advance(timedelta(seconds=1))
+        self.assertEqual(len(history), 3)
+        self.assertEqual([value for _, value in history.samples()], [7, 8, 9])
+        self.assertEqual(history.stats(timedelta(seconds=2.5)), (2, 8, 9, 8.5))
+
+    def test_only_numbers(self):
+        history = History(4)
+        self.assertFalse(history.append('unset'))
+        self.assertTrue(history.append(True))
+        self.assertTrue(history.append(False))
+        self.assertEqual(history.stats().mean, 0.5)
+
+    def test_area_history(self):
+        clock = VirtualClock(datetime(2016, 3, 1))
+        abode = Abode('Test')
+        room = abode.create_room('Room', Coord(0, 0), Size(1, 1, 1))
+        room.set('temperature', 'unset')
+        room.track_history('temperature', 8, clock)
+        self.assertEqual(room.history_names(), ['temperature'])
+        for value in (20, 20, 21):
+            room.set('temperature', value)
+            clock.advance(timedelta(seconds=5))
+        room.set('humidity', 40)
+        self.assertEqual(room.history('temperature').stats(), (3, 20, 21, 61 / 3))
+        self.assertRaises(KeyError, lambda: room.history('humidity'))
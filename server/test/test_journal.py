@@ -0,0 +1,127 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+from unittest import TestCase
+
+from mcp import codec, journal, network
+
+
+class LocalSensor:
+    def __init__(self, name: str, address: str):
+        self.name = name
+        self.address = address
+        self.messages = []
+
+    def on_message(self, message):
+        self.messages.append(message)
+
+
+class TestJournal(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'bus.journal')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_write_read(self):
+        writer = journal.JournalWriter(self.filename, chunk_size=64)
+        records = [(journal.SensorMessage, 'nerve-bedroom-north', codec.NerveCodec.encode({'type': 'MOVEMENT',
+                                                                                             'state': True})),
+                   (journal.ActuatorMessage, 'wemoswitch-office-fountain', b'{"state": true}')]
+        for i in range(100):
+            kind, name, payload = records[i % 2]
+            writer.append(kind, name, payload, timestamp=i)
+        writer.close()
+
+        read = list(journal.JournalReader(self.filename))
+        self.assertEqual(len(read), 100)
+        for i, record in enumerate(read):
+            kind, name, payload = records[i % 2]
+            self.assertEqual((i, kind, name, payload), (record.timestamp, record.kind, record.name,
+                                                        bytes(record.payload)))
+
+    def test_existing_journal(self):
+        writer = journal.JournalWriter(self.filename)
+        writer.append(journal.SensorMessage, 'a', b'{}')
+        writer.close()
+        self.assertRaises(FileExistsError, lambda: journal.JournalWriter(self.filename))
+        self.assertEqual(len(list(journal.JournalReader(self.filename))), 1)
+
+    def test_unclosed_journal(self):
+        # Without close, the file still has its zeroed preallocated tail.
+        writer = journal.JournalWriter(self.filename)
+        writer.append(journal.SensorMessage, 'a', b'{}')
+        writer.flush()
+        self.assertEqual(len(list(journal.JournalReader(self.filename))), 1)
+        writer.close()
+
+    def test_truncated_journal(self):
+        writer = journal.JournalWriter(self.filename)
+        writer.append(journal.SensorMessage, 'a', b'{"first": 1}')
+        writer.append(journal.SensorMessage, 'a', b'{"second": 2}')
+        writer.close()
+        with open(self.filename, 'r+b') as fp:
+            fp.truncate(os.path.getsize(self.filename) - 3)
+        self.assertEqual([bytes(r.payload) for r in journal.JournalReader(self.filename)], [b'{"first": 1}'])
+
+    def test_record_and_replay(self):
+        bus = network.Bus(threading.Lock(), journal.JournalWriter(self.filename))
+        publisher = bus.bind_local('inproc://sensor')
+        local = LocalSensor('TestSensor', 'inproc://sensor')
+        bus.add_sensor(network.Sensor(local))
+        bus.start()
+
+        for i in range(5):
+            publisher.send({'seq': i})
+        while len(local.messages) < 5:
+            time.sleep(0.1)
+        bus.exit()
+        bus.join()
+        publisher.close()
+
+        # Replay into a fresh bus that is not even running.
+        fresh = network.Bus(threading.Lock())
+        replayed = LocalSensor('TestSensor', 'inproc://sensor')
+        fresh.add_sensor(network.Sensor(replayed))
+        stats = journal.replay(journal.JournalReader(self.filename), fresh, speed=0)
+        self.assertEqual(stats.messages, 5)
+        self.assertEqual(replayed.messages, [{'seq': i} for i in range(5)])
+        fresh.cleanup()
+
+    def test_replay_filters_like_bus(self):
+        writer = journal.JournalWriter(self.filename)
+        writer.append(journal.SensorMessage, 'TestSensor', b'{"type": "heartbeat"}', timestamp=0)
+        for i in range(5):
+            writer.append(journal.SensorMessage, 'TestSensor',
+                          codec.JsonCodec.encode({'type': 'MOVEMENT', 'seq': i}), timestamp=i)
+        writer.close()
+
+        bus = network.Bus(threading.Lock())
+        local = LocalSensor('TestSensor', 'inproc://sensor')
+        bus.add_sensor(network.Sensor(local, rate=1, burst=1, shed='merge'))
+        stats = journal.replay(journal.JournalReader(self.filename), bus, speed=0)
+        self.assertEqual(local.messages, [{'type': 'MOVEMENT', 'seq': 0}, {'type': 'MOVEMENT', 'seq': 4}])
+        self.assertEqual((stats.messages, stats.heartbeats, stats.shed), (2, 1, 3))
+        bus.cleanup()
+
+    def test_replay_speed(self):
+        writer = journal.JournalWriter(self.filename)
+        writer.append(journal.SensorMessage, 'TestSensor', b'{"seq": 0}', timestamp=0)
+        writer.append(journal.SensorMessage, 'TestSensor', b'{"seq": 1}', timestamp=2 * 10**9)
+        writer.close()
+
+        bus = network.Bus(threading.Lock())
+        local = LocalSensor('TestSensor', 'inproc://sensor')
+        bus.add_sensor(network.Sensor(local))
+        stats = journal.replay(journal.JournalReader(self.filename), bus, speed=10)
+        self.assertEqual(len(local.messages), 2)
+        self.assertGreaterEqual(stats.elapsed, 0.2)
+        self.assertLess(stats.elapsed, 1.0)
+        bus.cleanup()
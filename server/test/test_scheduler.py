@@ -4,7 +4,8 @@ from datetime import datetime, timedelta
 from unittest import TestCase
 from threading import Lock
 
-from mcp.scheduler import Scheduler
+from mcp.clock import VirtualClock
+from mcp.scheduler import Scheduler, _Event, _TimingWheel
 
 
 class TestScheduler(TestCase):
@@ -15,8 +16,8 @@ class TestScheduler(TestCase):
         scheduler.join()
 
     def test_set_timeout(self):
-        scheduler = Scheduler(Lock())
-        scheduler.start()
+        clock = VirtualClock(datetime(2016, 3, 1))
+        scheduler = clock.attach(Scheduler(Lock(), clock=clock))
 
         count = 0
         def callback():
@@ -27,12 +28,9 @@ class TestScheduler(TestCase):
 
         scheduler.set_timeout(timedelta(milliseconds=500), callback)
 
-        time.sleep(3.5)
+        clock.advance(timedelta(seconds=3.5))
         self.assertEqual(count, 6)
 
-        scheduler.exit()
-        scheduler.join()
-
     def test_negative_update(self):
         scheduler = Scheduler(Lock())
         scheduler.start()
@@ -47,3 +45,225 @@ class TestScheduler(TestCase):
 
         scheduler.exit()
         scheduler.join()
+
+    def test_cancel(self):
+        scheduler = Scheduler(Lock())
+        scheduler.start()
+
+        fired = []
+        keep = scheduler.set_timeout(timedelta(milliseconds=200), lambda: fired.append('keep'))
+        drop = scheduler.set_timeout(timedelta(milliseconds=100), lambda: fired.append('drop'))
+        self.assertTrue(drop.pending)
+        self.assertTrue(drop.cancel())
+        self.assertFalse(drop.cancel())
+        self.assertFalse(drop.pending)
+        time.sleep(0.5)
+        self.assertEqual(fired, ['keep'])
+        self.assertFalse(keep.pending)
+        self.assertFalse(keep.cancel())
+        self.assertEqual((scheduler.fired_count, scheduler.cancelled_count), (1, 1))
+
+        scheduler.exit()
+        scheduler.join()
+
+    def test_reschedule(self):
+        clock = VirtualClock(datetime(2016, 3, 1))
+        scheduler = clock.attach(Scheduler(Lock(), clock=clock))
+
+        fired = []
+        first = scheduler.set_timeout(timedelta(milliseconds=100), lambda: fired.append('first'))
+        scheduler.set_timeout(timedelta(milliseconds=300), lambda: fired.append('second'))
+        first.reschedule(timedelta(milliseconds=500))
+        clock.advance(timedelta(milliseconds=400))
+        self.assertEqual(fired, ['second'])
+        clock.advance(timedelta(milliseconds=400))
+        self.assertEqual(fired, ['second', 'first'])
+        self.assertEqual(scheduler.fired_count, 2)
+        self.assertEqual(scheduler.late_count, 0)
+
+        # A timer that has fired can be re-armed.
+        first.reschedule(timedelta(milliseconds=0))
+        clock.advance(timedelta(0))
+        self.assertEqual(fired, ['second', 'first', 'first'])
+
+    def test_compaction(self):
+        scheduler = Scheduler(Lock())
+        timers = [scheduler.set_timeout(timedelta(hours=1), lambda: None) for _ in range(200)]
+        for timer in timers[:150]:
+            timer.cancel()
+        self.assertEqual(scheduler.pending_count, 50)
+        self.assertGreaterEqual(scheduler.compaction_count, 1)
+        self.assertLess(len(scheduler.events_.heap_), 200)
+
+    def test_late(self):
+        lock = Lock()
+        scheduler = Scheduler(lock)
+        scheduler.start()
+
+        # Hold the model lock past the deadline.
+        with lock:
+            timer = scheduler.set_timeout(timedelta(milliseconds=0), lambda: None)
+            time.sleep(0.3)
+        while timer.pending:
+            time.sleep(0.01)
+        self.assertEqual(scheduler.late_count, 1)
+
+        scheduler.exit()
+        scheduler.join()
+
+    def test_wheel(self):
+        scheduler = Scheduler(Lock(), backend='wheel', tick=timedelta(milliseconds=20), wheel_slots=8)
+        scheduler.start()
+
+        fired = []
+        scheduler.set_timeout(timedelta(milliseconds=300), lambda: fired.append('late'))
+        scheduler.set_timeout(timedelta(milliseconds=50), lambda: fired.append('early'))
+        drop = scheduler.set_timeout(timedelta(milliseconds=100), lambda: fired.append('drop'))
+        self.assertEqual(scheduler.pending_count, 3)
+        self.assertTrue(drop.cancel())
+        self.assertEqual(scheduler.pending_count, 2)
+        time.sleep(0.6)
+        self.assertEqual(fired, ['early', 'late'])
+        self.assertEqual(scheduler.pending_count, 0)
+
+        scheduler.exit()
+        scheduler.join()
+
+    def test_wheel_revolutions(self):
+        class FakeTimer:
+            event_ = None
+
+        wheel = _TimingWheel(100, 4, 0)
+        events = []
+        for sequence, when in enumerate([50, 950, 250, 550, 225]):
+            event = _Event(when, sequence, FakeTimer())
+            event.timer.event_ = event
+            events.append(event)
+            wheel.push(event)
+
+        def drain(now):
+            due = []
+            event = wheel.pop_due(now)
+            while event is not None:
+                due.append(event.time)
+                event = wheel.pop_due(now)
+            return due
+
+        # Nothing fires early, even when it shares a slot with something due.
+        self.assertEqual(drain(100), [50])
+        self.assertEqual(wheel.next_time(), 300)
+        self.assertEqual(drain(300), [225, 250])
+        # Sleeping through more than a revolution catches up in order.
+        self.assertEqual(drain(2000), [550, 950])
+        self.assertEqual(len(wheel), 0)
+        self.assertIsNone(wheel.next_time())
+
+    def test_wheel_sparse(self):
+        class FakeTimer:
+            event_ = None
+
+        # Deadlines spread out over several blocks of slots, with whole empty blocks between them.
+        wheel = _TimingWheel(10, 1000, 0)
+        times = [15, 640, 655, 2010, 9990, 25000]
+        for sequence, when in enumerate(reversed(times)):
+            event = _Event(when, sequence, FakeTimer())
+            event.timer.event_ = event
+            wheel.push(event)
+        fired = []
+        next_time = wheel.next_time()
+        while next_time is not None:
+            event = wheel.pop_due(next_time)
+            while event is not None:
+                fired.append((event.time, next_time))
+                event = wheel.pop_due(next_time)
+            next_time = wheel.next_time()
+        self.assertEqual(fired, [(15, 20), (640, 640), (655, 660), (2010, 2010), (9990, 9990), (25000, 25000)])
+
+    def test_wheel_early_timer(self):
+        scheduler = Scheduler(Lock(), backend='wheel', tick=timedelta(milliseconds=20), wheel_slots=8)
+        scheduler.start()
+
+        # A far-off timer must not make nearer ones look overdue.
+        fired = []
+        scheduler.set_timeout(timedelta(hours=1), lambda: fired.append('later'))
+        scheduler.set_timeout(timedelta(milliseconds=300), lambda: fired.append('soon'))
+        time.sleep(0.1)
+        self.assertEqual(fired, [])
+        time.sleep(0.4)
+        self.assertEqual(fired, ['soon'])
+
+        scheduler.exit()
+        scheduler.join()
+
+    def test_unlocked_callbacks(self):
+        lock = Lock()
+        scheduler = Scheduler(lock, workers=2)
+        scheduler.start()
+
+        # A slow callback that does not need the lock must not hold up the others.
+        ran = []
+        def slow():
+            time.sleep(0.5)
+            ran.append(('slow', lock.locked()))
+        def quick():
+            ran.append(('quick', lock.locked()))
+        scheduler.set_timeout(timedelta(milliseconds=0), slow, needs_lock=False)
+        scheduler.set_timeout(timedelta(milliseconds=50), quick)
+        time.sleep(0.2)
+        self.assertEqual(ran, [('quick', True)])
+        time.sleep(0.5)
+        self.assertEqual(ran, [('quick', True), ('slow', False)])
+
+        scheduler.exit()
+        scheduler.join()
+
+    def test_callback_stats(self):
+        clock = VirtualClock(datetime(2016, 3, 1))
+        scheduler = clock.attach(Scheduler(Lock(), clock=clock, workers=0))
+
+        def poll():
+            pass
+        def broken():
+            raise ValueError("broken")
+        for delay in range(3):
+            scheduler.set_timeout(timedelta(seconds=delay), poll)
+        scheduler.set_timeout(timedelta(seconds=1), broken, needs_lock=False)
+        clock.advance(timedelta(seconds=5))
+
+        stats = scheduler.callback_stats()
+        self.assertEqual({name.split('.')[-1]: entry.calls for name, entry in stats.items()}, {'poll': 3, 'broken': 1})
+        for entry in stats.values():
+            self.assertGreaterEqual(entry.max_time, entry.mean_time)
+            self.assertGreaterEqual(entry.total_time, entry.max_time)
+
+    def test_slack(self):
+        class CountingLock:
+            def __init__(self):
+                self.lock_ = Lock()
+                self.acquisitions = 0
+
+            def __enter__(self):
+                self.lock_.acquire()
+                self.acquisitions += 1
+
+            def __exit__(self, *args):
+                self.lock_.release()
+
+        for backend in Scheduler.Backends:
+            clock = VirtualClock(datetime(2016, 3, 1))
+            lock = CountingLock()
+            scheduler = clock.attach(Scheduler(lock, backend=backend, tick=timedelta(milliseconds=10), clock=clock,
+                                                workers=0))
+            fired = []
+            def fire(name: str):
+                return lambda: fired.append((name, clock.monotonic()))
+
+            # The first timer can wait for the second; the third is not due until after both.
+            scheduler.set_timeout(timedelta(seconds=1), fire('a'), slack=timedelta(seconds=1))
+            scheduler.set_timeout(timedelta(seconds=1.5), fire('b'))
+            scheduler.set_timeout(timedelta(seconds=1.8), fire('c'), slack=timedelta(seconds=1))
+            clock.advance(timedelta(seconds=5))
+            self.assertEqual(fired, [('a', 1.5), ('b', 1.5), ('c', 2.8)], backend)
+            self.assertEqual(scheduler.wakeups_saved, 1, backend)
+            self.assertEqual(lock.acquisitions, 2, backend)
+            self.assertEqual(scheduler.late_count, 0, backend)
@@ -0,0 +1,58 @@
+# This Source Code Form is subject to the terms of the GNU General Public
+# License, version 3. If a copy of the GPL was not distributed with this file,
+# You can obtain one at https://www.gnu.org/licenses/gpl.txt.
+from unittest import TestCase, skipIf
+
+from mcp import spatial
+from mcp.abode import Abode
+from mcp.dimension import Coord, Size
+
+
+class TestSpatialIndex(TestCase):
+    def build_abode(self):
+        abode = Abode('Test')
+        kitchen = abode.create_room('kitchen', Coord(0, 0), Size(4, 3, 2.5))
+        hall = abode.create_room('hall', Coord(4, 0), Size(1.5, 6, 2.5))
+        # Positions are relative to the parent: the island is at (1, 1) to (3, 2) in the house.
+        island = kitchen.create_subarea('island', Coord(1, 1), Size(2, 1, 1))
+        loft = hall.create_subarea('loft', Coord(0, 3, 2.5), Size(1.5, 3, 2))
+        return abode, kitchen, hall, island, loft
+
+    def test_at_point(self):
+        abode, kitchen, hall, island, loft = self.build_abode()
+        index = abode.spatial_index()
+        self.assertEqual(index.at_point(0.5, 0.5), [kitchen])
+        self.assertEqual(index.at_point(2, 1.5), [kitchen, island])
+        self.assertEqual(index.at_point(2, 1.5, 2), [kitchen])
+        self.assertEqual(index.at_point(4, 1), [hall, kitchen])  # On the wall.
+        self.assertEqual(index.at_point(4.5, 4, 1), [hall])
+        self.assertEqual(index.at_point(4.5, 4, 3), [loft])
+        self.assertEqual(index.at_point(10, 10), [])
+        self.assertEqual(index.at_point(-0.5, 0.5), [])
+
+    def test_overlapping(self):
+        abode, kitchen, hall, island, loft = self.build_abode()
+        index = abode.spatial_index()
+        self.assertEqual(index.overlapping(Coord(2.5, 1.5), Size(2, 0.1, 0.1)), [hall, kitchen, island])
+        self.assertEqual(index.overlapping(Coord(4.1, 3.1, 3), Size(0.1, 0.1, 0.1)), [loft])
+        self.assertEqual(index.overlapping(Coord(6, 0), Size(1, 1, 1)), [])
+
+    def test_replaced_area(self):
+        abode, kitchen, hall, island, loft = self.build_abode()
+        pantry = abode.create_room('kitchen', Coord(0, 0), Size(1, 1, 2.5))
+        index = abode.spatial_index()
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.at_point(2, 1.5), [])
+        self.assertEqual(index.at_point(0.5, 0.5), [pantry])
+
+    def test_at_points(self):
+        abode, kitchen, hall, island, loft = self.build_abode()
+        points = [(0.5, 0.5, 1), (2, 1.5, 0.5), (4.5, 4, 3), (10, 10, 0)]
+        self.assertEqual(abode.spatial_index().at_points(points), [[kitchen], [kitchen, island], [loft], []])
+
+    @skipIf(spatial.numpy is None, "numpy is not installed")
+    def test_contains_points(self):
+        abode, kitchen, hall, island, loft = self.build_abode()
+        areas, inside = abode.spatial_index().contains_points(spatial.numpy.array([(0.5, 0.5), (2, 1.5)]))
+        self.assertEqual(areas, [hall, loft, kitchen, island])
+        self.assertEqual(inside.tolist(), [[False, False, True, False], [False, False, True, True]])